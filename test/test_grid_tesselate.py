@@ -0,0 +1,625 @@
+import unittest
+'''Tests for grid_tesselate.py
+These run without Earth Engine or GDAL: each test makes a small raster (padded by 1 cell, as get_zipped_tiles() does),
+meshes it with the per-cell engine (create_cells()) and/or the vectorized engine (create_triangle_arrays()) and
+compares the resulting triangles.
+'''
+import os
+import io
+import time
+import warnings
+import struct
+import functools
+import tracemalloc
+import tempfile
+import zipfile
+import contextlib
+import numpy
+from touchterrain.common.grid_tesselate import grid, vertex, quad, cell, get_normal, get_normals, corner_elevations, cell_borders, tri_cell_types
+from touchterrain.common.utils import dilate_array, fillHoles, clean_up_diags, share_raster, attach_shared_raster
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# the benchmarks (run times compared to the previous versions) depend on the machine and its load, so they only run 
+# if TOUCHTERRAIN_BENCHMARKS is set, e.g. TOUCHTERRAIN_BENCHMARKS=1 python -m pytest test/test_grid_tesselate.py
+benchmark = unittest.skipUnless(os.getenv("TOUCHTERRAIN_BENCHMARKS"), "set TOUCHTERRAIN_BENCHMARKS to run the benchmarks")
+
+nn = numpy.nan
+
+def make_tile_info(**overwrite):
+    '''tile info dict with the settings get_zipped_tiles() would use for a single 10 x 8 mm tile'''
+    tile_info = {
+        "scale": 1000,
+        "z_scale": 1.0,
+        "pixel_mm": 1.0,
+        "min_elev": 0,
+        "min_bot_elev": None,
+        "user_offset": 0,
+        "base_thickness_mm": 1.0,
+        "tile_centered": False,
+        "tile_no_x": 1,
+        "tile_no_y": 1,
+        "ntilesy": 1,
+        "tile_width": 10,
+        "tile_height": 8,
+        "full_raster_width": -1,
+        "full_raster_height": -1,
+        "fileformat": "STLb",
+        "temp_file": None,
+        "no_bottom": False,
+        "bottom_image": None,
+        "bottom_elevation": None,
+        "no_normals": True,
+        "geo_transform": None,
+        "use_geo_coords": None,
+        "smooth_borders": False,
+        "clean_diags": False,
+        "dirty_triangles": False,
+        "throughwater": False,
+    }
+    tile_info.update(overwrite)
+    return tile_info
+
+def make_top(with_nan=False):
+    '''10 x 8 test raster with some relief (and a NaN hole and NaN corner)'''
+    top = numpy.add.outer(numpy.arange(8) * 3.0, numpy.arange(10) * 2.0) + 100
+    top[3, 4] += 7.5
+    if with_nan:
+        top[0:2, 0:3] = nn
+        top[4:6, 5:7] = nn
+    return top
+
+def prepare(top, bottom=None):
+    '''dilate (if needed) and pad the raster(s) like get_zipped_tiles() does
+    returns top, bottom, top_orig'''
+    top_orig = None
+    if bottom is None and numpy.any(numpy.isnan(top)):
+        top_orig = numpy.pad(top, (1,1), 'edge')
+        top = dilate_array(top)
+    top = numpy.pad(top, (1,1), 'edge')
+    if bottom is not None:
+        bottom = numpy.pad(bottom, (1,1), 'edge')
+    return top, bottom, top_orig
+
+def mesh(top, bottom, top_orig, tile_info, vectorized, cells_per_band=None):
+    '''returns the buffer (or temp file content) of the mesh file
+    cells_per_band: for vectorized, use (much) smaller bands to test the band boundaries'''
+    tile_info = dict(tile_info, vectorized_mesh=vectorized)
+    g = grid(top.copy(), None if bottom is None else bottom.copy(),
+             None if top_orig is None else top_orig.copy(), tile_info)
+    if cells_per_band is not None:
+        g.create_triangle_arrays = functools.partial(g.create_triangle_arrays, cells_per_band=cells_per_band)
+    b = g.make_file_buffer()
+    if tile_info["temp_file"] is not None:
+        with open(b, "rb") as fo:
+            b = fo.read()
+        os.remove(tile_info["temp_file"])
+    return b
+
+def STLb_to_array(buf):
+    '''returns normals (n,3) and triangles (n, 3, 3) of a binary STL buffer'''
+    num_tris = numpy.frombuffer(buf, dtype="<u4", count=1, offset=80)[0]
+    facets = numpy.frombuffer(buf, dtype=numpy.dtype([("n", "<f4", 3), ("v", "<f4", (3,3)), ("a", "<u2")]), offset=84)
+    assert len(facets) == num_tris
+    return facets["n"], facets["v"]
+
+def STLa_to_array(buf):
+    '''returns triangles (n, 3, 3) of an ascii STL string'''
+    verts = [[float(c) for c in l.split()[1:]] for l in buf.splitlines() if l.startswith("vertex")]
+    return numpy.array(verts).reshape(-1, 3, 3)
+
+def obj_to_array(buf):
+    '''returns triangles (n, 3, 3) of an obj string'''
+    lines = buf.splitlines()
+    verts = numpy.array([[float(c.strip(",")) for c in l.split()[1:]] for l in lines if l.startswith("v ")])
+    idx = numpy.array([[int(c.strip(",")) for c in l.split()[1:]] for l in lines if l.startswith("f ")])
+    return verts[idx - 1]
+
+def obj_canonical(buf):
+    '''returns the coords of the 3 vertices of each face of an obj string, sorted by face, i.e. independent of the 
+    numbering of the vertices and the order of vertices and faces. Coords are rounded to float32 (as in STL files) because
+    create_cells() calculates a corner shared by 4 cells up to 4 times, which can differ in the last digit'''
+    lines = buf.splitlines()
+    verts = [" ".join(str(numpy.float32(c.strip(","))) for c in l.split()[1:]) for l in lines if l.startswith("v ")]
+    faces = [[int(c.strip(",")) for c in l.split()[1:]] for l in lines if l.startswith("f ")]
+    return sorted(" | ".join(verts[i - 1] for i in f) for f in faces)
+
+
+class VectorizedMeshTests(unittest.TestCase):
+    '''the vectorized engine must create the same triangles (in the same order) as the per-cell engine'''
+
+    def assert_same_mesh(self, top, bottom=None, top_orig=None, prepared=False, **overwrite):
+        '''meshes top (and bottom) with both engines, prepared=True means the rasters are already dilated and padded'''
+        tile_info = make_tile_info(**overwrite)
+        if prepared == False:
+            top, bottom, top_orig = prepare(top, bottom)
+        legacy = mesh(top, bottom, top_orig, tile_info, False)
+        vectorized = mesh(top, bottom, top_orig, tile_info, True, cells_per_band=30)
+        fileformat = tile_info["fileformat"]
+        if fileformat == "STLb":
+            legacy_normals, legacy_tris = STLb_to_array(legacy)
+            vec_normals, vec_tris = STLb_to_array(vectorized)
+            numpy.testing.assert_allclose(vec_normals, legacy_normals, rtol=1e-6, atol=1e-6)
+        elif fileformat == "STLa":
+            legacy_tris, vec_tris = STLa_to_array(legacy), STLa_to_array(vectorized)
+        else:
+            legacy_tris, vec_tris = obj_to_array(legacy), obj_to_array(vectorized)
+        self.assertGreater(len(legacy_tris), 0)
+        self.assertEqual(legacy_tris.shape, vec_tris.shape)
+        numpy.testing.assert_allclose(vec_tris, legacy_tris, rtol=1e-6, atol=1e-5)
+        return vec_tris
+
+    def test_corner_elevations(self):
+        ras = numpy.array([[1.0, 2.0, 3.0],
+                           [4.0,  nn, 6.0],
+                           [ nn,  nn, 9.0]])
+        c = corner_elevations(ras, nan_aware=True)
+        numpy.testing.assert_allclose(c, [[7/3, 11/3], [4.0, 7.5]])
+        self.assertTrue(numpy.isnan(corner_elevations(ras)[0, 0]))
+        self.assertTrue(numpy.isnan(corner_elevations(numpy.full((2,2), nn), nan_aware=True)[0, 0]))
+
+    def test_flat_bottom(self):
+        tris = self.assert_same_mesh(make_top())
+        self.assertEqual(len(tris), 10 * 8 * 2 + 2 * (10 + 8) * 2 + 2) # top, walls, 2 bottom triangles
+
+    def test_with_normals(self):
+        self.assert_same_mesh(make_top(), no_normals=False)
+
+    def test_centered_tile(self):
+        self.assert_same_mesh(make_top(), tile_centered=True)
+
+    def test_NaN_no_smoothing(self):
+        self.assert_same_mesh(make_top(with_nan=True))
+
+    def test_NaN_no_bottom(self):
+        self.assert_same_mesh(make_top(with_nan=True), no_bottom=True)
+
+    def test_NaN_dirty_triangles(self):
+        self.assert_same_mesh(make_top(with_nan=True), dirty_triangles=True)
+
+    def test_NaN_dirty_triangles_with_normals(self):
+        self.assert_same_mesh(make_top(with_nan=True), dirty_triangles=True, no_normals=False)
+
+    def test_STLa_with_normals(self):
+        self.assert_same_mesh(make_top(with_nan=True), fileformat="STLa", no_normals=False)
+
+    def test_bottom_elevation(self):
+        top = make_top()
+        bottom = top - 20 - numpy.arange(10)
+        self.assert_same_mesh(top, bottom, bottom_elevation="bottom.tif", min_bot_elev=numpy.nanmin(bottom))
+
+    def test_bottom_elevation_with_NaN(self):
+        top = make_top()
+        bottom = top - 20
+        bottom[2:4, 2:5] = nn
+        self.assert_same_mesh(top, bottom, bottom_elevation="bottom.tif", min_bot_elev=numpy.nanmin(bottom))
+
+    def test_throughwater(self):
+        top = make_top()
+        bottom = top - 20
+        top_orig = numpy.pad(top, (1,1), 'edge')
+        top_orig[3:5, 3:5] = nn
+        top, bottom, _ = prepare(top, bottom)
+        self.assert_same_mesh(top, bottom, top_orig, prepared=True, bottom_elevation="bottom.tif", throughwater=True,
+                              min_bot_elev=numpy.nanmin(bottom))
+
+    def test_bottom_image(self):
+        top, _, _ = prepare(make_top())
+        relief = numpy.random.default_rng(42).random(top.shape) * 0.8
+        tris = self.assert_same_mesh(top, relief, prepared=True, bottom_image="relief.png")
+        self.assertEqual(len(tris), 10 * 8 * 4 + 2 * (10 + 8) * 2) # top and bottom and walls
+
+    def test_geo_coords(self):
+        self.assert_same_mesh(make_top(), use_geo_coords="centered", geo_transform=(500000, 10, 0, 4000000, 0, -10))
+
+    def test_STLa(self):
+        self.assert_same_mesh(make_top(with_nan=True), fileformat="STLa")
+
+    def test_obj(self):
+        self.assert_same_mesh(make_top(with_nan=True), fileformat="obj")
+
+    def test_smooth_borders(self):
+        self.assert_same_mesh(make_top(with_nan=True), smooth_borders=True)
+
+    def test_smooth_borders_random_mask(self):
+        top = numpy.random.default_rng(1).random((40, 50)) * 10 + 100
+        top[numpy.random.default_rng(2).random(top.shape) < 0.3] = nn
+        self.assert_same_mesh(top, smooth_borders=True, tile_width=50, tile_height=40)
+        self.assert_same_mesh(top, smooth_borders=True, tile_width=50, tile_height=40, fileformat="obj")
+
+    def test_smooth_borders_no_bottom(self):
+        # create_cells() can't make tri-cells without a bottom, so only check the number of triangles
+        top, bottom, top_orig = prepare(make_top(with_nan=True))
+        with_bottom = STLb_to_array(mesh(top, bottom, top_orig, make_tile_info(smooth_borders=True), True))[1]
+        no_bottom = STLb_to_array(mesh(top, bottom, top_orig, make_tile_info(smooth_borders=True, no_bottom=True), True))[1]
+        valid = ~numpy.isnan(top_orig[1:-1, 1:-1])
+        num_tri_cells = numpy.count_nonzero(tri_cell_types(cell_borders(top_orig, True))[valid])
+        num_cells = numpy.count_nonzero(valid)
+        self.assertEqual(len(with_bottom) - len(no_bottom), 2 * num_cells - num_tri_cells)
+
+    def test_tri_cell_types(self):
+        top_orig = numpy.pad(numpy.array([[ nn, 1.0, 1.0],
+                                          [1.0, 1.0,  nn],
+                                          [1.0, 1.0, 1.0]]), (1,1), 'edge')
+        types = tri_cell_types(cell_borders(top_orig, True))
+        # the NW and SE corner cells have 3 borders (2 fringe walls + NaN neighbour)
+        numpy.testing.assert_array_equal(types, [[1, 1, 0],
+                                                 [1, 0, 0],
+                                                 [4, 0, 0]])
+
+    def test_temp_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assert_same_mesh(make_top(with_nan=True), temp_file=os.path.join(tmp, "tile.tmp"))
+
+    def test_STLb_preallocated(self):
+        # vectorized STLb files/buffers are allocated for the exact number of triangles before meshing
+        all_nan = numpy.full((8, 10), nn)
+        with warnings.catch_warnings(): # the all NaN tile must not warn (nanmin() of an all NaN top)
+            warnings.simplefilter("error", RuntimeWarning)
+            for top in (make_top(), make_top(with_nan=True), all_nan):
+                top, bottom, top_orig = prepare(top)
+                in_memory = mesh(top, bottom, top_orig, make_tile_info(no_normals=False), True, cells_per_band=30)
+                self.assertIsInstance(in_memory, bytearray)
+                with tempfile.TemporaryDirectory() as tmp:
+                    tile_info = make_tile_info(no_normals=False, temp_file=os.path.join(tmp, "tile.tmp"))
+                    temp_file = mesh(top, bottom, top_orig, tile_info, True, cells_per_band=30)
+                    self.assertEqual(os.listdir(tmp), []) # no .body file left behind
+                self.assertEqual(temp_file, in_memory)
+                self.assertEqual(temp_file, mesh(top, bottom, top_orig, make_tile_info(no_normals=False), False))
+        self.assertEqual(len(in_memory), 84) # all NaN: header only
+
+    def test_parallel_stripes(self):
+        # stripes meshed on 2 processes must give the same file as a single process
+        top, bottom, top_orig = prepare(make_top(with_nan=True))
+        with tempfile.TemporaryDirectory() as tmp:
+            for fileformat, temp_file in (("STLb", os.path.join(tmp, "tile.tmp")), ("obj", None)):
+                tile_info = make_tile_info(fileformat=fileformat, temp_file=temp_file, smooth_borders=True, no_normals=False)
+                single = mesh(top, bottom, top_orig, tile_info, True)
+                parallel = mesh(top, bottom, top_orig, dict(tile_info, CPU_cores_per_tile=2), True)
+                self.assertEqual(parallel, single)
+
+    def test_band_size(self):
+        # output must not depend on how many rows are processed at once
+        top, bottom, top_orig = prepare(make_top(with_nan=True))
+        for fileformat in ("STLb", "obj"):
+            tile_info = make_tile_info(fileformat=fileformat, smooth_borders=True)
+            whole_tile = mesh(top, bottom, top_orig, tile_info, True)
+            for cells_per_band in (1, 20, 35):
+                self.assertEqual(mesh(top, bottom, top_orig, tile_info, True, cells_per_band), whole_tile)
+
+    def test_float32_rasters(self):
+        # accuracy check: float32 rasters must give the same triangles as float64 rasters, up to float32 rounding
+        top = make_top(with_nan=True) * 10 + 1000
+        bottom = top - 20 - numpy.arange(10)
+        for (t, b, o), overwrite in [(prepare(top), dict(smooth_borders=True)), (prepare(top), dict(dirty_triangles=True)),
+                                     (prepare(make_top(), bottom), dict(bottom_elevation="bottom.tif", min_bot_elev=numpy.nanmin(bottom))),
+                                     (prepare(top), dict(use_geo_coords="UTM", geo_transform=(500000, 10, 0, 4000000, 0, -10)))]:
+            with self.subTest(**overwrite):
+                tile_info = make_tile_info(min_elev=numpy.nanmin(top), **overwrite)
+                _, expected = STLb_to_array(mesh(t, b, o, tile_info, True))
+                _, tris = STLb_to_array(mesh(*[None if r is None else r.astype(numpy.float32) for r in (t, b, o)],
+                                             dict(tile_info, float32_rasters=True), True, cells_per_band=30))
+                self.assertEqual(tris.shape, expected.shape)
+                numpy.testing.assert_allclose(tris, expected, rtol=1e-6, atol=1e-3)
+                # the per-cell engine ignores float32_rasters (its corners would not be manifold in float32)
+                self.assertEqual(mesh(t, b, o, dict(tile_info, float32_rasters=True), False), mesh(t, b, o, tile_info, False))
+
+    def test_float32_rasters_memory(self):
+        top, _, top_orig = prepare(make_top(with_nan=True).repeat(30, axis=0).repeat(30, axis=1))
+        peaks = []
+        for dtype in (numpy.float64, numpy.float32):
+            tile_info = make_tile_info(vectorized_mesh=True, float32_rasters=dtype == numpy.float32)
+            t, o = top.astype(dtype), top_orig.astype(dtype)
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracemalloc.start()
+                g = grid(t, None, o, tile_info)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            self.assertEqual(g.top.dtype, dtype)
+            self.assertTrue(numpy.shares_memory(g.top_orig, o)) # not copied
+            del g
+        self.assertLess(peaks[1], 0.6 * peaks[0])
+
+    def test_obj_grid_indexed(self):
+        # same faces as with vertex_index_dict, just numbered differently
+        top = make_top()
+        bottom = top - 20 - numpy.arange(10)
+        configs = [(make_top(), None, {}), 
+                   (make_top(with_nan=True), None, {}),
+                   (make_top(with_nan=True), None, {"smooth_borders": True}),
+                   (make_top(with_nan=True), None, {"no_bottom": True}),
+                   (top, bottom, {"bottom_elevation": "bottom.tif", "min_bot_elev": numpy.nanmin(bottom)})]
+        for top, bottom, overwrite in configs:
+            top, bottom, top_orig = prepare(top, bottom)
+            tile_info = make_tile_info(fileformat="obj", **overwrite)
+            legacy = mesh(top, bottom, top_orig, tile_info, False)
+            grid_indexed = mesh(top, bottom, top_orig, tile_info, True)
+            self.assertEqual(obj_canonical(grid_indexed), obj_canonical(legacy))
+            # no unused vertices (vertex_index_dict also has unused bottom vertices)
+            lines = grid_indexed.splitlines()
+            num_verts = len([l for l in lines if l.startswith("v ")])
+            used_ids = {int(c.strip(",")) for l in lines if l.startswith("f ") for c in l.split()[1:]}
+            self.assertEqual(used_ids, set(range(1, num_verts + 1)))
+
+    def test_obj_grid_indexed_temp_file(self):
+        top, bottom, top_orig = prepare(make_top(with_nan=True))
+        in_memory = mesh(top, bottom, top_orig, make_tile_info(fileformat="obj"), True)
+        with tempfile.TemporaryDirectory() as tmp:
+            tile_info = make_tile_info(fileformat="obj", temp_file=os.path.join(tmp, "tile.tmp"))
+            temp_file = mesh(top, bottom, top_orig, tile_info, True, cells_per_band=30) # 3 rows per band
+            self.assertFalse(os.path.exists(tile_info["temp_file"] + ".idx"))
+        self.assertEqual(temp_file.decode(), in_memory)
+
+
+class STLbWriterTests(unittest.TestCase):
+    '''write_triangle_array_to_buffer() must write the same bytes as packing each facet with struct'''
+
+    def write(self, tris, temp_file=None, **overwrite):
+        top, bottom, top_orig = prepare(make_top())
+        g = grid(top, bottom, top_orig, make_tile_info(temp_file=temp_file, **overwrite))
+        g.s = io.BytesIO()
+        if temp_file is not None:
+            g.fo = open(temp_file, "ab")
+        g.write_triangle_array_to_buffer(tris[:3])
+        g.write_triangle_array_to_buffer(tris[3:])
+        if temp_file is None:
+            return g.s.getvalue(), g.num_triangles
+        g.fo.close()
+        with open(temp_file, "rb") as fo:
+            return fo.read(), g.num_triangles
+
+    def test_get_normals(self):
+        tris = numpy.random.default_rng(5).random((20, 3, 3))
+        tris[3, 1] = tris[3, 0] # collapsed into a line
+        tris[4, :] = tris[4, 0] # collapsed into a point
+        normals = get_normals(tris)
+        numpy.testing.assert_array_equal(normals, [get_normal(t) for t in tris.tolist()])
+        numpy.testing.assert_array_equal(normals[3:5], 0)
+        self.assertFalse(numpy.signbit(normals[3:5]).any()) # 0.0, not -0.0
+
+    def expected(self, tris, no_normals):
+        return b"".join(struct.pack("12fH", *(get_normal(t) if no_normals == False else [0,0,0]), *sum(t, []), 0) 
+                        for t in tris.tolist())
+
+    def test_in_memory(self):
+        tris = numpy.random.default_rng(3).random((7, 3, 3)) * 100
+        tris[5, 2] = tris[5, 1] # degenerate triangle
+        for no_normals in (True, False):
+            buf, num_triangles = self.write(tris, no_normals=no_normals)
+            self.assertEqual(num_triangles, 7)
+            self.assertEqual(buf, self.expected(tris, no_normals))
+
+    def test_temp_file(self):
+        tris = numpy.random.default_rng(4).random((7, 3, 3)) * 100
+        with tempfile.TemporaryDirectory() as tmp:
+            buf, _ = self.write(tris, temp_file=os.path.join(tmp, "tile.tmp"), no_normals=False)
+        self.assertEqual(buf, self.expected(tris, False))
+
+
+class SharedRasterTests(unittest.TestCase):
+    '''multi-core tiles are read-only windows of rasters in shared memory (see process_shared_tile())'''
+
+    def test_grid_on_shared_rasters(self):
+        top, _, top_orig = prepare(make_top(with_nan=True))
+        bottom = top - 20 - numpy.arange(12)
+        blocks = []
+        try:
+            shared = []
+            for ras in (top, bottom, top_orig):
+                shm, sh = share_raster(ras)
+                blocks.append(shm)
+                shared.append(sh)
+            window = (slice(0, 6), slice(2, 12)) # a tile of 4 x 8 cells (plus fringe)
+            for tile_info in (make_tile_info(), make_tile_info(use_geo_coords="UTM", geo_transform=(0, 1, 0, 0, 0, -1)),
+                              make_tile_info(bottom_elevation="bottom.tif", min_bot_elev=numpy.nanmin(bottom))):
+                views = [attach_shared_raster(sh, window) for sh in shared]
+                t, b, o = [v for _, v in views]
+                self.assertFalse(t.flags.writeable)
+                b = b if tile_info["bottom_elevation"] is not None else None
+                g = grid(t, b, o, dict(tile_info)) # grid changes tile_info
+                self.assertTrue(numpy.shares_memory(g.top_orig, o)) # not copied
+                self.assertEqual(numpy.shares_memory(g.top, t), tile_info["use_geo_coords"] is not None) # only copied if scaled
+                buf = g.make_file_buffer()
+                expected = mesh(top[window], None if b is None else bottom[window], top_orig[window], tile_info, False)
+                self.assertEqual(bytes(buf), expected)
+                del g, t, b, o, views # release the views before closing
+            shm, shared_top = attach_shared_raster(shared[0])
+            numpy.testing.assert_array_equal(shared_top, top) # unchanged
+            del shared_top
+            shm.close()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+
+class ZipStreamTests(unittest.TestCase):
+    '''in temp file mode, tiles are streamed into their zip file member (or a worker's part archive)'''
+
+    def stream(self, top, top_orig, tile_info, vectorized, tmp):
+        zip_name = os.path.join(tmp, "tiles.zip")
+        with zipfile.ZipFile(zip_name, "w", allowZip64=True) as zf:
+            with zf.open("tile", "w", force_zip64=True) as zip_stream:
+                g = grid(top.copy(), None, top_orig.copy(), dict(tile_info, vectorized_mesh=vectorized))
+                self.assertIs(g.make_file_buffer(zip_stream), zip_stream)
+        self.assertEqual(os.listdir(tmp), ["tiles.zip"]) # no temp files left
+        with zipfile.ZipFile(zip_name) as zf:
+            self.assertIsNone(zf.testzip())
+            return zf.read("tile")
+
+    def test_stream_into_zip_member(self):
+        top, _, top_orig = prepare(make_top(with_nan=True))
+        for fileformat in ("STLb", "STLa", "obj"):
+            for vectorized in (True, False): # non-vectorized STLb goes through the temp file
+                with self.subTest(fileformat=fileformat, vectorized=vectorized), tempfile.TemporaryDirectory() as tmp:
+                    tile_info = make_tile_info(fileformat=fileformat, temp_file=os.path.join(tmp, "tile.tmp"))
+                    expected = mesh(top, None, top_orig, tile_info, vectorized)
+                    self.assertEqual(self.stream(top, top_orig, tile_info, vectorized, tmp), expected)
+
+    def test_is_empty(self):
+        '''is_empty() (which decides whether a tile gets a zip member) must match a mesh without triangles'''
+        rng = numpy.random.default_rng(13)
+        for trial in range(40):
+            top = make_top()
+            top[rng.random(top.shape) < rng.choice([0.5, 0.9, 0.97, 1.0])] = nn
+            if trial % 10 == 0:
+                top[:] = nn # e.g. a water tile that no water cells cross
+            elif trial % 10 == 1:
+                top[:] = nn
+                top[0, :] = 1.0 # only in the fringe cells
+            for dirty_triangles in (False, True):
+                for clean_diags in (False, True):
+                    tile_info = make_tile_info(dirty_triangles=dirty_triangles, clean_diags=clean_diags)
+                    args = prepare(top.copy())
+                    if args[2] is None: # no NaN
+                        continue
+                    g = grid(args[0].copy(), None, args[2].copy(), dict(tile_info, vectorized_mesh=True))
+                    is_empty = g.is_empty()
+                    with self.subTest(trial=trial, dirty_triangles=dirty_triangles, clean_diags=clean_diags):
+                        for vectorized in (True, False):
+                            g = grid(args[0].copy(), None, args[2].copy(), dict(tile_info, vectorized_mesh=vectorized))
+                            g.make_file_buffer()
+                            self.assertEqual(is_empty, g.num_triangles == 0)
+        self.assertFalse(grid(*prepare(make_top()), make_tile_info()).is_empty()) # no NaN
+
+
+class RasterDiagsCleanedTests(unittest.TestCase):
+    '''tiles of a raster whose holes were filled and diagonals cleaned up as a whole (raster_diags_cleaned)'''
+
+    def test_raster_diags_cleaned(self):
+        '''a tile of a raster that was already cleaned up as a whole must not be cleaned up again'''
+        top = make_top()
+        top[2, 2] = top[3, 3] = top[5, 6] = top[6, 7] = nn # two diagonal patterns
+        top[4, 8] = top[5, 8] = top[6, 2] = nn # and a single hole
+        pad = functools.partial(numpy.pad, pad_width=(1, 1), mode="edge")
+        for vectorized in (False, True):
+            with self.subTest(vectorized=vectorized), contextlib.redirect_stdout(io.StringIO()):
+                # like get_zipped_tiles(), the tiles get the (undilated) top and a copy of it as top_orig
+                expected = mesh(pad(top), None, pad(top), make_tile_info(clean_diags=True), vectorized)
+                cleaned, cleaned_orig = clean_up_diags(fillHoles(top, 1, 8, True)), clean_up_diags(top)
+                self.assertTrue(numpy.isnan(cleaned_orig[6, 2]) and not numpy.isnan(cleaned[6, 2]))
+                tile_info = make_tile_info(clean_diags=True, raster_diags_cleaned=True)
+                self.assertEqual(mesh(pad(cleaned), None, pad(cleaned_orig), tile_info, vectorized), expected)
+
+    def test_raster_diags_cleaned_tile_seam(self):
+        '''holes filled and diagonals cleaned on the full raster give the same top elevations on both sides of a seam
+        between two tiles, doing it per tile (as before) doesn't, as each tile only sees a 1 cell fringe of the other'''
+        def seam_elevations(tile_rasters, seam_x):
+            '''y -> highest z of the mesh vertices on the seam, for each of the tiles'''
+            seams = []
+            for tx, (top, top_orig) in enumerate(tile_rasters):
+                tile_info = make_tile_info(clean_diags=True, raster_diags_cleaned=per_tile == False, tile_no_x=tx + 1,
+                                           tile_width=8, tile_height=8, full_raster_width=16, full_raster_height=8)
+                tris = STLb_to_array(mesh(top, None, top_orig, tile_info, True))[1].reshape(-1, 3)
+                tris = tris[tris[:, 0] == seam_x]
+                seams.append({y: tris[tris[:, 1] == y, 2].max() for y in numpy.unique(tris[:, 1])})
+            return seams
+
+        rng = numpy.random.default_rng(5)
+        pad = functools.partial(numpy.pad, pad_width=(1, 1), mode="edge")
+        num_different = {True: 0, False: 0}
+        for trial in range(30):
+            top = numpy.add.outer(numpy.arange(8) * 3.0, numpy.arange(16) * 2.0) + 100 # 2 tiles of 8 x 8 cells
+            top[rng.random(top.shape) < 0.2] = nn
+            for per_tile in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if per_tile:
+                        top_cleaned, top_orig = pad(top), pad(top)
+                    else:
+                        top_cleaned, top_orig = pad(clean_up_diags(fillHoles(top, 1, 8, True))), pad(clean_up_diags(top))
+                    left, right = seam_elevations([(top_cleaned[:, 0:10], top_orig[:, 0:10]), 
+                                                   (top_cleaned[:, 8:18], top_orig[:, 8:18])], 8.0)
+                num_different[per_tile] += any(left[y] != right[y] for y in set(left) & set(right))
+        self.assertEqual(num_different[False], 0)
+        self.assertGreater(num_different[True], 0)
+
+
+class CellObjectTests(unittest.TestCase):
+    '''micro-benchmark for the memory used by the vertex, quad and cell objects of create_cells()'''
+
+    def make_cell(self, i):
+        '''same objects create_cells() makes for a fringe cell with N and W walls'''
+        E, W, N, S = i * 1.0, i + 1.0, 5.0, 4.0
+        NEt, NWt, SEt, SWt = vertex(E, N, 3.0), vertex(W, N, 3.5), vertex(E, S, 2.0), vertex(W, S, 2.5)
+        NEb, NWb, SEb, SWb = vertex(E, N, 0), vertex(W, N, 0), vertex(E, S, 0), vertex(W, S, 0)
+        borders = {"N": quad(NEb, NEt, NWt, NWb), "S": False, "E": False, "W": quad(SEt, NEt, NEb, SEb)}
+        return cell(quad(NEt, SEt, SWt, NWt), quad(NEb, NWb, SWb, SEb), borders)
+
+    def test_cell_memory(self):
+        vertex_index_dict = vertex.vertex_index_dict
+        vertex.vertex_index_dict = -1 # no obj indexing
+        try:
+            n = 10000
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            cells = [self.make_cell(i) for i in range(n)]
+            stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+            tracemalloc.stop()
+        finally:
+            vertex.vertex_index_dict = vertex_index_dict
+        bytes_per_cell = sum(s.size_diff for s in stats) / n
+        allocs_per_cell = sum(s.count_diff for s in stats) / n
+        self.assertLess(bytes_per_cell, 2000) # was ~2300 bytes and 50 allocations with __dict__ based objects
+        self.assertLess(allocs_per_cell, 40)
+        for o in (cells[0], cells[0].topquad, cells[0].topquad.vl[0]):
+            self.assertFalse(hasattr(o, "__dict__"))
+
+    def test_tri_cell(self):
+        c = self.make_cell(0)
+        self.assertTrue(c.check_for_tri_cell())
+        c.convert_to_tri_cell()
+        self.assertTrue(c.is_tri_cell)
+        self.assertEqual(c.borders["W"], False)
+        self.assertIsNone(c.topquad.vl[3])
+
+
+@unittest.skipIf(gdal is None, "needs GDAL")
+class SheepMtnTests(unittest.TestCase):
+    '''both engines on the SheepMtn DEM masked with its kml outline, which has lots of wall cells
+    (and tri-cells with smooth_borders)'''
+
+    @classmethod
+    def setUpClass(cls):
+        gdal.UseExceptions()
+        ds = gdal.Warp("/vsimem/sheepMtn_clipped.tif", "test/SheepMtn.tif", format="GTiff",
+                       warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'], cutlineDSName="test/sheepMtn_outline.kml",
+                       cropToCutline=True, dstNodata=-32768)
+        top = ds.GetRasterBand(1).ReadAsArray().astype(numpy.float64)
+        ds = None
+        gdal.Unlink("/vsimem/sheepMtn_clipped.tif")
+        top[top == -32768] = nn
+        cls.ny, cls.nx = top.shape
+        cls.rasters = prepare(top)
+
+    def tile_info(self, smooth_borders):
+        top = self.rasters[0]
+        return make_tile_info(smooth_borders=smooth_borders, scale=10000, z_scale=1.5, min_elev=numpy.nanmin(top),
+                              tile_width=self.nx, tile_height=self.ny)
+
+    def test_sheepMtn_kml_masked(self):
+        for smooth_borders in (False, True):
+            with self.subTest(smooth_borders=smooth_borders), contextlib.redirect_stdout(io.StringIO()):
+                tile_info = self.tile_info(smooth_borders)
+                legacy_normals, legacy_tris = STLb_to_array(mesh(*self.rasters, tile_info, False))
+                vec_normals, vec_tris = STLb_to_array(mesh(*self.rasters, tile_info, True))
+            self.assertEqual(vec_tris.shape, legacy_tris.shape)
+            numpy.testing.assert_allclose(vec_tris, legacy_tris, rtol=1e-6, atol=1e-5)
+            numpy.testing.assert_allclose(vec_normals, legacy_normals, rtol=1e-6, atol=1e-6)
+
+    @benchmark
+    def test_sheepMtn_kml_masked_benchmark(self):
+        for smooth_borders in (False, True):
+            times = []
+            for vectorized in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    t = time.time()
+                    mesh(*self.rasters, self.tile_info(smooth_borders), vectorized)
+                    times.append(time.time() - t)
+            self.assertLess(times[1], times[0])
+
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
@@ -0,0 +1,915 @@
+import unittest
+import unittest.mock
+'''Tests for utils.py
+These run without Earth Engine (and, except for BandRowsTests, without GDAL): the raster functions are compared to
+their previous versions (or to simple reference implementations) on small rasters, the caches and zip helpers work
+in temp folders.
+'''
+import os
+import io
+import time
+import warnings
+import re
+import functools
+import contextlib
+import tracemalloc
+import tempfile
+import threading
+import glob
+import struct
+import zipfile
+import numpy
+from PIL import Image
+from scipy import ndimage
+from touchterrain.common.utils import dilate_array, fillHoles, clean_up_diags, share_raster, attach_shared_raster
+from touchterrain.common.utils import memmap_raster, map_row_blocks, copy_raster, pad_raster, is_memmap, fill_holes_by_rows
+from touchterrain.common.utils import RasterStats, preprocess_raster, raise_raster
+from touchterrain.common.utils import BandPool, iterate_row_bands
+from touchterrain.common.utils import resample_rasters, BandRows, get_overview_bands, get_cached_overviews
+from touchterrain.common.utils import deflate_tile, write_deflated_to_zip, copy_zip_member, ZipWriter, DEMCache, DEMChunkCache
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# the benchmarks (run times compared to the previous versions) depend on the machine and its load, so they only run 
+# if TOUCHTERRAIN_BENCHMARKS is set, e.g. TOUCHTERRAIN_BENCHMARKS=1 python -m pytest test/test_utils.py
+benchmark = unittest.skipUnless(os.getenv("TOUCHTERRAIN_BENCHMARKS"), "set TOUCHTERRAIN_BENCHMARKS to run the benchmarks")
+
+nn = numpy.nan
+
+
+class DEMCacheTests(unittest.TestCase):
+    def test_key(self):
+        a = DEMCache.key({"DEM_name": "USGS/3DEP/10m", "scale": 10.0, "crs": "EPSG:32613"})
+        b = DEMCache.key({"crs": "EPSG:32613", "scale": 10.0, "DEM_name": "USGS/3DEP/10m"})
+        c = DEMCache.key({"crs": "EPSG:32613", "scale": 10.1, "DEM_name": "USGS/3DEP/10m"})
+        self.assertEqual(a, b) # order of the keys doesn't matter
+        self.assertNotEqual(a, c)
+
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMCache(os.path.join(tmp, "dem_cache"), 1000)
+            hits, misses = DEMCache.hits, DEMCache.misses
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", b"geotiff")
+            self.assertEqual(cache.get("a"), b"geotiff")
+            self.assertEqual((DEMCache.hits - hits, DEMCache.misses - misses), (1, 1))
+            cache.put("b", b"x" * 1001) # bigger than the whole cache
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual([f for f in os.listdir(cache.folder) if f.endswith(".tmp")], [])
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMCache(tmp, 250)
+            for i, key in enumerate("abc"):
+                cache.put(key, b"x" * 100)
+                os.utime(cache.file_name(key), (1000 + i, 1000 + i)) # a is the oldest
+                if key == "b":
+                    self.assertIsNotNone(cache.get("a")) # now b is the oldest
+            self.assertIsNotNone(cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("c"))
+
+    def test_evict_stale_tmp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMCache(tmp, 1000)
+            for name, age in (("old.tmp", 7200), ("new.tmp", 10)):
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"x" * 600)
+                os.utime(os.path.join(tmp, name), (time.time() - age, time.time() - age))
+            cache.put("a", b"x" * 600) # tmp files don't count against max_bytes
+            self.assertEqual(sorted(os.listdir(tmp)), ["a.tif", "new.tmp"])
+
+
+class DEMChunkCacheTests(unittest.TestCase):
+    n = 16 # chunk_cells
+
+    def fetch(self, chunk_col, chunk_row):
+        '''stand-in for the EE download: elevation of cell col, row is col + 1000 * row (+ 0.5 on odd chunks)'''
+        self.fetched.append((chunk_col, chunk_row))
+        rows, cols = numpy.mgrid[chunk_row * self.n:(chunk_row + 1) * self.n, chunk_col * self.n:(chunk_col + 1) * self.n]
+        return (cols + 1000.0 * rows + 0.5 * ((chunk_col + chunk_row) % 2)).astype(numpy.float32)
+
+    def expected(self, col, row, num_cols, num_rows):
+        rows, cols = numpy.mgrid[row:row + num_rows, col:col + num_cols]
+        return cols + 1000.0 * rows + 0.5 * ((cols // self.n + rows // self.n) % 2)
+
+    def test_overlapping_requests(self):
+        grid = {"DEM_name": "USGS/3DEP/10m", "crs": "EPSG:32613", "scale": 10.0}
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMChunkCache(tmp, 1 << 20, chunk_cells=self.n)
+            self.fetched = []
+            raster, stats = cache.get_raster(grid, -16, -5, 40, 30, self.fetch) # 3 x 3 chunks
+            numpy.testing.assert_array_equal(raster, self.expected(-16, -5, 40, 30))
+            self.assertEqual(len(self.fetched), 9)
+            self.assertEqual((stats["chunks"], stats["hits"], stats["bytes_saved"], stats["fetched"]), (9, 0, 0, 9))
+            self.assertGreater(stats["bytes_fetched"], 0)
+
+            # overlaps the first one: only the 3 chunks of its extra column are fetched
+            self.fetched = []
+            raster, stats = cache.get_raster(grid, 0, -5, 40, 30, self.fetch)
+            numpy.testing.assert_array_equal(raster, self.expected(0, -5, 40, 30))
+            self.assertEqual(sorted(self.fetched), [(2, -1), (2, 0), (2, 1)])
+            self.assertEqual((stats["chunks"], stats["hits"], stats["fetched"]), (9, 6, 3))
+            self.assertGreater(stats["bytes_saved"], 0)
+
+            # other cell size => other grid
+            self.fetched = []
+            cache.get_raster(dict(grid, scale=20.0), 0, 0, 10, 10, self.fetch)
+            self.assertEqual(self.fetched, [(0, 0)])
+
+    def test_concurrent_fetch(self):
+        '''the missing chunks are fetched by up to max_workers threads at the same time, into the right places'''
+        grid = {"DEM_name": "USGS/3DEP/10m", "crs": "EPSG:32613", "scale": 10.0}
+        lock = threading.Lock()
+        running = [0, 0] # now, max.
+        def fetch(chunk_col, chunk_row):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05) # waiting for the download
+            with lock:
+                self.fetched.append((chunk_col, chunk_row))
+                running[0] -= 1
+            rows, cols = numpy.mgrid[chunk_row * self.n:(chunk_row + 1) * self.n, chunk_col * self.n:(chunk_col + 1) * self.n]
+            return (cols + 1000.0 * rows + 0.5 * ((chunk_col + chunk_row) % 2)).astype(numpy.float32)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMChunkCache(tmp, 1 << 20, chunk_cells=self.n)
+            self.fetched = []
+            raster, stats = cache.get_raster(grid, -16, -5, 60, 45, fetch, max_workers=3) # 4 x 4 chunks
+            numpy.testing.assert_array_equal(raster, self.expected(-16, -5, 60, 45))
+            self.assertEqual(len(self.fetched), 16)
+            self.assertEqual(stats["fetched"], 16)
+            self.assertGreater(running[1], 1)
+            self.assertLessEqual(running[1], 3)
+            self.assertGreater(stats["fetch_seconds"], 0)
+            self.assertEqual(len(glob.glob(os.path.join(tmp, "*.npz"))), 16)
+
+    def test_nodata_chunk(self):
+        '''cells without data (e.g. the ocean off a land-only DEM) are NaN in the chunk, in the cache and in the raster'''
+        grid = {"DEM_name": "USGS/3DEP/10m", "crs": "EPSG:32613", "scale": 10.0}
+        def fetch(chunk_col, chunk_row):
+            chunk = numpy.round(self.fetch(chunk_col, chunk_row)) # ints, i.e. int16 without the NaNs
+            if (chunk_col, chunk_row) == (1, 0):
+                chunk[:, 4:] = nn
+            return chunk
+        expected = numpy.round(self.expected(0, 0, 32, 16)).astype(numpy.float32)
+        expected[:, 20:] = nn
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DEMChunkCache(tmp, 1 << 20, chunk_cells=self.n)
+            for cached in (False, True):
+                with self.subTest(cached=cached):
+                    self.fetched = []
+                    raster, stats = cache.get_raster(grid, 0, 0, 32, 16, fetch)
+                    numpy.testing.assert_array_equal(raster, expected)
+                    self.assertEqual(stats["hits"], 2 if cached else 0)
+
+    def test_to_bytes(self):
+        ints = numpy.arange(-300, 300, dtype=numpy.float32).reshape(20, 30)
+        floats = ints + 0.25
+        with_nan = ints.copy()
+        with_nan[5:9, 3:7] = nn
+        for chunk, dtype in ((ints, numpy.int16), (floats, numpy.float32), (ints * 1000, numpy.float32), (with_nan, numpy.float32)):
+            with self.subTest(dtype=dtype):
+                restored = DEMChunkCache.from_bytes(DEMChunkCache.to_bytes(chunk))
+                self.assertEqual(restored.dtype, dtype)
+                numpy.testing.assert_array_equal(restored, chunk)
+
+    def test_separate_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            hits = DEMCache.hits
+            DEMChunkCache(tmp, 1000).put("a", b"npz")
+            DEMChunkCache(tmp, 1000).get("a")
+            self.assertEqual(DEMCache.hits, hits)
+            self.assertTrue(DEMChunkCache(tmp, 1000).stats().startswith("DEM chunk cache hits:"))
+
+
+def raw_member_data(zip_name, name):
+    '''the compressed data of the member name, as it is in the file zip_name'''
+    with zipfile.ZipFile(zip_name) as zf:
+        info = zf.getinfo(name)
+    with open(zip_name, "rb") as f:
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        return f.read(info.compress_size)
+
+
+class ZipWriterTests(unittest.TestCase):
+    '''ZipWriter writes the zip file of get_zipped_tiles(), which ZipFile (and unzip tools) must be able to read'''
+
+    def write_members(self, zf, tmp):
+        '''writes the members of expected() into the (open) ZipWriter zf'''
+        zf.writestr("stored.txt", "stored as usual")
+        zf.writestr("deflated.txt", "deflated " * 100, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("Höhenmodell_tile_1_1.STL", bytearray(b"utf-8 name")) # flag bit 11
+        fname = os.path.join(tmp, "dem.tif")
+        with open(fname, "wb") as f:
+            f.write(b"geotiff" * 1000)
+        zf.write(fname, "dem.tif", compress_type=zipfile.ZIP_DEFLATED)
+        zinfo = zipfile.ZipInfo("streamed.STL", date_time=(2024, 5, 17, 13, 45, 58))
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        text = io.TextIOWrapper(zf.open(zinfo, "w", force_zip64=True), encoding="utf-8", newline="") # as grid does for obj
+        for i in range(1000):
+            text.write(f"v {i} {i} {i}\n")
+        text.close() # closes the member's stream
+        self.assertEqual(zinfo.file_size, len(self.expected()["streamed.STL"])) # set when the stream is closed
+        write_deflated_to_zip(zf, "deflated.STL", *deflate_tile(buf=b"facet " * 1000))
+        with zf.open("empty", "w") as zip_stream:
+            pass
+
+    def expected(self):
+        return {"stored.txt": b"stored as usual", "deflated.txt": b"deflated " * 100,
+                "Höhenmodell_tile_1_1.STL": b"utf-8 name", "dem.tif": b"geotiff" * 1000,
+                "streamed.STL": "".join(f"v {i} {i} {i}\n" for i in range(1000)).encode(),
+                "deflated.STL": b"facet " * 1000, "empty": b""}
+
+    def check(self, zip_name):
+        with zipfile.ZipFile(zip_name) as zf:
+            self.assertIsNone(zf.testzip()) # checks the CRCs
+            self.assertEqual({name: zf.read(name) for name in zf.namelist()}, self.expected())
+            self.assertEqual(zf.namelist(), list(self.expected()))
+            self.assertEqual(zf.getinfo("dem.tif").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zf.getinfo("stored.txt").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo("streamed.STL").date_time, (2024, 5, 17, 13, 45, 58))
+            self.assertEqual(zf.getinfo("stored.txt").external_attr, 0o600 << 16)
+            self.assertEqual(zf.getinfo("dem.tif").external_attr >> 16, os.stat(os.path.join(os.path.dirname(zip_name), "dem.tif")).st_mode)
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            zip_name = os.path.join(tmp, "tiles.zip")
+            with ZipWriter(zip_name) as zf:
+                self.write_members(zf, tmp)
+            self.check(zip_name)
+
+    def test_zip64(self):
+        '''ZIP64 extra fields and end of central directory record, for sizes and offsets beyond ZIP64_LIMIT
+        (lowered here, so no GB files are needed)'''
+        with tempfile.TemporaryDirectory() as tmp, unittest.mock.patch("touchterrain.common.utils.ZIP64_LIMIT", 100):
+            zip_name = os.path.join(tmp, "tiles.zip")
+            with ZipWriter(zip_name) as zf:
+                self.write_members(zf, tmp)
+                with self.assertRaises(RuntimeError): # size not known up front and no force_zip64
+                    with zf.open("too_big", "w") as zip_stream:
+                        zip_stream.write(b"x" * 200)
+                zf.members = [m for m in zf.members if m.filename != "too_big"]
+            with open(zip_name, "rb") as f:
+                self.assertIn(b"PK\x06\x06", f.read()) # ZIP64 end of central directory record
+            self.check(zip_name)
+
+    def test_many_members(self):
+        '''more than 65535 members need the ZIP64 end of central directory record'''
+        with tempfile.TemporaryDirectory() as tmp:
+            zip_name = os.path.join(tmp, "tiles.zip")
+            with ZipWriter(zip_name) as zf:
+                for i in range(70000):
+                    zinfo = zipfile.ZipInfo(f"{i}")
+                    zinfo.CRC = 0
+                    zf.write_raw(zinfo, b"")
+            with zipfile.ZipFile(zip_name) as zf:
+                self.assertEqual(len(zf.namelist()), 70000)
+                self.assertEqual(zf.namelist()[-1], "69999")
+
+    def test_one_write_handle(self):
+        with tempfile.TemporaryDirectory() as tmp, ZipWriter(os.path.join(tmp, "tiles.zip")) as zf:
+            with zf.open("a", "w") as zip_stream:
+                with self.assertRaises(ValueError):
+                    zf.writestr("b", "while a is written")
+                zip_stream.write(b"a")
+
+
+class DeflatedZipTests(unittest.TestCase):
+    '''with compress_zip, tiles are deflated by process_tile() (in the worker processes) and only copied into the zip file'''
+
+    def test_deflated_members(self):
+        stl = numpy.arange(30000, dtype=numpy.float32).tobytes() # stand-ins for tile buffers
+        obj = "".join(f"v {i} {i % 7} {i % 13}\n" for i in range(3000))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "tile.tmp")
+            with open(fname, "wb") as f:
+                f.write(stl)
+            deflated_file, file_crc, file_size = deflate_tile(filename=fname, chunk_size=1000)
+            self.assertFalse(os.path.exists(fname)) # replaced by the .deflate file
+            deflated_stl, deflated_obj = deflate_tile(buf=bytearray(stl)), deflate_tile(buf=obj) # (str buffer)
+            zip_name = os.path.join(tmp, "tiles.zip")
+            with ZipWriter(zip_name) as zf, \
+                 unittest.mock.patch("zlib.compressobj", side_effect=AssertionError("compressed again")), \
+                 unittest.mock.patch("zlib.decompressobj", side_effect=AssertionError("decompressed")):
+                zf.writestr("first.txt", "stored as usual")
+                write_deflated_to_zip(zf, "tile_1_1.STL", *deflated_stl)
+                write_deflated_to_zip(zf, "tile_1_2.STL", deflated_file, file_crc, file_size, chunk_size=1000)
+                write_deflated_to_zip(zf, "tile_1_3.obj", *deflated_obj)
+                zf.writestr("last.txt", "stored as usual")
+            with zipfile.ZipFile(zip_name) as zf:
+                self.assertIsNone(zf.testzip()) # checks the CRCs
+                self.assertEqual(zf.namelist(), ["first.txt", "tile_1_1.STL", "tile_1_2.STL", "tile_1_3.obj", "last.txt"])
+                self.assertEqual(zf.read("tile_1_1.STL"), stl)
+                self.assertEqual(zf.read("tile_1_2.STL"), stl)
+                self.assertEqual(zf.read("tile_1_3.obj"), obj.encode())
+                self.assertEqual(zf.read("last.txt"), b"stored as usual")
+                info = zf.getinfo("tile_1_1.STL")
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                self.assertLess(info.compress_size, info.file_size)
+            self.assertEqual(raw_member_data(zip_name, "tile_1_1.STL"), deflated_stl[0])
+
+    def test_short_file(self):
+        deflated, crc, size = deflate_tile(buf=b"tile" * 100)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "tile.deflate")
+            with open(fname, "wb") as f:
+                f.write(deflated[:-1])
+            with ZipWriter(os.path.join(tmp, "tiles.zip")) as zf:
+                zinfo = zipfile.ZipInfo("tile")
+                zinfo.compress_type, zinfo.CRC, zinfo.file_size, zinfo.compress_size = zipfile.ZIP_DEFLATED, crc, size, len(deflated)
+                with open(fname, "rb") as f, self.assertRaises(EOFError):
+                    zf.write_raw(zinfo, f)
+
+
+class CopyZipMemberTests(unittest.TestCase):
+    '''the tiles that the tile workers stream (and compress) into their own part archives are copied into the zip file'''
+
+    def test_copy_part_archive(self):
+        expected = numpy.arange(30000, dtype=numpy.float32).tobytes() # stand-in for a tile buffer
+        with tempfile.TemporaryDirectory() as tmp:
+            for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED): # (made by the workers)
+                with zipfile.ZipFile(os.path.join(tmp, f"part_{compress_type}.zip"), "w", compress_type) as part:
+                    part.writestr("tile_1_1.STL", expected)
+            zip_name = os.path.join(tmp, "tiles.zip")
+            with ZipWriter(zip_name) as zf, \
+                 unittest.mock.patch("zlib.compressobj", side_effect=AssertionError("compressed again")), \
+                 unittest.mock.patch("zlib.decompressobj", side_effect=AssertionError("decompressed")):
+                zf.writestr("first.txt", "stored as usual")
+                for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+                    copy_zip_member(os.path.join(tmp, f"part_{compress_type}.zip"), "tile_1_1.STL", zf, 
+                                    f"tile_{compress_type}.STL", chunk_size=100)
+                zf.writestr("last.txt", "stored as usual")
+            with zipfile.ZipFile(zip_name) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.namelist(), ["first.txt", "tile_8.STL", "tile_0.STL", "last.txt"])
+                for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+                    self.assertEqual(zf.read(f"tile_{compress_type}.STL"), expected)
+                    self.assertEqual(zf.getinfo(f"tile_{compress_type}.STL").compress_type, compress_type)
+            for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED): # the same bytes as in the part archive
+                self.assertEqual(raw_member_data(zip_name, f"tile_{compress_type}.STL"),
+                                 raw_member_data(os.path.join(tmp, f"part_{compress_type}.zip"), "tile_1_1.STL"))
+
+
+def resampleDEM_PIL(a, factor):
+    '''the previous resampleDEM() (PIL bilinear resize, with NaN swapped to a bit less than the minimum)'''
+    newsh = (int(a.shape[0] / float(factor)), int(a.shape[1] / float(factor)))
+    nanmin = numpy.nanmin(a)
+    a = numpy.where(numpy.isnan(a), nanmin - 1, a)
+    a = numpy.asarray(Image.fromarray(a).resize(newsh[::-1], resample=Image.BILINEAR))
+    return numpy.where(a < nanmin, numpy.nan, a)
+
+
+class ResampleTests(unittest.TestCase):
+    '''resample_rasters() must average the (valid) source cells under the footprint of each resampled cell'''
+
+    def dense_weights(self, n, m):
+        '''(m, n) matrix of the covered part of each source cell, one footprint at a time'''
+        edges = numpy.arange(m + 1) * n / m
+        return numpy.array([[max(0, min(i + 1, edges[j + 1]) - max(i, edges[j])) for i in range(n)] for j in range(m)])
+
+    def test_resample_rasters(self):
+        rng = numpy.random.default_rng(4)
+        for trial in range(100):
+            ny, nx = rng.integers(1, 40, 2)
+            factor = (2, 3, 1.5, 2.7, 1.2, 1, 4.0000001, 10)[trial % 8]
+            top = rng.random((ny, nx)) * 1000
+            top[rng.random((ny, nx)) < rng.random() * 0.5] = nn
+            mask = rng.random((ny, nx)).astype(numpy.float32)
+            with self.subTest(trial=trial, factor=factor):
+                resampled = resample_rasters([top, mask], factor, rows_per_chunk=int(rng.integers(1, 8)))
+                self.assertEqual(resampled[0].shape, (max(int(ny / factor), 1), max(int(nx / factor), 1)))
+                self.assertEqual([r.dtype for r in resampled], [numpy.float64, numpy.float32])
+                weights_y, weights_x = self.dense_weights(ny, resampled[0].shape[0]), self.dense_weights(nx, resampled[0].shape[1])
+                valid = ~numpy.isnan(top)
+                sums = weights_y @ numpy.where(valid, top, 0) @ weights_x.T
+                areas = weights_y @ valid @ weights_x.T
+                full_area = weights_y.sum(axis=1)[:, None] * weights_x.sum(axis=1)[None, :]
+                with numpy.errstate(invalid="ignore"):
+                    expected = numpy.where(areas >= full_area / 2 - 1e-9, sums / areas, nn)
+                numpy.testing.assert_allclose(resampled[0], expected, rtol=1e-12)
+                numpy.testing.assert_allclose(resampled[1], weights_y @ mask @ weights_x.T / full_area, rtol=1e-5)
+
+        # integer factors average blocks, a footprint that's half NaN is still valid, 3/4 NaN is not
+        top = numpy.arange(16.0).reshape(4, 4)
+        top[0:2, 0] = top[0, 1] = top[2:4, 2] = nn
+        numpy.testing.assert_array_equal(resample_rasters([top], 2)[0], [[nn, 4.5], [10.5, 13.0]])
+
+    def test_upsample(self):
+        '''up-sampling (factor < 1) interpolates bilinearly, like the previous PIL resize, instead of averaging'''
+        # a linear ramp stays a linear ramp (apart from the cells beyond the outer source cell centers)
+        ramp = numpy.add.outer(numpy.arange(6) * 10.0, numpy.arange(4) * 3.0)
+        up = resample_rasters([ramp], 0.5)[0]
+        self.assertEqual(up.shape, (12, 8))
+        numpy.testing.assert_allclose(numpy.diff(up[1:-1, 1:-1], axis=0), 5.0)
+        numpy.testing.assert_allclose(numpy.diff(up[1:-1, 1:-1], axis=1), 1.5)
+        numpy.testing.assert_array_equal(resample_rasters([numpy.array([[0, 10, 20, 30.0]])], 0.5)[0][0], 
+                                         [0, 2.5, 7.5, 12.5, 17.5, 22.5, 27.5, 30])
+
+        rng = numpy.random.default_rng(6)
+        for trial in range(20):
+            ny, nx = rng.integers(2, 30, 2)
+            factor = (0.5, 0.7, 0.25, 0.33)[trial % 4]
+            top = rng.random((ny, nx)) * 1000
+            with self.subTest(trial=trial, factor=factor):
+                up = resample_rasters([top], factor, rows_per_chunk=int(rng.integers(1, 8)))[0]
+                pil = Image.fromarray(top).resize(up.shape[::-1], resample=Image.BILINEAR)
+                numpy.testing.assert_allclose(up, numpy.asarray(pil), rtol=1e-5) # (PIL uses float32)
+
+                # NaN cells are left out of the interpolation, cells mostly interpolated from NaNs are NaN
+                holes = rng.random((ny, nx)) < 0.3
+                top[holes] = nn
+                up = resample_rasters([top], factor)[0]
+                valid = resample_rasters([(~holes).astype(numpy.float64)], factor)[0]
+                with numpy.errstate(invalid="ignore"):
+                    expected = resample_rasters([numpy.where(holes, 0, top)], factor)[0] / valid
+                numpy.testing.assert_allclose(up, numpy.where(valid >= 0.5 - 1e-9, expected, nn))
+
+    @benchmark
+    def test_resample_benchmark(self):
+        top = numpy.random.default_rng(5).random((3000, 3000)) * 1000
+        top[:500, :500] = nn
+        for factor in (2, 2.5):
+            t = time.time()
+            old = resampleDEM_PIL(top, factor)
+            t_old = time.time() - t
+            t = time.time()
+            new = resample_rasters([top], factor)[0]
+            t_new = time.time() - t
+            self.assertEqual(new.shape, old.shape)
+            self.assertLess(t_new, t_old)
+
+
+@unittest.skipIf(gdal is None, "needs GDAL")
+class BandRowsTests(unittest.TestCase):
+    '''reading aligned rasters in windows of rows while re-sampling must give the same result as re-sampling them
+    after reading them fully'''
+
+    def make_tif(self, name, ras, undef_val=None, overviews=()):
+        gdal.UseExceptions()
+        ds = gdal.GetDriverByName("GTiff").Create(name, ras.shape[1], ras.shape[0], 1, gdal.GDT_Float32)
+        band = ds.GetRasterBand(1)
+        if undef_val is not None:
+            band.SetNoDataValue(undef_val)
+        band.WriteArray(ras)
+        if overviews:
+            ds.BuildOverviews("AVERAGE", list(overviews))
+        if name.startswith("/vsimem/"):
+            self.addCleanup(gdal.Unlink, name)
+        return ds
+
+    def test_read_resampled(self):
+        rng = numpy.random.default_rng(6)
+        top = (rng.random((301, 203)) * 1000).astype(numpy.float32)
+        top[rng.random(top.shape) < 0.1] = -9999
+        thickness = (rng.random(top.shape) * 10).astype(numpy.float32)
+        top_ds, thickness_ds = self.make_tif("/vsimem/top.tif", top, -9999), self.make_tif("/vsimem/thickness.tif", thickness)
+        top_band, thickness_band = top_ds.GetRasterBand(1), thickness_ds.GetRasterBand(1)
+
+        full_top = numpy.where(top == -9999, nn, top.astype(numpy.float64))
+        bottom = full_top - thickness
+        full_top[full_top <= 100] = nn # ignore_leq
+        for factor in (2, 3.3):
+            with self.subTest(factor=factor):
+                rows = [BandRows(top_band, -9999, ignore_leq=100), BandRows(top_band, -9999, minus=(thickness_band, None))]
+                self.assertEqual(rows[0].shape, top.shape)
+                for resampled, expected in zip(resample_rasters(rows, factor, rows_per_chunk=16), 
+                                               resample_rasters([full_top, bottom], factor)):
+                    numpy.testing.assert_array_equal(resampled, expected)
+
+    def test_get_overview_bands(self):
+        top = numpy.arange(64 * 48, dtype=numpy.float32).reshape(64, 48)
+        top_band = self.make_tif("/vsimem/top_ov.tif", top, overviews=(2, 4)).GetRasterBand(1)
+        bottom_band = self.make_tif("/vsimem/bottom_ov.tif", top - 10, overviews=(2,)).GetRasterBand(1)
+        self.assertEqual([(b.YSize, b.XSize) for b in get_overview_bands([top_band], (15, 12))], [(16, 12)])
+        self.assertEqual([(b.YSize, b.XSize) for b in get_overview_bands([top_band, bottom_band], (15, 12))], [(32, 24)] * 2)
+        self.assertIs(get_overview_bands([top_band], (40, 30))[0], top_band) # no overview with enough cells
+
+    def test_get_cached_overviews(self):
+        with tempfile.TemporaryDirectory() as folder:
+            tif_name, cache_folder = os.path.join(folder, "dem.tif"), os.path.join(folder, "cache")
+            top = numpy.arange(600 * 520, dtype=numpy.float32).reshape(600, 520)
+            ds = self.make_tif(tif_name, top, -9999)
+            ds = None # close
+            vrt_name, hit = get_cached_overviews(tif_name, cache_folder, min_size=100)
+            self.assertFalse(hit)
+            self.assertEqual(get_cached_overviews(tif_name, cache_folder, min_size=100), (vrt_name, True))
+            ds = gdal.Open(vrt_name)
+            band = ds.GetRasterBand(1)
+            self.assertEqual([(band.GetOverview(i).YSize, band.GetOverview(i).XSize) for i in range(band.GetOverviewCount())],
+                             [(300, 260), (150, 130)]) # down to >= 100 cells
+            numpy.testing.assert_array_equal(band.ReadAsArray(), top)
+            self.assertEqual(band.GetNoDataValue(), -9999)
+            ds = None
+
+            # a changed file gets new overviews, the outdated ones are removed
+            os.utime(tif_name, ns=(0, 0))
+            new_vrt_name, hit = get_cached_overviews(tif_name, cache_folder, min_size=100)
+            self.assertFalse(hit)
+            self.assertNotEqual(new_vrt_name, vrt_name)
+            self.assertEqual(sorted(os.listdir(cache_folder)), sorted([os.path.basename(new_vrt_name), os.path.basename(new_vrt_name) + ".ovr"]))
+
+
+class MemmapRasterTests(unittest.TestCase):
+    '''the preprocessing of memmap rasters (out-of-core, in blocks of rows) must give the same results as in memory'''
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def test_preprocessing(self):
+        rng = numpy.random.default_rng(7)
+        for trial in range(30):
+            ny, nx = rng.integers(1, 40, 2)
+            raster = rng.random((ny, nx)) * 100 - 10
+            raster[rng.random((ny, nx)) < 0.3] = nn
+            mapped = memmap_raster(raster, self.folder)
+            source = memmap_raster(raster * 2, self.folder)
+            with self.subTest(trial=trial), contextlib.redirect_stdout(io.StringIO()), \
+                 unittest.mock.patch("touchterrain.common.utils.map_row_blocks", 
+                                     functools.partial(map_row_blocks, rows_per_block=3)), \
+                 unittest.mock.patch("touchterrain.common.utils.fill_holes_by_rows", 
+                                     functools.partial(fill_holes_by_rows, rows_per_block=3)):
+                for args in [(50, 7, False), (2, 5, True), (-1, 8, True)]:
+                    filled = fillHoles(mapped, *args)
+                    self.assertTrue(is_memmap(filled))
+                    numpy.testing.assert_array_equal(filled, fillHoles(raster, *args))
+                numpy.testing.assert_array_equal(dilate_array(mapped), dilate_array(raster))
+                numpy.testing.assert_array_equal(dilate_array(mapped, source), dilate_array(raster, raster * 2))
+                numpy.testing.assert_array_equal(clean_up_diags(mapped), clean_up_diags(raster))
+                numpy.testing.assert_array_equal(pad_raster(mapped), numpy.pad(raster, (1, 1), 'edge'))
+                numpy.testing.assert_array_equal(copy_raster(mapped), raster)
+                lowered = map_row_blocks(lambda rows: numpy.where(rows > 5, rows + 1, rows), [copy_raster(mapped)], in_place=True)
+                numpy.testing.assert_array_equal(lowered, numpy.where(raster > 5, raster + 1, raster))
+            numpy.testing.assert_array_equal(mapped, raster) # unchanged
+
+    def test_shared_memmap_window(self):
+        '''a tile only maps the rows of its window'''
+        raster = numpy.arange(30 * 20, dtype=numpy.float64).reshape(30, 20)
+        shm, shared = share_raster(memmap_raster(raster, self.folder))
+        self.assertIsNone(shm)
+        window = (slice(11, 22), slice(5, 17))
+        shm, tile = attach_shared_raster(shared, window)
+        self.assertIsNone(shm)
+        numpy.testing.assert_array_equal(tile, raster[window])
+        self.assertEqual(tile.base.shape, (11, 20))
+        self.assertFalse(tile.flags.writeable)
+
+
+class PreprocessTests(unittest.TestCase):
+    '''the in-place preprocessing in one pass must give the same rasters as the previous chain of numpy.where() passes'''
+
+    def make_raster(self, rng, dtype=numpy.float64):
+        raster = (rng.random((37, 23)) * 40000 - 20000).round(-3).astype(dtype) # incl. some 0s
+        raster[rng.random(raster.shape) < 0.1] = -9999
+        raster[rng.random(raster.shape) < 0.1] = nn
+        return raster
+
+    def test_preprocess_raster(self):
+        rng = numpy.random.default_rng(5)
+        for dtype in (numpy.float64, numpy.float32):
+            for kwargs in [dict(undef_val=-9999), dict(nan_zeros=True, ignore_leq=-1000, max_abs_elev=16384), dict(max_abs_elev=16384),
+                           dict(), dict(undef_val=-9999, nan_zeros=True, ignore_leq=5000, max_abs_elev=16384)]:
+                raster = self.make_raster(rng, dtype)
+                expected = raster.copy()
+                if kwargs.get("undef_val") is not None:
+                    expected = numpy.where(numpy.isclose(expected, kwargs["undef_val"]), nn, expected)
+                if kwargs.get("nan_zeros") == True:
+                    expected = numpy.where(expected == 0.0, nn, expected)
+                if kwargs.get("ignore_leq") is not None:
+                    expected = numpy.where(expected <= kwargs["ignore_leq"], nn, expected)
+                num_nan = numpy.count_nonzero(numpy.isnan(expected))
+                if kwargs.get("max_abs_elev") is not None:
+                    expected = numpy.where(expected < -kwargs["max_abs_elev"], nn, expected)
+                    num_too_low = numpy.count_nonzero(numpy.isnan(expected)) - num_nan
+                    expected = numpy.where(expected > kwargs["max_abs_elev"], nn, expected)
+                num_nan_before = numpy.count_nonzero(numpy.isnan(raster))
+                with self.subTest(dtype=dtype, **kwargs):
+                    stats, counts = preprocess_raster(raster, cells_per_block=50, **kwargs) # in place
+                    numpy.testing.assert_array_equal(raster, expected)
+                    self.assertEqual(raster.dtype, dtype)
+                    self.assertEqual(stats.min, numpy.nanmin(expected))
+                    self.assertEqual(stats.max, numpy.nanmax(expected))
+                    self.assertEqual(stats.num_nan, numpy.count_nonzero(numpy.isnan(expected)))
+                    self.assertEqual(sum(counts.values()), stats.num_nan - num_nan_before) # cells set to NaN
+                    if kwargs.get("max_abs_elev") is not None:
+                        self.assertEqual(counts["too_low"], num_too_low)
+
+    def test_raise_raster(self):
+        rng = numpy.random.default_rng(6)
+        for trial in range(10):
+            raster = rng.random((29, 31)) * 100 - 20
+            raster[rng.random(raster.shape) < 0.1] = nn
+            masks = [(numpy.where(rng.random(raster.shape) < 0.5, 1.0, 0.0), o) for o in rng.random(2) * 40 - 10]
+            masks[0][0][rng.random(raster.shape) < 0.1] = nn
+            threshold, offset = (None, 0) if trial % 2 else (10.0, 3.5)
+            # previous version
+            expected = raster.copy()
+            if threshold is not None:
+                expected = numpy.where(expected > threshold, expected + offset, expected)
+            for mask, mask_offset in masks:
+                expected = numpy.add(expected, numpy.multiply(numpy.where(mask > 0, 0, 1), 1 * mask_offset))
+                expected = numpy.where(expected < 0, 0, expected)
+            with self.subTest(trial=trial):
+                stats = raise_raster(raster, threshold, offset, masks, cells_per_block=40)
+                numpy.testing.assert_array_equal(raster, expected)
+                self.assertEqual((stats.min, stats.max), (numpy.nanmin(expected), numpy.nanmax(expected)))
+
+    def test_raster_stats(self):
+        raster = numpy.array([[nn, 3.0, -2.0], [nn, nn, 7.5]])
+        stats = RasterStats(raster)
+        self.assertEqual((stats.min, stats.max, stats.num_nan), (-2.0, 7.5, 3))
+        self.assertIsNone(stats.ras) # gathered once, then cached
+        stats = RasterStats(numpy.full((3, 3), nn))
+        self.assertTrue(numpy.isnan(stats.min) and numpy.isnan(stats.max))
+
+    def test_preprocess_memory(self):
+        # peak memory stays close to the raster itself (numpy.where() chain: a full size temporary per pass)
+        raster = self.make_raster(numpy.random.default_rng(7)).repeat(40, axis=0).repeat(40, axis=1)
+        tracemalloc.start()
+        preprocess_raster(raster, undef_val=-9999, nan_zeros=True, ignore_leq=-1000, max_abs_elev=16384, cells_per_block=1 << 14)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, 0.2 * raster.nbytes)
+
+
+def fillHoles_generic_filter(raster, num_iters=-1, num_neighbors=7, NaN_are_holes=False):
+    '''the previous fillHoles() (a python callback via generic_filter on every cell), to compare against'''
+    if num_neighbors < 0 or num_neighbors > 9:
+        num_neighbors = 7
+    holesFilledLastRound = 1
+    while (holesFilledLastRound > 0) and (num_iters == -1 or num_iters > 0):
+        holesFilledLastRound = 0
+        if num_iters > 0:
+            num_iters -= 1
+
+        def checkForAndFillHole(values):
+            nonlocal holesFilledLastRound
+            if values[4] > 0 or (NaN_are_holes == True and ~numpy.isnan(values[4])):
+                return values[4]
+            if len(values[values > 0]) >= num_neighbors:
+                holesFilledLastRound += 1
+                return numpy.nanmean(values)
+            return values[4]
+
+        raster = ndimage.generic_filter(raster, checkForAndFillHole, footprint=numpy.ones((3, 3)), mode='nearest')
+        if NaN_are_holes == False:
+            for i, j in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
+                raster[i, j] = 0 if raster[i, j] < 0 else raster[i, j]
+    return raster
+
+
+def dilate_array_generic_filter(raster):
+    '''the previous dilate_array() without dilation source (3x3 nanmean of every cell via generic_filter)'''
+    mask = ~numpy.isnan(raster)
+    unequal_mask = numpy.not_equal(mask, ndimage.binary_dilation(mask))
+    def nanmean(data):
+        return numpy.nan if numpy.all(numpy.isnan(data)) else numpy.nanmean(data)
+    return numpy.where(unequal_mask, ndimage.generic_filter(raster, nanmean, size=(3, 3)), raster)
+
+
+def clean_up_diags_hit_or_miss(ras):
+    '''the previous clean_up_diags() (hit & miss on the full mask, each round), to compare against'''
+    if not numpy.any(numpy.isnan(ras)):
+        return ras
+    while True:
+        mask = numpy.invert(numpy.isnan(ras)).astype(numpy.int8)
+        pre = numpy.count_nonzero(mask)
+        if pre == 0:
+            return ras
+        p = numpy.array([[1, 0], [0, 1]])
+        mask = mask - ndimage.binary_hit_or_miss(mask, structure1=p, origin1=-1).astype(numpy.int8)
+        mask = numpy.flip(mask, axis=1)
+        mask = mask - ndimage.binary_hit_or_miss(mask, structure1=p, origin1=-1).astype(numpy.int8)
+        mask = numpy.flip(mask, axis=1)
+        post = numpy.count_nonzero(mask)
+        ras = ras * numpy.where(mask == 0, numpy.nan, 1)
+        if pre == post:
+            return ras
+
+
+class RasterFilterTests(unittest.TestCase):
+    '''the raster preprocessing in utils must give the same results as the previous (generic_filter) versions'''
+
+    def test_fillHoles(self):
+        rng = numpy.random.default_rng(0)
+        for trial in range(60):
+            ny, nx = rng.integers(1, 25, 2)
+            dtype = (numpy.float64, numpy.float32, numpy.int16)[trial % 3]
+            raster = (rng.random((ny, nx)) * 1000).astype(dtype)
+            holes = rng.random((ny, nx)) < rng.random() * 0.6
+            NaN_are_holes = trial % 2 == 1
+            if dtype != numpy.int16 and (NaN_are_holes or trial % 4 == 0):
+                raster[holes] = nn
+            else:
+                raster[holes] = -rng.integers(0, 100, numpy.count_nonzero(holes))
+            raster[rng.random((ny, nx)) < 0.05] = 0 # 0 is also a hole (unless NaN_are_holes)
+            for num_iters in (50, 2, 0): # (-1 may never end, e.g. for holes that get filled with 0)
+                for num_neighbors in (7, 8, 5, 0, 10):
+                    with self.subTest(trial=trial, num_iters=num_iters, num_neighbors=num_neighbors), \
+                         warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+                        warnings.simplefilter("ignore") # nanmean of all NaN
+                        expected = fillHoles_generic_filter(raster.copy(), num_iters, num_neighbors, NaN_are_holes)
+                        filled = fillHoles(raster, num_iters, num_neighbors, NaN_are_holes)
+                    self.assertEqual(filled.dtype, expected.dtype)
+                    numpy.testing.assert_array_equal(filled, expected) # bit-identical, NaN == NaN
+
+    def test_dilate_array(self):
+        rng = numpy.random.default_rng(2)
+        for trial in range(40):
+            ny, nx = rng.integers(1, 30, 2)
+            raster = (rng.random((ny, nx)) * 10.0 ** rng.integers(-2, 4)).astype((numpy.float64, numpy.float32)[trial % 2])
+            raster[rng.random((ny, nx)) < rng.random()] = nn
+            with self.subTest(trial=trial):
+                dilated = dilate_array(raster)
+                self.assertEqual(dilated.dtype, raster.dtype)
+                numpy.testing.assert_array_equal(dilated, dilate_array_generic_filter(raster))
+
+        # cost depends on the number of cells along the NaN border
+        raster = numpy.tile(numpy.arange(400.0), (400, 1))
+        raster[100:300, 100:300] = nn
+        numpy.testing.assert_array_equal(dilate_array(raster), dilate_array_generic_filter(raster))
+
+    @benchmark
+    def test_dilate_array_benchmark(self):
+        raster = numpy.tile(numpy.arange(400.0), (400, 1))
+        raster[100:300, 100:300] = nn # 200 x 200 NaN hole
+        times = []
+        for dilate in (dilate_array_generic_filter, dilate_array):
+            t = time.time()
+            dilate(raster)
+            times.append(time.time() - t)
+        self.assertLess(times[1], times[0])
+
+    def test_clean_up_diags(self):
+        rng = numpy.random.default_rng(3)
+        for trial in range(200):
+            ny, nx = rng.integers(1, 30, 2)
+            raster = (rng.random((ny, nx)) * 100).astype((numpy.float64, numpy.float32)[trial % 2])
+            raster[rng.random((ny, nx)) < rng.random()] = nn
+            with self.subTest(trial=trial), contextlib.redirect_stdout(io.StringIO()):
+                cleaned = clean_up_diags(raster)
+                expected = clean_up_diags_hit_or_miss(raster)
+            self.assertEqual(cleaned.dtype, raster.dtype) # float32 rasters stay float32 (see float32_rasters)
+            numpy.testing.assert_array_equal(cleaned, expected)
+
+        # later rounds only check the windows around the cells changed in the previous round
+        raster = numpy.ones((2000, 2000))
+        raster[rng.random(raster.shape) < 0.3] = nn
+        with contextlib.redirect_stdout(io.StringIO()):
+            numpy.testing.assert_array_equal(clean_up_diags(raster), clean_up_diags_hit_or_miss(raster))
+
+    @benchmark
+    def test_clean_up_diags_benchmark(self):
+        raster = numpy.ones((2000, 2000))
+        raster[numpy.random.default_rng(3).random(raster.shape) < 0.3] = nn
+        times = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for clean in (clean_up_diags_hit_or_miss, clean_up_diags):
+                t = time.time()
+                clean(raster)
+                times.append(time.time() - t)
+        self.assertLess(times[1], times[0])
+
+    def pyramid_with_holes(self):
+        '''pyramid.tif tiled 4 x 4 (404 x 404), with single holes and 1 x 4 holes that get filled over several rounds'''
+        pyramid = numpy.asarray(Image.open("stuff/pyramid.tif"), dtype=numpy.float64)
+        raster = numpy.tile(pyramid, (4, 4))
+        rng = numpy.random.default_rng(1)
+        raster[rng.random(raster.shape) < 0.01] = -1 # single holes
+        for y, x in rng.integers(0, raster.shape[0] - 4, (50, 2)):
+            raster[y, x:x + 4] = -1 # 1 x 4 holes, filled over several rounds (cascading)
+        return raster
+
+    def test_fillHoles_pyramid(self):
+        raster = self.pyramid_with_holes()
+        with contextlib.redirect_stdout(io.StringIO()):
+            numpy.testing.assert_array_equal(fillHoles(raster, -1, 7), fillHoles_generic_filter(raster, -1, 7))
+
+    @benchmark
+    def test_fillHoles_pyramid_benchmark(self):
+        raster = self.pyramid_with_holes()
+        times = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for fill in (fillHoles_generic_filter, fillHoles):
+                t = time.time()
+                fill(raster, -1, 7)
+                times.append(time.time() - t)
+        self.assertLess(times[1], times[0])
+
+
+class BandPoolTests(unittest.TestCase):
+    '''the preprocessing done in parallel on row bands (with halos) must give the same results (and log) as for the 
+    whole raster, incl. the operators repeated in rounds, where changes spread across the band borders'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.band_pool = BandPool(3, min_cells_per_band=50) # bands of a few rows, so most rounds cross band borders
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.band_pool.close()
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def make_raster(self, rng, ny, nx, dtype=numpy.float64):
+        raster = (rng.random((ny, nx)) * 100 + 1).astype(dtype)
+        raster[rng.random((ny, nx)) < rng.random() * 0.6] = nn
+        x = rng.integers(1, nx - 1)
+        raster[:, x - 1:x + 2] = rng.random((ny, 3)) * 100 + 1
+        raster[:-2, x] = -1 # a column of holes, filled from the bottom up, a row per round (7 neighbors)
+        return raster
+
+    def run_both(self, func, *args, **kwargs):
+        '''returns the results and logs of func without and with the band pool'''
+        results = []
+        for band_pool in (None, self.band_pool):
+            with contextlib.redirect_stdout(io.StringIO()) as log, warnings.catch_warnings():
+                warnings.simplefilter("ignore") # nanmean of all NaN
+                results.append((func(*args, band_pool=band_pool, **kwargs), log.getvalue()))
+        return results
+
+    def test_fillHoles(self):
+        rng = numpy.random.default_rng(8)
+        for trial in range(12):
+            raster = self.make_raster(rng, *rng.integers(20, 70, 2), (numpy.float64, numpy.float32)[trial % 2])
+            for num_iters, num_neighbors, NaN_are_holes in [(-1, 5, False), (30, 7, False), (3, 3, True), (1, 8, True)]:
+                with self.subTest(trial=trial, num_iters=num_iters, num_neighbors=num_neighbors, NaN_are_holes=NaN_are_holes):
+                    (expected, expected_log), (filled, log) = self.run_both(fillHoles, raster, num_iters, num_neighbors, NaN_are_holes)
+                    self.assertEqual(filled.dtype, expected.dtype)
+                    numpy.testing.assert_array_equal(filled, expected)
+                    self.assertEqual(log, expected_log) # same number of rounds and filled holes per round
+                    if num_iters == 30: # more rounds than in a batch of rounds on the bands
+                        self.assertGreater(log.count("Round"), 8)
+
+    def test_clean_up_diags(self):
+        rng = numpy.random.default_rng(9)
+        for trial in range(12):
+            raster = self.make_raster(rng, *rng.integers(20, 70, 2), (numpy.float64, numpy.float32)[trial % 2])
+            raster[rng.random(raster.shape) < 0.25] = nn # for a few rounds
+            for rounds_per_batch in (8, 1): # 1: stitched after each round
+                with self.subTest(trial=trial, rounds_per_batch=rounds_per_batch), \
+                     unittest.mock.patch("touchterrain.common.utils.iterate_row_bands", 
+                                         functools.partial(iterate_row_bands, rounds_per_batch=rounds_per_batch)):
+                    (expected, expected_log), (cleaned, log) = self.run_both(clean_up_diags, raster)
+                    self.assertEqual(cleaned.dtype, expected.dtype)
+                    numpy.testing.assert_array_equal(cleaned, expected)
+                    self.assertEqual(log, expected_log)
+                    self.assertGreater(int(re.search(r"(\d+) rounds", log).group(1)), 2)
+
+    def test_dilate_array(self):
+        rng = numpy.random.default_rng(10)
+        for trial in range(10):
+            raster = self.make_raster(rng, *rng.integers(20, 70, 2), (numpy.float64, numpy.float32)[trial % 2])
+            source = raster * 2 + 1
+            for args in [(raster,), (raster, source), (memmap_raster(raster, self.folder),)]:
+                with self.subTest(trial=trial, args=len(args)):
+                    (expected, _), (dilated, _) = self.run_both(dilate_array, *args)
+                    self.assertEqual(dilated.dtype, expected.dtype)
+                    numpy.testing.assert_array_equal(dilated, expected)
+                    self.assertEqual(is_memmap(dilated), is_memmap(args[0]))
+
+    def test_memmap(self):
+        rng = numpy.random.default_rng(11)
+        raster = self.make_raster(rng, 61, 23)
+        mapped = memmap_raster(raster, self.folder)[:-1, :-2] # cropped (not contiguous)
+        (expected, _), (filled, _) = self.run_both(fillHoles, mapped, -1, 5)
+        self.assertTrue(is_memmap(filled))
+        numpy.testing.assert_array_equal(filled, expected)
+        numpy.testing.assert_array_equal(filled, fillHoles_generic_filter(raster[:-1, :-2], -1, 5))
+        (expected, _), (cleaned, _) = self.run_both(clean_up_diags, mapped)
+        numpy.testing.assert_array_equal(cleaned, expected)
+        numpy.testing.assert_array_equal(mapped, raster[:-1, :-2]) # unchanged
+
+    def test_resample_rasters(self):
+        rng = numpy.random.default_rng(12)
+        for trial in range(8):
+            ny, nx = rng.integers(30, 90, 2)
+            rasters = [self.make_raster(rng, ny, nx, dtype) for dtype in (numpy.float64, numpy.float32)]
+            rasters[0][: ny // 2] = 5.0 # fully valid chunks take a shortcut
+            factor = rng.random() * 3 + 1 if trial % 4 else 0.6 # (and up-sampling)
+            with self.subTest(trial=trial, factor=factor):
+                (expected, _), (resampled, _) = self.run_both(resample_rasters, rasters, factor, rows_per_chunk=4)
+                for r, e in zip(resampled, expected):
+                    self.assertEqual(r.dtype, e.dtype)
+                    numpy.testing.assert_array_equal(r, e)
+
+    def test_small_raster(self):
+        '''rasters too small for 2 bands are processed as usual, without starting the processes'''
+        band_pool = BandPool(4, min_cells_per_band=1000)
+        raster = self.make_raster(numpy.random.default_rng(13), 30, 30)
+        with contextlib.redirect_stdout(io.StringIO()):
+            numpy.testing.assert_array_equal(fillHoles(raster, -1, 5, band_pool=band_pool), fillHoles(raster, -1, 5))
+        self.assertIsNone(band_pool.pool)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
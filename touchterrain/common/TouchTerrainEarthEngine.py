@@ -22,11 +22,12 @@ TouchTerrainEarthEngine  - creates 3D model tiles from DEM (via Google Earth Eng
 import sys
 import os
 import datetime
+import shutil
 from io import StringIO
 import urllib.request, urllib.error, urllib.parse
 import socket
 import io
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
 import http.client
 import numpy
 from touchterrain.common.config import EE_ACCOUNT,EE_CREDS,EE_PROJECT
@@ -41,7 +42,12 @@ if DEV_MODE:
 import touchterrain.common
 from touchterrain.common.grid_tesselate import grid      # my own grid class, creates a mesh from DEM raster
 from touchterrain.common.Coordinate_system_conv import * # arc to meters conversion
-from touchterrain.common.utils import save_tile_as_image, clean_up_diags, fillHoles, add_to_stl_list, k3d_render_to_html, dilate_array, plot_DEM_histogram
+from touchterrain.common.utils import save_tile_as_image, clean_up_diags, fillHoles, add_to_stl_list, k3d_render_to_html, dilate_array, plot_DEM_histogram, resample_rasters
+from touchterrain.common.utils import BandRows, get_overview_bands, get_cached_overviews
+from touchterrain.common.utils import share_raster, attach_shared_raster, deflate_tile, write_deflated_to_zip
+from touchterrain.common.utils import copy_zip_member, ZipWriter
+from touchterrain.common.utils import new_memmap_raster, memmap_raster, map_row_blocks, copy_raster, pad_raster
+from touchterrain.common.utils import RasterStats, preprocess_raster, raise_raster, BandPool, DEMCache, DEMChunkCache
 if DEV_MODE:
     sys.path = oldsp # back to old sys.path
 
@@ -160,6 +166,15 @@ initial_args = {
     "clean_diags":False, # clean of corner diagonal 1 x 1 islands?
     "bottom_elevation":None,
     "dirty_triangles:":False, # allow degenerate triangles for water
+    "vectorized_mesh": False, # make the mesh with numpy arrays instead of a python object per cell (faster)
+    "CPU_cores_per_tile": None, # with vectorized_mesh, mesh stripes of a tile in parallel. 0 means all cores, None => single core
+    "compress_zip": False, # compress the tiles in the zip file (deflate)
+    "overview_cache": None, # folder for overviews of local rasters, which are re-used by later runs. None => no overviews are made
+    "memmap_rasters": False, # keep the rasters in memory mapped scratch files in temp_folder (for rasters larger than memory)
+    "float32_rasters": False, # process the rasters as float32 instead of float64 (half the memory, vectorized_mesh only)
+    "DEM_cache": None, # folder for Earth Engine DEM GeoTIFFs, which are re-used by later identical requests. None => no caching
+    "DEM_cache_max_MB": 2000, # size limit of the DEM_cache (and DEM_chunk_cache) folder, the least recently used GeoTIFFs are deleted beyond it
+    "DEM_chunk_cache": None, # folder for chunks of Earth Engine DEMs, which are re-used by later overlapping requests. None => no chunks
 }
 
 
@@ -213,9 +228,11 @@ def make_bottom_raster_from_image(image_file_name, shape):
 # if multicore processing is used, this is called via multiprocessing.map()
 # tile_info["temp_file"] contains the file name to open and write into (creating a file object)
 # but if it's None, a buffer is made instead.
+# With a temp file and an open zip_file (ZipWriter or ZipFile), the tile is streamed into its member (tile_info["zip_member"])
+# instead, tile_info["zip_file"] is then the name of that zip file.
 # the tile info dict (with the file/buffer size) and the buffer (or the file's name) are returns as a tuple
 #@profile
-def process_tile(tile_tuple):
+def process_tile(tile_tuple, zip_file=None):
     tile_info = tile_tuple[0] # has info for this individual tile
     tile_elev_raster = tile_tuple[1] # the actual (top) raster
     tile_bottom_raster = tile_tuple[2] # the actual (bottom) raster (or None)
@@ -404,7 +421,10 @@ def process_tile(tile_tuple):
     fileformat = tile_info["fileformat"]
 
     # info on buffer/temp file
-    if tile_info.get("temp_file") != None:  # contains None or a file name.
+    if tile_info.get("temp_file") != None and zip_file is not None:
+        print("Writing tile into zip file", os.path.realpath(zip_file.filename), file=sys.stderr)
+        temp_fn = tile_info.get("temp_file") # only used for obj indices (or a non-vectorized STLb)
+    elif tile_info.get("temp_file") != None:  # contains None or a file name.
         print("Writing tile into temp. file", os.path.realpath(tile_info["temp_file"]), file=sys.stderr)
         temp_fn = tile_info.get("temp_file")
     else:
@@ -413,6 +433,20 @@ def process_tile(tile_tuple):
 
     # Create triangle "file" either in a buffer or in a tempfile, of requested fileformat
     # if file: open, write and close it, b will be temp file name
+    # With a zip file, stream the tile straight into its member in the zip file instead of a temp file
+    if temp_fn != None and zip_file is not None:
+        tile_info["temp_file"] = None
+        tile_info["zip_file"] = zip_file.filename
+        if g.is_empty(): # don't add a member for it, see below
+            return tile_info, None
+        zinfo = ZipInfo(tile_info["zip_member"], date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = ZIP_DEFLATED if tile_info.get("compress_zip") == True else ZIP_STORED
+        with zip_file.open(zinfo, "w", force_zip64=True) as zip_stream: # size is not known up front
+            g.make_file_buffer(zip_stream)
+        tile_info["file_size"] = zinfo.file_size / float(1024*1024)
+        print("tile", tile_info["tile_no_x"], tile_info["tile_no_y"], fileformat, tile_info["file_size"], "Mb ", file=sys.stderr)
+        return tile_info, zip_file.filename
+
     b = g.make_file_buffer()
 
     # When using top and bottom and multiple tiles it is possible that a water tile is empty
@@ -429,8 +463,53 @@ def process_tile(tile_tuple):
 
     tile_info["file_size"] = fsize
     print("tile", tile_info["tile_no_x"], tile_info["tile_no_y"], fileformat, fsize, "Mb ", file=sys.stderr) #, multiprocessing.current_process()
+
+    # compress here (i.e. in the worker process if multi-core) so that the main process only needs to copy
+    # the deflated data into the zip file (see write_deflated_to_zip())
+    if tile_info.get("compress_zip") == True:
+        b, crc, size = deflate_tile(buf=b if temp_fn == None else None, filename=temp_fn)
+        if temp_fn != None:
+            tile_info["temp_file"] = b # name of the .deflate file
+            csize = os.stat(b).st_size / float(1024*1024)
+        else:
+            csize = len(b) / float(1024*1024)
+        tile_info["deflated"] = (crc, size) # CRC-32 and size of the uncompressed data
+        print("tile", tile_info["tile_no_x"], tile_info["tile_no_y"], "compressed to", csize, "Mb ", file=sys.stderr)
+
     return tile_info, b # return info and buffer/temp_file NAME
 
+def process_shared_tile(tile_tuple):
+    '''process_tile() for multi-core processing: instead of arrays, the tile tuple has (shared, window) for
+    each raster (or None), i.e. the (name, shape, dtype) of a raster in a shared memory block (see share_raster())
+    and the window (rows, columns) of the tile within that raster. 
+    If the tile has a zip_member, it's written into a part archive (temp file + .zip) instead of a temp file'''
+    shared_blocks = []
+    rasters = []
+    part_zip = None
+    for r in tile_tuple[1:]:
+        if r is not None:
+            shm, r = attach_shared_raster(*r) # read-only view, grid will make a copy only if it needs to write
+            if shm is not None: # (None for memmap rasters)
+                shared_blocks.append(shm)
+        rasters.append(r)
+    tile_tuple = (tile_tuple[0], *rasters)
+    del rasters, r
+
+    try:
+        # stream the tile into its own part archive, which the main process then copies into the zip file
+        if tile_tuple[0].get("temp_file") != None and tile_tuple[0].get("zip_member") != None:
+            part_zip = ZipFile(tile_tuple[0]["temp_file"] + ".zip", "w", allowZip64=True)
+        return process_tile(tile_tuple, part_zip)
+    finally:
+        del tile_tuple
+        if part_zip is not None:
+            part_zip.close()
+        for shm in shared_blocks:
+            try:
+                shm.close()
+            except BufferError: # view still in use (e.g. by a traceback), will be released when the worker exits
+                pass
+
 
 """
 CH: converting to PIL, rotating it and back to numpy works but that changes the real-world cell size and
@@ -457,48 +536,6 @@ def rotateDEM(a, rot_degs):
     return a
 """
 
-def resampleDEM(a, factor):
-    ''' resample the DEM raster a by a factor
-    a: 2D numpy array
-    factor: down(!) sample factor, 2.0 will reduce the number of cells in x and y to 50%
-        Should(?) deal with undef/NaN ...
-    '''
-
-    # get new shape of raster
-    cursh = a.shape
-    newsh = ( int(int(cursh[0]) / float(factor)), int(cursh[1] / float(factor)) )
-
-    #print "resample1 min/max : %.2f to %.2f" % (numpy.nanmin(a), numpy.nanmax(a))
-    has_nan = False
-    if numpy.isnan(numpy.sum(a)):
-        has_nan = True
-        nanmin = numpy.nanmin(a)
-        a = numpy.where(numpy.isnan(a), nanmin-1, a) # swap NaN to a bit smaller than valid min, so the interpolation works
-        #print "resample2 min/max : %.2f to %.2f" % (numpy.nanmin(a), numpy.nanmax(a))
-
-    # Use PIL resize with bilinear interpolation to avoid aliasing artifacts
-    img = Image.fromarray(a)  # was using fromarray(a, 'F') but that affected the elevation value, which were much lower!
-    #print "pre-resam", img.size
-    #print "resamp 2.5 min/max", img.getextrema()
-    img  = img.resize(newsh[::-1], resample=Image.BILINEAR) # x and y are swapped in numpy
-    #print "post-resam", img.size
-    a = numpy.asarray(img)
-    #print "resample3 min/max : %.2f to %.2f" % (numpy.nanmin(a), numpy.nanmax(a))
-
-    if has_nan:  # swap NaN back in
-        a = numpy.where(a < nanmin, numpy.nan, a)
-        #print "resample4 min/max : %.2f to %.2f" % (numpy.nanmin(a), numpy.nanmax(a))
-
-    # fix CH Jan 2, 20: needs to be a copy, PIL locks it to read only!
-    # Thanks to ljverge for finding this!
-    a = numpy.copy(a)
-
-    # deleting the PIL image will also free up the read-only numpy array
-    # CHECK THIS
-    del img
-
-    return a
-
 def get_KML_poly_geometry(kml_doc):
     ''' Parses a kml document (string) via xml.dom.minidom
         finds the geometry of the first(!) polygon feature encountered otherwise returns None
@@ -572,6 +609,149 @@ def get_bounding_box(coords):
     bllon -= width/100
     return trlat, trlon, bllat, bllon
 
+def download_EE_geotiff(request, DEM_name):
+    ''' return the DEM geotiff (bytes) from the zip file at the EE download URL request'''
+    # Retry download zipfile from url until request was successfull
+    web_sock = None
+    while web_sock == None:
+        try:
+            web_sock = urllib.request.urlopen(request, timeout=20) # 20 sec timeout
+        except socket.timeout as e:
+            raise logger.error("Timeout error %r" % e)
+        except urllib.error.HTTPError as e:
+            logger.error('HTTPError = ' + str(e.code))
+            if e.code == 429:  # 429: quota reached
+                time.sleep(random.randint(1,10)) # wait for a couple of secs
+        except urllib.error.URLError as e:
+            logger.error('URLError = ' + str(e.reason))
+        except http.client.HTTPException as e:
+            logger.error('HTTPException')
+        except Exception:
+            import traceback
+            logger.error('generic exception: ' + traceback.format_exc())
+
+        # at any exception, wait for a couple of secs
+        if web_sock == None:
+            time.sleep(random.randint(1,10))
+
+    # read the zipped folder into memory
+    buf = web_sock.read()
+    web_sock.close()
+    GEEZippedGeotiff = io.BytesIO(buf)
+    GEEZippedGeotiff.flush() # not sure if this is needed ...
+    #print GEEZippedGeotiff
+
+    # pretend we've got a .zip folder (it's just in memory instead of on disk) and read the tif inside
+    zipdir = ZipFile(GEEZippedGeotiff)
+
+    # Debug: unzip both files into a folder so I can look at the geotiff and world file
+    #zipdir.extractall("DEM_from_GEE")
+
+    # get the entry for the tif file from the zip (there's usually also world file in the zip folder)
+    nl = zipdir.namelist()
+    tifl = [f for f in nl if f[-4:] == ".tif"]
+    assert tifl != [], "zip from ee didn't contain a tif: " +  str(nl)
+
+    # ETOPO will have bedrock and ice_surface tifs
+    if DEM_name == """NOAA/NGDC/ETOPO1""":
+        tif = [f for f in tifl if "ice_surface" in f][0]   # get the DEM tif that has the ice surface
+    else:
+        tif = tifl[0] # for non ETOPO, there's just one DEM tif in that list
+
+    # Debug: print out the data from the world file
+    #worldfile = zipdir.read(zipfile.namelist()[0]) # world file as textfile
+    #raster_info = [float(l) for l in worldfile.splitlines()]  # https://en.wikipedia.org/wiki/World_file
+
+    # geotiff as data string
+    str_data = zipdir.read(tif)
+    GEEZippedGeotiff.close()
+    return str_data
+
+def get_projected_bounds(crs_str, lonlat_coords, points_per_edge=16):
+    ''' return min x, min y, max x, max y of the lon/lat polygon lonlat_coords projected into crs_str (e.g. "EPSG:32613")
+        the edges are sampled as they are usually curved after the projection'''
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(4326)
+    dst = osr.SpatialReference()
+    dst.SetFromUserInput(crs_str)
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"): # GDAL 3 would otherwise expect lat/lon
+        src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    trans = osr.CoordinateTransformation(src, dst)
+    xy = []
+    for (lon0, lat0), (lon1, lat1) in zip(lonlat_coords, lonlat_coords[1:] + lonlat_coords[:1]):
+        for t in numpy.linspace(0, 1, points_per_edge, endpoint=False):
+            xy.append(trans.TransformPoint(lon0 + t * (lon1 - lon0), lat0 + t * (lat1 - lat0))[:2])
+    xy = numpy.array(xy)
+    return xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()
+
+def get_chunked_EE_geotiff(image, DEM_name, crs_str, cell_size_m, chunk_cache, lonlat_coords, tif_file_name, max_downloads=8):
+    ''' return the geotiff (bytes) of the EE image in crs_str, with cells of cell_size_m, that covers the lon/lat polygon
+        lonlat_coords. It's put together from the chunks of chunk_cache (a DEMChunkCache) for this DEM, crs and cell size,
+        only the missing chunks are downloaded from EE (and cached). So that requests with about the same cell size share 
+        their chunks, the chunks use a cell size snapped to a power of 2**(1/8) m (i.e. up to 4.5% off), the put together
+        raster is then resampled to cell_size_m. Cells without data (the nodata value of a chunk) are NaN, which is
+        also the nodata value of the geotiff. tif_file_name is used to write the geotiff.
+        Up to max_downloads chunks are downloaded at the same time'''
+    n = chunk_cache.chunk_cells
+    chunk_cell_size_m = 2 ** (round(numpy.log2(cell_size_m) * 8) / 8)
+
+    def get_EE_chunk(chunk_col, chunk_row):
+        chunk_request = {
+            'crs': crs_str,
+            'crs_transform': [chunk_cell_size_m, 0, chunk_col * n * chunk_cell_size_m, 
+                              0, -chunk_cell_size_m, -chunk_row * n * chunk_cell_size_m],
+            'dimensions': f"{n}x{n}",
+        }
+        chunk_file_name = f"/vsimem/{os.path.basename(tif_file_name)}_{chunk_col}_{chunk_row}.tif"
+        gdal.FileFromMemBuffer(chunk_file_name, download_EE_geotiff(image.getDownloadUrl(chunk_request), DEM_name))
+        chunk_tif = gdal.Open(chunk_file_name)
+        band = chunk_tif.GetRasterBand(1)
+        chunk = band.ReadAsArray().astype(numpy.float32)
+        nodata = band.GetNoDataValue()
+        if nodata != None: # cells without data become NaN (the mosaic's nodata value)
+            chunk[chunk == numpy.float32(nodata)] = numpy.nan
+        band = chunk_tif = None # closes it
+        gdal.Unlink(chunk_file_name)
+        return chunk
+
+    # cells of the chunk grid (the cell corners are multiples of the chunk cell size) that cover the polygon
+    min_x, min_y, max_x, max_y = get_projected_bounds(crs_str, lonlat_coords)
+    col, row = int(numpy.floor(min_x / chunk_cell_size_m)), int(numpy.floor(-max_y / chunk_cell_size_m))
+    num_cols = int(numpy.ceil(max_x / chunk_cell_size_m)) - col
+    num_rows = int(numpy.ceil(-min_y / chunk_cell_size_m)) - row
+
+    grid = {"DEM_name": DEM_name, "crs": crs_str, "scale": chunk_cell_size_m}
+    raster, stats = chunk_cache.get_raster(grid, col, row, num_cols, num_rows, get_EE_chunk, max_workers=max_downloads)
+    pr("DEM chunks:", stats["hits"], "of", stats["chunks"], "were cached, hit ratio",
+       f"{stats['hits'] / stats['chunks']:.0%},", stats["bytes_saved"] / 1048576.0, "Mb not downloaded (" + chunk_cache.stats() + ")")
+    if stats["fetched"] > 0:
+        pr("DEM chunks: downloaded", stats["fetched"], "chunks,", stats["bytes_fetched"] / 1048576.0, "Mb, in", 
+           f"{stats['fetch_seconds']:.1f}", "secs, with up to", max_downloads, "at the same time")
+
+    # resample to the requested cell size (same upper left corner, the extent changes by less than half a cell)
+    if chunk_cell_size_m != cell_size_m:
+        new_shape = (max(round(num_rows * chunk_cell_size_m / cell_size_m), 1), 
+                     max(round(num_cols * chunk_cell_size_m / cell_size_m), 1))
+        pr("DEM chunks: re-sampling from the chunks'", chunk_cell_size_m, "m cells", raster.shape[::-1], 
+           "to the requested", cell_size_m, "m cells", new_shape[::-1])
+        raster = resample_rasters([raster], None, new_shape=new_shape)[0]
+    num_rows, num_cols = raster.shape
+
+    # write it as geotiff, so it's used just like a geotiff downloaded from EE
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs_str)
+    tif = gdal.GetDriverByName("GTiff").Create(tif_file_name, num_cols, num_rows, 1, gdal.GDT_Float32, ["COMPRESS=DEFLATE"])
+    tif.SetGeoTransform((col * chunk_cell_size_m, cell_size_m, 0, -row * chunk_cell_size_m, 0, -cell_size_m))
+    tif.SetProjection(srs.ExportToWkt())
+    tif.GetRasterBand(1).SetNoDataValue(numpy.nan)
+    tif.GetRasterBand(1).WriteArray(raster)
+    tif = None # closes the file
+    with open(tif_file_name, "rb") as f:
+        str_data = f.read()
+    os.remove(tif_file_name)
+    return str_data
+
 
 
 def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=None, # all args are keywords, so I can use just **args in calls ...
@@ -610,6 +790,15 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
                          clean_diags=False,
                          dirty_triangles=False,
                          kd3_render=False,
+                         vectorized_mesh=False,
+                         CPU_cores_per_tile=None,
+                         compress_zip=False,
+                         overview_cache=None,
+                         memmap_rasters=False,
+                         float32_rasters=False,
+                         DEM_cache=None,
+                         DEM_cache_max_MB=2000,
+                         DEM_chunk_cache=None,
                          **otherargs):
     """
     args:
@@ -631,6 +820,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
                                             "GeoTiff" = DEM raster only, no 3D geometry
     - tile_centered: True-> all tiles are centered around 0/0, False, all tiles "fit together"
     - CPU_cores_to_use: 0 means use all available cores, set to 1 to force single processor use (needed for Paste) TODO: change to True/False
+      With several tiles, large rasters are also re-sampled, hole filled, dilated and diag cleaned on row bands in parallel
     - max_cells_for_memory_only: if total number of cells is bigger, use temp_file instead using memory only
     - temp_folder: the folder to put the temp files and the final zip file into
     - zip_file_name: name of zipfile containing the tiles (st/obj) and helper files
@@ -656,6 +846,16 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
     - tilewidth_scale: divdes m width of selection box by this to get tilewidth (supersedes tilewidth setting)
     - clean_diags: if True, repair diagonal patterns which cause non-manifold edges
     - k3d_render: if True will create a html file containing the model as a k3d object. 
+    - vectorized_mesh: if True, the triangles of each tile are made with numpy arrays (whole rows of cells at once) instead of a python object per cell. Much faster, same mesh.
+    - CPU_cores_per_tile: with vectorized_mesh, mesh horizontal stripes of each tile on this many processes (0 means all cores, None or 1: single core). Only used if the tiles are not already processed on multiple cores (see CPU_cores_to_use)
+    - compress_zip: if True, the tiles are compressed (deflate) in the zip file. The compression is done while processing the tile, i.e. in the worker processes with CPU_cores_to_use
+    - memmap_rasters: if True, the (mesh export) rasters are kept in memory mapped scratch files in temp_folder and are processed in blocks of rows, for rasters that don't fit into memory (several times)
+    - float32_rasters: if True (and with vectorized_mesh), the rasters are read and processed as float32 instead of float64, which halves their memory. Elevations differ by float32 rounding (far below what can be printed)
+    - overview_cache: None or folder in which overviews (2x, 4x, ... down-sampled versions) of down-sampled local rasters are made once and re-used by later runs, which only need to re-sample the closest overview
+    - DEM_cache: None or folder in which the GeoTIFFs downloaded from Earth Engine are stored, keyed by a hash of the request (DEM, region, crs, scale). A later identical request (e.g. with only a different zscale or basethick) uses the stored GeoTIFF without contacting Earth Engine. Can be shared by several processes
+    - DEM_cache_max_MB: size limit of DEM_cache (and of DEM_chunk_cache) in MB, beyond it the least recently used GeoTIFFs (chunks) are deleted
+    - DEM_chunk_cache: None or folder in which the Earth Engine DEMs are stored as chunks of a fixed grid (per DEM, projection and cell size).
+      A later request for an overlapping region only downloads the chunks it's missing. The chunks have a cell size snapped to a power of 2**(1/8) m, the DEM is resampled from them to the requested cell size. Not used with polygons
 
 
     returns the total size of the zip file in Mb
@@ -702,6 +902,14 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             assert False, temp_folder + "doesn't exists but could also not be created"
 
 
+    # for memmap_rasters: folder for the memory mapped scratch files of the rasters
+    scratch_folder = temp_folder + os.sep + zip_file_name + "_rasters"
+    if memmap_rasters == True:
+        os.makedirs(scratch_folder, exist_ok=True)
+
+    # rasters are read and processed as float64, or as float32 (half the memory) for float32_rasters
+    raster_dtype = numpy.float32 if float32_rasters == True and vectorized_mesh == True else numpy.float64
+
     # set up log file
     log_file_name = temp_folder + os.sep + zip_file_name + ".log"
     log_file_handler = logging.FileHandler(log_file_name, mode='w+')
@@ -723,6 +931,12 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
     # Nov 19, 2021: As multi processing is still broken, I'm setting CPU to 1 for now ...
     #CPU_cores_to_use = 1
 
+    # when the tiles are processed on multiple cores (see use_multi_core below), the preprocessing of large rasters
+    # (re-sampling, hole filling, dilation, diagonal cleanup) is also done in parallel, on row bands of the raster
+    band_pool = None
+    if not (num_tiles[0] * num_tiles[1] == 1 or CPU_cores_to_use == 1 or CPU_cores_to_use == None or only != None):
+        band_pool = BandPool(None if CPU_cores_to_use == 0 else CPU_cores_to_use) # processes are started when needed
+
     #
     # get polygon data, either from GeoJSON (or just it's coordinates as a list) or from kml URL or file
     #
@@ -951,45 +1165,6 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             # print3D_resolution  <= 0 means: get whatever GEEs default is.
             cell_size_m = 0
 
-        #
-        # Get a download URL for DEM from Earth Engine
-        #
-        if DEM_name in ("NRCan/CDEM", "AU/GA/AUSTRALIA_5M_DEM"):  # Image collection?
-            coll = ee.ImageCollection(DEM_name)
-            info = coll.getInfo()
-            elev = coll.select('elevation')
-            proj = elev.first().select(0).projection() # must use common projection(?)
-            image1 = elev.mosaic().setDefaultProjection(proj) # must mosaic collection into single image
-        else:
-            image1 = ee.Image(DEM_name)
-            info = image1.getInfo()
-
-
-        pr("Earth Engine raster:", info["id"])
-        try:#
-            pr(" " + info["properties"]["title"])
-        except Exception as e:
-            #print e
-            pass
-        try:
-            pr(" " + info["properties"]["link"])
-        except Exception as e:
-            #print e
-            pass
-
-        # https://developers.google.com/earth-engine/resample
-        # projections (as will be done in getDownload()) defaults to nearest neighbor, which introduces artifacts,
-        # so I set the resampling mode here to bilinear or bicubic
-        #image1 = image1.resample("bicubic") # only very small differences to bilinear
-        image1 = image1.resample("bilinear")
-
-
-        # if we got clip_poly_coords, clip the image, using -32768 as NoData value
-        if clip_poly_coords != None:
-            clip_polygon = ee.Geometry.Polygon([clip_poly_coords])
-            clip_feature = ee.Feature(clip_polygon)
-            image1 = image1.clip(clip_feature).unmask(-32768, False)
-
         # Make a geoJSON polygon to define the area to be printed
         reg_rect = ee.Geometry.Rectangle([[bllon, bllat], [trlon, trlat]]) # opposite corners
         if polygon == None:
@@ -1013,62 +1188,70 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         # force to use unprojected (lat/long) instead of UTM projection, can only work for Geotiff export
         if unprojected == True: del request_dict["crs"]
 
-        request = image1.getDownloadUrl(request_dict)
-        pr("URL for geotiff is: ", request)
+        # DEM cache: re-use the GeoTIFF of an identical earlier request (same DEM, region, crs and scale, e.g. when
+        # only zscale or basethick were changed) without any request to Earth Engine
+        # DEM chunk cache: re-use the chunks of earlier requests that overlap this one (same DEM, crs and cell size).
+        # Clipping polygons are not cached (i.e. the whole DEM is downloaded)
+        use_chunks = DEM_chunk_cache != None and clip_poly_coords == None and "crs" in request_dict and cell_size_m > 0
+        str_data = None
+        if DEM_cache != None:
+            dem_cache = DEMCache(DEM_cache, DEM_cache_max_MB * 1024 * 1024)
+            cache_key = DEMCache.key(dict(request_dict, DEM_name=DEM_name, clip_poly_coords=clip_poly_coords))
+            str_data = dem_cache.get(cache_key)
+            pr("DEM cache", "hit:" if str_data is not None else "miss:", cache_key, "(" + dem_cache.stats() + ")")
+
+        if str_data is None: # not cached, get it from Earth Engine
+            #
+            # Get a download URL for DEM from Earth Engine
+            #
+            if DEM_name in ("NRCan/CDEM", "AU/GA/AUSTRALIA_5M_DEM"):  # Image collection?
+                coll = ee.ImageCollection(DEM_name)
+                info = coll.getInfo()
+                elev = coll.select('elevation')
+                proj = elev.first().select(0).projection() # must use common projection(?)
+                image1 = elev.mosaic().setDefaultProjection(proj) # must mosaic collection into single image
+            else:
+                image1 = ee.Image(DEM_name)
+                info = image1.getInfo()
 
-        # Retry download zipfile from url until request was successfull
-        web_sock = None
-        while web_sock == None:
-            try:
-                web_sock = urllib.request.urlopen(request, timeout=20) # 20 sec timeout
-            except socket.timeout as e:
-                raise logger.error("Timeout error %r" % e)
-            except urllib.error.HTTPError as e:
-                logger.error('HTTPError = ' + str(e.code))
-                if e.code == 429:  # 429: quota reached
-                    time.sleep(random.randint(1,10)) # wait for a couple of secs
-            except urllib.error.URLError as e:
-                logger.error('URLError = ' + str(e.reason))
-            except http.client.HTTPException as e:
-                logger.error('HTTPException')
-            except Exception:
-                import traceback
-                logger.error('generic exception: ' + traceback.format_exc())
-
-            # at any exception, wait for a couple of secs
-            if web_sock == None:
-                time.sleep(random.randint(1,10))
-
-        # read the zipped folder into memory
-        buf = web_sock.read()
-        web_sock.close()
-        GEEZippedGeotiff = io.BytesIO(buf)
-        GEEZippedGeotiff.flush() # not sure if this is needed ...
-        #print GEEZippedGeotiff
-
-        # pretend we've got a .zip folder (it's just in memory instead of on disk) and read the tif inside
-        zipdir = ZipFile(GEEZippedGeotiff)
-
-        # Debug: unzip both files into a folder so I can look at the geotiff and world file
-        #zipdir.extractall("DEM_from_GEE")
-
-        # get the entry for the tif file from the zip (there's usually also world file in the zip folder)
-        nl = zipdir.namelist()
-        tifl = [f for f in nl if f[-4:] == ".tif"]
-        assert tifl != [], "zip from ee didn't contain a tif: " +  str(nl)
-
-        # ETOPO will have bedrock and ice_surface tifs
-        if DEM_name == """NOAA/NGDC/ETOPO1""":
-            tif = [f for f in tifl if "ice_surface" in f][0]   # get the DEM tif that has the ice surface
-        else:
-            tif = tifl[0] # for non ETOPO, there's just one DEM tif in that list
 
-        # Debug: print out the data from the world file
-        #worldfile = zipdir.read(zipfile.namelist()[0]) # world file as textfile
-        #raster_info = [float(l) for l in worldfile.splitlines()]  # https://en.wikipedia.org/wiki/World_file
+            pr("Earth Engine raster:", info["id"])
+            try:#
+                pr(" " + info["properties"]["title"])
+            except Exception as e:
+                #print e
+                pass
+            try:
+                pr(" " + info["properties"]["link"])
+            except Exception as e:
+                #print e
+                pass
+
+            # https://developers.google.com/earth-engine/resample
+            # projections (as will be done in getDownload()) defaults to nearest neighbor, which introduces artifacts,
+            # so I set the resampling mode here to bilinear or bicubic
+            #image1 = image1.resample("bicubic") # only very small differences to bilinear
+            image1 = image1.resample("bilinear")
+
+
+            # if we got clip_poly_coords, clip the image, using -32768 as NoData value
+            if clip_poly_coords != None:
+                clip_polygon = ee.Geometry.Polygon([clip_poly_coords])
+                clip_feature = ee.Feature(clip_polygon)
+                image1 = image1.clip(clip_feature).unmask(-32768, False)
+
+            if use_chunks: # put the DEM together from the chunks of the DEM chunk cache, only download the missing chunks
+                chunk_cache = DEMChunkCache(DEM_chunk_cache, DEM_cache_max_MB * 1024 * 1024)
+                str_data = get_chunked_EE_geotiff(image1, DEM_name, crs_str, cell_size_m, chunk_cache,
+                                                  [[bllon, bllat], [trlon, bllat], [trlon, trlat], [bllon, trlat]],
+                                                  temp_folder + os.sep + zip_file_name + "_chunks.tif")
+            else:
+                request = image1.getDownloadUrl(request_dict)
+                pr("URL for geotiff is: ", request)
+                str_data = download_EE_geotiff(request, DEM_name)
 
-        # geotiff as data string
-        str_data = zipdir.read(tif)
+            if DEM_cache != None:
+                dem_cache.put(cache_key, str_data)
 
         # write the GEE geotiff into the temp folder and add it to the zipped d/l folder later
         GEE_dem_filename =  temp_folder + os.sep + zip_file_name + "_dem.tif"
@@ -1102,13 +1285,13 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             if dem_undef_val != None:
                 logger.debug("undefined DEM value used by GEE geotiff: " + str(dem_undef_val))
 
-            # delete zip file and buffer from memory
-            GEEZippedGeotiff.close()
-            del zipdir, str_data
+            # delete geotiff buffer from memory
+            del str_data
 
             # although STL can only use 32-bit floats, we need to use 64 bit floats
-            # for calculations, otherwise we get non-manifold vertices!
-            npim = band.ReadAsArray().astype(numpy.float64)
+            # for calculations, otherwise we get non-manifold vertices! (Unless float32_rasters is used with vectorized_mesh,
+            # which calculates each corner only once)
+            npim = band.ReadAsArray().astype(raster_dtype)
             #npim = band.ReadAsArray().astype(numpy.longdouble)
             #print(npim, npim.shape, npim.dtype, numpy.nanmin(npim), numpy.nanmax(npim)) #DEBUG
 
@@ -1124,32 +1307,31 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             # For AU/GA/AUSTRALIA_5M_DEM, replace all exact 0 value with NaN
             # b/c there are spots on land that have no pixels, but these are encoded as 0 and
             # need to be marked as NaN otherwise they screw up the thickness of the base
-            if DEM_name == "AU/GA/AUSTRALIA_5M_DEM":
-                npim = numpy.where(npim == 0.0, numpy.nan, npim)
+            nan_zeros = DEM_name == "AU/GA/AUSTRALIA_5M_DEM"
 
             # Add GPX points to the model (thanks KohlhardtC!)
             if importedGPX != None and importedGPX != []:
+                if nan_zeros == True: # (before the GPX paths are added to the elevations)
+                    preprocess_raster(npim, nan_zeros=True)
+                    nan_zeros = False
                 from touchterrain.common.TouchTerrainGPX import addGPXToModel
                 addGPXToModel(pr, npim, dem, importedGPX,
                               gpxPathHeight, gpxPixelsBetweenPoints, gpxPathThickness,
                               trlat, trlon, bllat, bllon)
 
-            # clip values?
-            if ignore_leq != None:
-                npim = numpy.where(npim <= ignore_leq, numpy.nan, npim)
-                pr("ignoring elevations <= ", ignore_leq, " (were set to NaN)")
-
+            # clip values? (ignore_leq)
             # Polygon masked pixels will have been set to -32768, so turn
             # these into NaN. Huge values can also occur outside
             # polygon masking (e.g. offshore pixels in GTOPO or non US pixels in NED)
-            min_elevation = numpy.nanmin(npim) # independent from arg min_elev!
-            if min_elevation < -16384:
-                npim = numpy.where(npim <  -16384, numpy.nan, npim)
+            # All of this is done in place, in one pass over the raster, which also gets its min/max
+            npim_stats, num_nan = preprocess_raster(npim, nan_zeros=nan_zeros, ignore_leq=ignore_leq, max_abs_elev=16384)
+            if ignore_leq != None:
+                pr("ignoring elevations <= ", ignore_leq, " (were set to NaN)")
+            if num_nan["too_low"] > 0:
                 pr("omitting cells with elevation < -16384")
-            if numpy.nanmax(npim) > 16384:
-                npim = numpy.where(npim >  16384, numpy.nan, npim)
+            if num_nan["too_high"] > 0:
                 pr("omitting cells with elevation > 16384")
-            pr("full (untiled) raster (height,width) ", npim.shape, npim.dtype, "elev. min/max:", numpy.nanmin(npim), numpy.nanmax(npim))
+            pr("full (untiled) raster (height,width) ", npim.shape, npim.dtype, "elev. min/max:", npim_stats.min, npim_stats.max)
 
             #
             # based on the full raster's shape and given the model width, recalc the model height
@@ -1221,13 +1403,25 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         # Make numpy array from imported geotiff
         dem = gdal.Open(importedDEM)
         band = dem.GetRasterBand(1)
-        npim = band.ReadAsArray().astype(numpy.float64) # top elevation values
+        source_shape = (dem.RasterYSize, dem.RasterXSize)
+
+        # If the raster will be down-sampled anyway (and isn't changed at source resolution, as with GPX), don't read all
+        # its cells now. Instead, it (and its aligned rasters) will be read in windows of rows while re-sampling, see below
+        read_resampled = (printres > 0 and tilewidth_scale == None and (importedGPX == None or importedGPX == []) and 
+                          print3D_resolution_mm > (tilewidth * ntilesx) / float(source_shape[1]))
+        resample_bands = [] # (raster, band, undef value) to read while re-sampling: bottom or thickness, offset mask
+        bottom_is_thickness = False
+        if read_resampled == False:
+            npim = band.ReadAsArray().astype(raster_dtype) # top elevation values
 
         # Read in offset mask file (Anson's stuff ...)
         if offset_masks_lower is not None:
             offset_dem = gdal.Open(offset_masks_lower[0][0])
             offset_band = offset_dem.GetRasterBand(1)
-            offset_npim.append(offset_band.ReadAsArray().astype(numpy.float64))
+            if read_resampled == True:
+                resample_bands.append((offset_dem, offset_band, None)) # keep the raster open until it's read
+            else:
+                offset_npim.append(offset_band.ReadAsArray().astype(raster_dtype))
             del offset_band
             offset_dem = None
 
@@ -1239,7 +1433,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             logger.warning("Warning: raster cells are not square (" + str(pw) + "x" + str(ph) + ") , using" + str(pw))
         cell_size_m = pw
         pr("source raster upper left corner (x/y): ",tf[0], tf[3])
-        pr("source raster cells size", cell_size_m, "m ", npim.shape)
+        pr("source raster cells size", cell_size_m, "m ", source_shape)
         geo_transform = tf
 
         def get_GDAL_projection_and_datum(raster):
@@ -1267,9 +1461,8 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         # if we have a GDAL undefined value, set all cells with that value to NaN
         dem_undef_val = band.GetNoDataValue()
         pr("undefined DEM value:", dem_undef_val)
-        if dem_undef_val != None:  # None means the raster is not a geotiff, so no undef values
-            undef_cells = numpy.isclose(npim, dem_undef_val) # bool with cells that are close to the GDAL undef value
-            npim = numpy.where(undef_cells, numpy.nan, npim) # replace GDAL undef values with nan
+        if dem_undef_val != None and read_resampled == False:  # None means the raster is not a geotiff, so no undef values
+            preprocess_raster(npim, undef_val=dem_undef_val) # replace cells close to the GDAL undef value with nan (in place)
 
 
         # for a bottom raster or a thickness raster, check that it matches the top raster
@@ -1279,7 +1472,8 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             else:
                 ras = gdal.Open(top_thickness)
             ras_band = ras.GetRasterBand(1)
-            ras_npim = ras_band.ReadAsArray().astype(numpy.float64) # bottom elevation or thickness values as numpy array
+            if read_resampled == False:
+                ras_npim = ras_band.ReadAsArray().astype(raster_dtype) # bottom elevation or thickness values as numpy array
             ras_tf = ras.GetGeoTransform()
             ras_pw, ras_ph = abs(ras_tf[1]), abs(ras_tf[5]) # pixel width and height
             if ras_pw != pw or ras_ph != ph:
@@ -1300,12 +1494,17 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             # get undef value and write it into the numpy array
             ras_undef_val = ras_band.GetNoDataValue()
             pr("undefined bottom elevation or thickness value:", ras_undef_val)
-            if ras_undef_val != None:  # None means the raster is not a geotiff so we don't support undef values
-                undef_cells = numpy.isclose(ras_npim, ras_undef_val) # bool with cells that are close to the undef value
-                ras_npim = numpy.where(undef_cells, numpy.nan, ras_npim) # replace undef values with nan
+            if read_resampled == True:
+                resample_bands.insert(0, (ras, ras_band, ras_undef_val)) # keep the raster open until it's read
+            elif ras_undef_val != None:  # None means the raster is not a geotiff so we don't support undef values
+                preprocess_raster(ras_npim, undef_val=ras_undef_val) # replace cells close to the undef value with nan (in place)
 
             # get bottom elevation as numpy array or create it be subtracting thickness from top elevation
-            if bottom_elevation != None:
+            if read_resampled == True: # will be read while re-sampling (as top - thickness)
+                if bottom_elevation == None:
+                    bottom_is_thickness = True
+                    bottom_elevation = top_thickness
+            elif bottom_elevation != None:
                 bot_npim = ras_npim # numpy array to be used later
             else:
                 bot_npim = npim - ras_npim   # bottom = top - thickness
@@ -1348,9 +1547,10 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
                           gpxPathHeight, gpxPixelsBetweenPoints, gpxPathThickness,
                           trlat, trlon, bllat, bllon)
 
-        # clip values?
+        # clip values? (when reading while re-sampling, this is done on the rows read)
+        if read_resampled == False:
+            npim_stats, _ = preprocess_raster(npim, ignore_leq=ignore_leq) # (in place, also gets the raster's min/max)
         if ignore_leq != None:
-            npim = numpy.where(npim <= ignore_leq, numpy.nan, npim)
             pr("ignoring elevations <= ", ignore_leq, " (were set to NaN)")
 
 
@@ -1361,18 +1561,21 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
 
 
         # tile height
-        whratio = npim.shape[0] / float(npim.shape[1])
+        whratio = source_shape[0] / float(source_shape[1])
         tileheight = tilewidth  * whratio
         pr("tile_width:", tilewidth)
         pr("tile_height:", tileheight)
         print3D_width_per_tile = tilewidth
         print3D_height_per_tile = tileheight
         print3D_width_total_mm =  print3D_width_per_tile * num_tiles[0]
-        real_world_total_width_m = npim.shape[1] * cell_size_m
-        pr("source raster width", real_world_total_width_m, "m,", "cell size:", cell_size_m, "m, elev. min/max is", numpy.nanmin(npim), numpy.nanmax(npim), "m")
+        real_world_total_width_m = source_shape[1] * cell_size_m
+        if read_resampled == False:
+            pr("source raster width", real_world_total_width_m, "m,", "cell size:", cell_size_m, "m, elev. min/max is", npim_stats.min, npim_stats.max, "m")
+        else:
+            pr("source raster width", real_world_total_width_m, "m,", "cell size:", cell_size_m, "m")
 
         # What would be the 3D print resolution using the original/unresampled source resolution?
-        source_print3D_resolution =  (tilewidth*ntilesx) / float(npim.shape[1])
+        source_print3D_resolution =  (tilewidth*ntilesx) / float(source_shape[1])
         pr("source raster 3D print resolution would be", source_print3D_resolution, "mm")
 
         # Resample raster to get requested printres?
@@ -1387,17 +1590,64 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             if scale_factor < 1.0:
                 pr("Warning: will re-sample to a resolution finer than the original source raster. Consider instead a value for printres >", source_print3D_resolution)
 
-            # re-sample DEM (and bottom_elevation) using PIL
-            pr("re-sampling", filename, ":\n ", npim.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", numpy.nanmin(npim), "-", numpy.nanmax(npim), "m")
-            npim =  resampleDEM(npim, scale_factor)
-            if bottom_elevation != None:
-                pr("re-sampling", bottom_elevation, ":\n ", bot_npim.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", numpy.nanmin(bot_npim), "-", numpy.nanmax(bot_npim), "m")
-                bot_npim =  resampleDEM(bot_npim, scale_factor)
+            if read_resampled == True:
+                # read the (aligned) rasters in windows of rows (from overviews, if they have any at >= the re-sampled resolution)
+                # and re-sample them in one pass, so only the re-sampled rasters need to fit into memory
+                new_shape = (int(source_shape[0] / scale_factor), int(source_shape[1] / scale_factor))
+                bands = [band] + [b[1] for b in resample_bands]
+                if overview_cache != None: # use bands of the cached VRTs, which have overviews
+                    cached = [] # keep the VRTs open until they are read
+                    for ds in [dem] + [b[0] for b in resample_bands]:
+                        vrt_name, hit = get_cached_overviews(ds.GetDescription(), overview_cache)
+                        pr("overview cache", "hit:" if hit else "miss, made overviews:", ds.GetDescription(), "->", vrt_name)
+                        cached.append(gdal.Open(vrt_name))
+                    bands = [c.GetRasterBand(1) for c in cached]
+                bands = get_overview_bands(bands, new_shape)
+                pr("re-sampling", filename, "(and aligned rasters) while reading them:\n ", source_shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m")
+                if bands[0].XSize != source_shape[1]:
+                    pr(" reading from overviews of", bands[0].YSize, "x", bands[0].XSize, "cells")
+                undef_vals = [b[2] for b in resample_bands]
+                rasters = [BandRows(bands[0], dem_undef_val, ignore_leq=ignore_leq, dtype=raster_dtype)]
+                if bottom_elevation != None:
+                    if bottom_is_thickness == True: # bottom = top - thickness
+                        rasters.append(BandRows(bands[0], dem_undef_val, minus=(bands[1], undef_vals[0]), dtype=raster_dtype))
+                    else:
+                        rasters.append(BandRows(bands[1], undef_vals[0], dtype=raster_dtype))
+                    del bands[1], undef_vals[0]
+                for offset_band, undef_val in zip(bands[1:], undef_vals):
+                    rasters.append(BandRows(offset_band, undef_val, dtype=raster_dtype))
+                out = None
+                if memmap_rasters == True: # re-sample straight into the scratch files
+                    out = [new_memmap_raster(new_shape, raster_dtype, scratch_folder) for r in rasters]
+                resampled = resample_rasters(rasters, scale_factor, new_shape=new_shape, out=out)
+                del rasters, bands
+                resample_bands = cached = [] # close the rasters
+                npim = resampled.pop(0)
+                if bottom_elevation != None:
+                    bot_npim = resampled.pop(0)
+                offset_npim[:] = resampled
+                del resampled
 
-            # re-sample offset mask
-            for index, offset_layer in enumerate(offset_npim):
-                pr("re-sampling offset layer",index, ":\n ", offset_layer.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", numpy.nanmin(offset_layer), "-", numpy.nanmax(offset_layer), "m")
-                offset_npim[index] = resampleDEM(offset_layer, scale_factor)
+            else:
+                # re-sample DEM (and bottom_elevation and offset masks, which are aligned with it) in one pass
+                pr("re-sampling", filename, ":\n ", npim.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", npim_stats.min, "-", npim_stats.max, "m")
+                rasters = [npim]
+                if bottom_elevation != None:
+                    bot_stats = RasterStats(bot_npim)
+                    pr("re-sampling", bottom_elevation, ":\n ", bot_npim.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", bot_stats.min, "-", bot_stats.max, "m")
+                    rasters.append(bot_npim)
+                for index, offset_layer in enumerate(offset_npim):
+                    offset_stats = RasterStats(offset_layer)
+                    pr("re-sampling offset layer",index, ":\n ", offset_layer.shape[::-1], source_print3D_resolution, "mm ", cell_size_m, "m ", offset_stats.min, "-", offset_stats.max, "m")
+                    rasters.append(offset_layer)
+
+                resampled = resample_rasters(rasters, scale_factor, band_pool=band_pool)
+                del rasters
+                npim = resampled.pop(0)
+                if bottom_elevation != None:
+                    bot_npim = resampled.pop(0)
+                offset_npim[:] = resampled # re-sampled offset masks
+                del resampled
 
             #
             # based on the full raster's shape and given the model width, recalc the model height
@@ -1411,7 +1661,8 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             adjusted_print3D_resolution = print3D_width_total_mm / float(npim.shape[1])
 
             cell_size_m *= scale_factor
-            pr(" ",npim.shape[::-1], adjusted_print3D_resolution, "mm ", cell_size_m, "m ", numpy.nanmin(npim), "-", numpy.nanmax(npim), "m")
+            npim_stats = RasterStats(npim) # stats of the re-sampled raster
+            pr(" ",npim.shape[::-1], adjusted_print3D_resolution, "mm ", cell_size_m, "m ", npim_stats.min, "-", npim_stats.max, "m")
 
             if adjusted_print3D_resolution != print3D_resolution_mm:
                 pr("after resampling, requested print res was adjusted from", print3D_resolution_mm, "to", adjusted_print3D_resolution, "to ensure correct model dimensions")
@@ -1426,7 +1677,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
     total_size = 0 # size of stl/objs/geotiff file(s) in byes
     full_zip_file_name =  temp_folder + os.sep + zip_file_name + ".zip"
     #print >> sys.stderr, "zip is in", os.path.abspath(full_zip_file_name)
-    zip_file = ZipFile(full_zip_file_name, "w", allowZip64=True) # create empty zipfile
+    zip_file = ZipWriter(full_zip_file_name) # create empty zipfile (ZipWriter can also add already compressed tiles)
 
 
     #
@@ -1440,6 +1691,14 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         else:
             DEM_name = filename
 
+        # out-of-core: from here on, the rasters are memory mapped scratch files, which are processed in blocks of rows
+        if memmap_rasters == True:
+            npim_stats.gather() # (from the in-memory raster, before it's replaced)
+            npim = memmap_raster(npim, scratch_folder)
+            if bottom_elevation != None:
+                bot_npim = memmap_raster(bot_npim, scratch_folder)
+            offset_npim[:] = [memmap_raster(offset_layer, scratch_folder) for offset_layer in offset_npim]
+
         # Adjust raster to nice multiples of tiles. If needed, crop raster from right and bottom
         remx = npim.shape[1] % num_tiles[0]
         remy = npim.shape[0] % num_tiles[1]
@@ -1447,6 +1706,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             pr(f"Cropping for nice fit of {num_tiles[0]} (width) x {num_tiles[1]} (height) tiles, removing: {remx} columns, {remy} rows")
             old_shape = npim.shape
             npim = npim[0:npim.shape[0] - remy, 0:npim.shape[1] - remx]
+            npim_stats = RasterStats(npim)
             pr("cropped", old_shape[::-1], "to", npim.shape[::-1])
 
             if bottom_elevation != None:
@@ -1472,7 +1732,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
 
         # if scale X is negative, assume it means scale up to X mm high and calculate required z-scale for that height
         if zscale < 0:
-            unscaled_elev_range_m = numpy.nanmax(npim) - numpy.nanmin(npim) # range at 1 x scale
+            unscaled_elev_range_m = npim_stats.max - npim_stats.min # range at 1 x scale
             scaled_elev_range_m = unscaled_elev_range_m / print3D_scale_number # convert range from real m to model/map m
             pos_zscale = -zscale
             requested_elev_range_m = -zscale / 1000 # requested range as m (given as mm)
@@ -1480,6 +1740,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             pr("From requested model height of", pos_zscale, "mm, calculated a z-scale of", zscale)
 
         # lower cells less/equal a certain elevation?
+        threshold, lower_offset = None, 0
         if lower_leq is not None:
             assert len(lower_leq) == 2, \
                 f"lower_leq should have the format [threshold, offset]. Got {lower_leq}"
@@ -1487,14 +1748,14 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             #offset = (lower_leq[1] / 1000) / sf
 
             threshold = lower_leq[0]
-            offset = lower_leq[1] / 1000 * print3D_scale_number  # scale mm up to real world meters
-            offset /= zscale # => unaffected by zscale
+            lower_offset = lower_leq[1] / 1000 * print3D_scale_number  # scale mm up to real world meters
+            lower_offset /= zscale # => unaffected by zscale
 
             # Instead of lowering, shift elevations greater than the threshold up to avoid negatives
-            npim = numpy.where(npim > threshold, npim + offset, npim)
-            pr("Lowering elevations <= ", threshold, " by ", offset, "m, equiv. to", lower_leq[1],  "mm at map scale")
+            pr("Lowering elevations <= ", threshold, " by ", lower_offset, "m, equiv. to", lower_leq[1],  "mm at map scale")
 
         # offset (lower) cells highlighted in the offset_masks files
+        offset_masks = []
         if offset_masks_lower is not None:
             count = 0
             for offset_layer in offset_npim:
@@ -1503,17 +1764,19 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
 
                 # Invert the mask layer in order to raise all areas not previously masked.
                 # Subtracting elevation into negative values will cause an invalid STL to be generated.
-                offset_layer = numpy.where(offset_layer > 0, 0, 1)
-                offset_layer = numpy.multiply(offset_layer, 1 * offset)
-                npim = numpy.add(npim, offset_layer)
+                offset_masks.append((offset_layer, offset))
                 pr("Offset masked elevations by raising all non masked areas of", offset_masks_lower[count][0],"by", offset, "m, equiv. to", offset_masks_lower[count][1],  "mm at map scale")
-                npim = numpy.where(npim < 0, 0, npim)
                 count += 1
 
+        # raise the cells for lower_leq and all offset masks in place, in one pass over the raster
+        if threshold is not None or len(offset_masks) > 0:
+            npim_stats = raise_raster(npim, threshold, lower_offset, offset_masks)
+
         # fill (< 0 elevation) holes using a 3x3 footprint. Requires scipy. 
         # [0] is number of iterations, [1] is number of neighbors
         if fill_holes is not None and (fill_holes[0] > 0 or fill_holes[0] == -1):
-            npim = fillHoles(npim, num_iters=fill_holes[0], num_neighbors=fill_holes[1])
+            npim = fillHoles(npim, num_iters=fill_holes[0], num_neighbors=fill_holes[1], band_pool=band_pool)
+            npim_stats = RasterStats(npim)
 
         #
         # if we have a bottom elevation raster, do some checks and preparations 
@@ -1530,7 +1793,7 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             bottom = bot_npim
 
             # where top is actually lower than bottom (which can happen with Anson's data), set top to bottom
-            top = np.where(top < bottom, bottom, top)
+            top = map_row_blocks(lambda t, b: np.where(t < b, b, t), [top, bottom])
 
             # bool array with True where bottom has NaN values but top does not
             # this is specific to Anson's way of encoding through-water cells
@@ -1541,29 +1804,29 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
 
             # if both have the same value (or very close to) set both to Nan
             # No relative tolerance here as we don't care about this concept here. Set the abs. tolerance to 0.001 m (1 mm)
-            close_values = np.isclose(top, bottom, rtol=0, atol=0.001, equal_nan=False) # bool array
+            close_values = map_row_blocks(lambda t, b: np.isclose(t, b, rtol=0, atol=0.001, equal_nan=False), [top, bottom]) # bool array
 
             # for any True values in array, set corresponding top and bottom cells to NaN
             # Also set NaN flags
             if np.any(close_values) == True: 
                 # save pre-dilated top for later dilation
-                top_pre_dil = top.copy()  
+                top_pre_dil = copy_raster(top)
                 top[close_values] = np.nan   # set close values to NaN   
 
                 # if diagonal cleanup is requested, we need to do it again after setting NaNs
                 #clean_up_diags_check(top)
 
                 # save original top after setting NaNs so we can skip the undilated NaN cells later
-                top_orig = top.copy()  
-                top = dilate_array(top, top_pre_dil) # dilate the NaN'd top with the original (pre NaN'd) top
+                top_orig = copy_raster(top)
+                top = dilate_array(top, top_pre_dil, band_pool) # dilate the NaN'd top with the original (pre NaN'd) top
 
                 bottom[close_values] = np.nan # set close values to NaN 
                 #clean_up_diags_check(bottom) # re-check for diags
                 
                 if throughwater == True:
-                    bottom = dilate_array(bottom) # dilate with 3x3 nanmean #  
+                    bottom = dilate_array(bottom, band_pool=band_pool) # dilate with 3x3 nanmean #  
                 else:
-                    bottom = dilate_array(bottom, top_pre_dil) # dilate the NaN'd bottom with the original (pre NaN'd) top (same as original bottom)
+                    bottom = dilate_array(bottom, top_pre_dil, band_pool) # dilate the NaN'd bottom with the original (pre NaN'd) top (same as original bottom)
 
                 # pre-dilated top is not needed anymore
                 del top_pre_dil
@@ -1571,20 +1834,31 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         # if we have no bottom but have NaNs in top, make a copy and 3x3 dilate it. 
         # We'll still use the non-dilated top_orig when we need to skip NaN cells
         elif np.any(np.isnan(npim)):
-            top_orig = top.copy()   # save original top before it gets dilated
-            top = dilate_array(top) # dilate with 3x3 nanmean 
+            top_orig = copy_raster(top)   # save original top before it gets dilated
+            top = dilate_array(top, band_pool=band_pool) # dilate with 3x3 nanmean 
 
 
         # repair these patterns, which cause non_manifold problems later:
         # 0 1    or     1 0
         # 1 0    or     0 1
+        # This is done once for the full raster (incl. the single hole fill), so the tiles don't need to redo it.
+        # Note that this differs from the previous per tile cleanup at the seams between tiles: there, each tile only
+        # saw a 1 cell fringe of its neighbors and the two sides of a seam could be filled/cleaned differently
         if clean_diags == True:
-            npim = clean_up_diags(npim)
+            npim = fillHoles(npim, 1, 8, True, band_pool) # fill single holes
+            npim = clean_up_diags(npim, band_pool)
+            npim_stats = RasterStats(npim)
+            if top_orig is not None:
+                top_orig = clean_up_diags(top_orig, band_pool)
             if bottom_elevation != None:  
-                bot_npim = clean_up_diags(bot_npim) 
+                bot_npim = clean_up_diags(bot_npim, band_pool) 
                 # TODO: check if this is needed as top NaNs dictate if a cell
                 # should be skipped or not
 
+        # preprocessing is done, free the processes of the band pool before the tiles get theirs
+        if band_pool is not None:
+            band_pool.close()
+
         #
         # deal with min_elev and min_bottom_elev (and user set min_elev)
         #
@@ -1592,24 +1866,27 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
         # set minimum elevation for top (will be used by all tiles)
         user_offset = 0  # no offset unless user specified min_elev
         min_bottom_elev = None
+        if bottom_elevation != None:
+            bot_stats = RasterStats(bot_npim)
         if min_elev != None: # user-given minimum elevation (via min_elev argument)
             if bottom_elevation != None: # have a bottom elevation
-                 min_bottom_elev = numpy.nanmin(bot_npim) #(actual min elev for all tiles)
-            user_offset = numpy.nanmin(npim) - min_elev 
-            min_elev = numpy.nanmin(npim) #(actual min elev for all tiles)
+                 min_bottom_elev = bot_stats.min #(actual min elev for all tiles)
+            user_offset = npim_stats.min - min_elev 
+            min_elev = npim_stats.min #(actual min elev for all tiles)
         else: # no user-given min_elev
-            min_elev = numpy.nanmin(npim)
+            min_elev = npim_stats.min
             if bottom_elevation != None:
-                min_bottom_elev = numpy.nanmin(bot_npim)
+                min_bottom_elev = bot_stats.min
 
-        print(f"elev min/max : {min_elev:.2f} to {numpy.nanmax(npim):.2f}")
+        print(f"elev min/max : {min_elev:.2f} to {npim_stats.max:.2f}")
         if bottom_elevation != None:
-                print(f"bottom elev min/max : {numpy.nanmin(bot_npim):.2f} to {numpy.nanmax(bot_npim):.2f}")
+                print(f"bottom elev min/max : {bot_stats.min:.2f} to {bot_stats.max:.2f}")
 
         #
         # plot DEM and histogram, save as png
         #
-        plot_file_name = plot_DEM_histogram(npim, DEM_name, temp_folder)
+        plot_step = 1 if memmap_rasters == False else int(numpy.ceil(max(npim.shape) / 4000)) # (only plot every n-th cell of huge rasters)
+        plot_file_name = plot_DEM_histogram(npim[::plot_step, ::plot_step], DEM_name, temp_folder)
         print(f"DEM plot and histogram saved as {plot_file_name}", file=sys.stderr)
 
         #
@@ -1647,8 +1924,14 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             "use_geo_coords": use_geo_coords, # create STL coords in UTM: None, "centered" or "UTM"
             "smooth_borders": smooth_borders, # optimize borders?
             "clean_diags": clean_diags, # remove diagonal patterns?
+            "raster_diags_cleaned": clean_diags == True, # diagonal patterns were already removed from the full raster
             "dirty_triangles": dirty_triangles, # allow creating of better fitting but potentiall degenerate triangles
             "throughwater": throughwater, # special flag for NaNs in bottom raster
+            "vectorized_mesh": vectorized_mesh, # use create_triangle_arrays() instead of create_cells()
+            "float32_rasters": float32_rasters, # float32 instead of float64 tile rasters (vectorized_mesh only)
+            "CPU_cores_per_tile": CPU_cores_per_tile, # mesh stripes of the tile in parallel (vectorized_mesh only)
+            # deflate the tile in process_tile(), not for a k3d render, which needs the uncompressed tiles
+            "compress_zip": compress_zip == True and not (kd3_render == True and fileformat in ("STLa", "STLb")),
         }
 
         #
@@ -1662,11 +1945,11 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
 
 
         # pad full rasters(s) by one at the fringes
-        npim = numpy.pad(npim, (1,1), 'edge') # will duplicate edges, including nan
+        npim = pad_raster(npim) # will duplicate edges, including nan
         if bottom_elevation != None:
-            bot_npim = numpy.pad(bot_npim, (1,1), 'edge')
+            bot_npim = pad_raster(bot_npim)
         if top_orig is not None:
-            top_orig =  numpy.pad(top_orig, (1,1), 'edge')
+            top_orig =  pad_raster(top_orig)
 
         # store size of full raster
         tile_info["full_raster_height"], tile_info["full_raster_width"]  = npim.shape
@@ -1677,6 +1960,24 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             pr("Only processing tile:", process_only)
             CPU_cores_to_use = 1 # set to SP
 
+        # if there's only one tile or one CPU or CPU_cores_to_use is still at default None, process tiles sequentially 
+        # (single core), otherwise use multi-core processing (see below)
+        use_multi_core = not (num_tiles[0] * num_tiles[1] == 1 or CPU_cores_to_use == 1 or CPU_cores_to_use == None)
+
+        # multi-core: put the padded full raster(s) into shared memory once, the tiles then only get the name 
+        # of the shared memory block and their window within it instead of a pickled copy of their rasters
+        # (memmap rasters are not copied, the tiles map the rows of their window from the scratch files)
+        shared_blocks = [] 
+        shared_rasters = [None, None, None] # top, bottom, top_orig 
+        if use_multi_core:
+            for i, ras in enumerate((npim, bot_npim if bottom_elevation != None else None, top_orig)):
+                if ras is not None:
+                    shm, shared_rasters[i] = share_raster(ras)
+                    if shm is not None:
+                        shared_blocks.append(shm)
+
+        make_k3d_render = kd3_render == True and (fileformat == "STLa" or fileformat == "STLb")
+
         # within the padded full raster, grab tiles - but each with a 1 cell fringe!
         tile_list = [] # list of tiles to be processed via multiprocessing.map()
         for tx in range(num_tiles[0]):
@@ -1722,8 +2023,17 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
                     # store temp file names (not file objects), MP will create file objects during processing
                     my_tile_info["temp_file"]  = mytempfname
 
+                    # unless the k3d render needs the files, stream the tile into its zip file member 
+                    # (or for multi-core, into a part archive) instead, see process_tile()
+                    if not make_k3d_render:
+                        my_tile_info["zip_member"] = f"{DEM_title}_tile_{tile_info['tile_no_x']}_{tile_info['tile_no_y']}.{fileformat[:3]}"
+
                 # assemble tile to be processed
-                tile = (my_tile_info, tile_elev_raster, tile_bot_elev_raster, tile_elev_orig_raster)   # leave it to process_tile() to unwrap the info and data parts
+                if use_multi_core: # window of the tile in the shared rasters (see process_shared_tile())
+                    window = (slice(start_y, end_y), slice(start_x, end_x))
+                    tile = (my_tile_info, *[None if r is None else (r, window) for r in shared_rasters])
+                else:
+                    tile = (my_tile_info, tile_elev_raster, tile_bot_elev_raster, tile_elev_orig_raster)   # leave it to process_tile() to unwrap the info and data parts
 
                 # if we only process one tile ...
                 if process_only == None: # "only" parameter was not given
@@ -1738,28 +2048,92 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             logger.debug("tempfile or memory? number of pixels:" + str(tile_info["full_raster_height"] * tile_info["full_raster_width"]) + ">" + str(max_cells_for_memory_only) + " => using temp file")
 
 
+        # the tile width/height was written into tileinfo during processing
+        pr(f"\n{num_tiles[0]} x {num_tiles[1]} tiles, tile size {tile_info['tile_width']:.2f} x {tile_info['tile_height']:.2f} mm\n")
+
+        # stl_list will contain the stl/obj files or buffers 
+        # we only need it later to create a k3d render, otherwise each tile is freed once it's in the zip file
+        stl_list = [] # make list of filenames or buffers
+        using_temp_files = tile_info["full_raster_height"] * tile_info["full_raster_width"] > max_cells_for_memory_only
+
+        # with compress_zip, the tiles are deflated by process_tile(), except for a k3d render, which needs
+        # the uncompressed buffers or files, so the zip file compresses them when they are added
+        tile_compression = ZIP_DEFLATED if compress_zip == True and make_k3d_render else ZIP_STORED
+
+        def add_tile_to_zip(processed_tile):
+            '''put a processed tile into the zip file as soon as it's done, then free its buffer or temp file.
+            processed_tile is the tuple returned by process_tile(): [0] is always the tile info dict, if its
+            "temp_file" is None, [1] is a buffer, but if "temp_file" is a string, [1] is the name of the temp file 
+            (which is redundant, i know ...). [1] is None for a tile without any elevations.
+            If its "zip_file" is set, the tile was streamed into that zip file (this one or a part archive)'''
+            nonlocal total_size
+            tile_info, buf = processed_tile # per-tile info
+
+            # streamed (and compressed) into a part archive by a worker process: copy its compressed data over, 
+            # then delete the part archive
+            part_zip_name = tile_info.get("zip_file")
+            if part_zip_name != None and part_zip_name != zip_file.filename:
+                if buf is not None:
+                    copy_zip_member(part_zip_name, tile_info["zip_member"], zip_file)
+                try:
+                    os.remove(part_zip_name)
+                except Exception as e:
+                    logger.error("Error removing" + str(part_zip_name) + " " + str(e))
+
+            if buf is None:
+                if tile_info.get("temp_file") != None:
+                    try: # delete temp file b/c it's only a STLb header from a tile with no elevations
+                        os.remove(tile_info["temp_file"])
+                    except Exception as e:
+                        logger.error("Error removing" + str(tile_info["temp_file"]) + " " + str(e))
+                return
+
+            tile_name = f"{DEM_title}_tile_{tile_info['tile_no_x']}_{tile_info['tile_no_y']}.{fileformat[:3]}" # name of file inside zip
+            if tile_info.get("zip_file") != None: # already in the zip file (see above)
+                pass
+            elif tile_info.get("deflated") != None: # buf (or temp file) was already compressed by process_tile()
+                crc, size = tile_info["deflated"]
+                write_deflated_to_zip(zip_file, tile_name, buf, crc, size)
+                if tile_info.get("temp_file") != None:
+                    try:
+                        os.remove(tile_info["temp_file"]) # the .deflate file
+                    except Exception as e:
+                        logger.error("Error removing" + str(tile_info["temp_file"]) + " " + str(e))
+            elif tile_info.get("temp_file") != None: # if buf is a file 
+                fname = tile_info["temp_file"]
+                zip_file.write(fname , tile_name, compress_type=tile_compression) # write temp file into zip
+                if make_k3d_render:
+                    add_to_stl_list(fname, stl_list) # removed after the render
+                else:
+                    try:
+                        os.remove(fname) # on windows remove closed file manually
+                    except Exception as e:
+                        logger.error("Error removing" + str(fname) + " " + str(e))
+            else:
+                zip_file.writestr(tile_name, buf, compress_type=tile_compression) # buf is a string
+                if make_k3d_render:
+                    add_to_stl_list(buf, stl_list)
+
+            total_size += tile_info["file_size"]
+            logger.debug("adding tile %d %d, total size is %d" % (tile_info["tile_no_x"],tile_info["tile_no_y"], total_size))
+
+            # print size and elev range
+            pr("tile", tile_info["tile_no_x"], tile_info["tile_no_y"], ": height: ", tile_info["min_elev"], "-", tile_info["max_elev"], "mm",
+                ", file size:", round(tile_info["file_size"]), "Mb")
+
         # single core processing: just work on the list sequentially, don't use multi-core processing.
         # if there's only one tile or one CPU or CPU_cores_to_use is still at default None.
-        # processed list will contain tuple(s): [0] is always the tile info dict, if its
-        # "temp_file" is None, we got a buffer, but if "temp_file" is a string, we got a file of that name
-        # [1] can either be the buffer or again the name of the temp file we just wrote (which is redundant, i know ...)
-        # None means no MP
-        if num_tiles[0] * num_tiles[1] == 1 or CPU_cores_to_use == 1 or CPU_cores_to_use == None:
+        # Each tile goes into the zip file right after it was processed
+        if use_multi_core == False:
             pr("using single-core only (multi-core is currently broken :(")
-            processed_list = []
             # Convert each tile into a list: [0]: updated tile info, [1,2,3]: rasters (or None)
             for i,t in enumerate(tile_list):
                 # t[0] is the tile info dict, t[1] is the numpy array of elevations, t[2] is the numpy array of bottom elevations or None
                 #print "processing", i, numpy.round(t[1], 1), t[0]
 
-                pt = process_tile(t)  # pt is a tuple: [0]: updated tile info, [1]: grid object (or None)
-                if pt[1] is not None: # if we got a grid object and not None
-                    processed_list.append(pt) # append to list of processed tiles
-                else:
-                    try: # delete temp file b/c it's only a STLb header from a tile with no elevations
-                        os.remove(pt[0]["temp_file"])
-                    except Exception as e:
-                        logger.error("Error removing" + str(pt[0]["temp_file"]) + " " + str(e))
+                pt = process_tile(t, zip_file)  # pt is a tuple: [0]: updated tile info, [1]: buffer or temp file name (or None)
+                add_tile_to_zip(pt)
+                del pt
             
 
         # use multi-core processing
@@ -1785,56 +2159,38 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             mp = multiprocessing.get_context('spawn')
             pool = mp.Pool(processes=num_cores, maxtasksperchild=1) # processes=None means use all available cores
 
-            # Convert each tile in tile_list and return as list of lists: [0]: updated tile info, [1]: grid object
+            # Tiles are submitted to the pool as futures (apply_async) and put into the zip file in tile_list order
+            # as soon as they are done. At most max_in_flight tiles are submitted but not yet zipped, so the
+            # number of tile buffers held here is bounded (finished tiles wait only for earlier, slower tiles)
+            max_in_flight = 2 * (num_cores if num_cores is not None else os.cpu_count())
+            in_flight = {} # index in tile_list => AsyncResult
+            next_to_submit = 0
             try:
-                print("MP before map()\n", file=sys.stderr)  # DEBUG
-                processed_list = pool.map(process_tile, tile_list)
-                print("MP after map()\n", file=sys.stderr)   # DEBUG
+                print("MP before processing tiles\n", file=sys.stderr)  # DEBUG
+                for next_to_zip in range(len(tile_list)):
+                    while next_to_submit < len(tile_list) and next_to_submit - next_to_zip < max_in_flight:
+                        in_flight[next_to_submit] = pool.apply_async(process_shared_tile, (tile_list[next_to_submit],))
+                        next_to_submit += 1
+                    add_tile_to_zip(in_flight.pop(next_to_zip).get())
+                print("MP after processing tiles\n", file=sys.stderr)   # DEBUG
             except Exception as e:
                 pr(e)
+                pool.terminate()
+                raise
             else:
                 pool.close()
                 pool.terminate()
+            finally:
+                # free the shared memory of the rasters
+                for shm in shared_blocks:
+                    shm.close()
+                    shm.unlink()
 
             pr("... multi-core processing done, logging resumed")
 
-           
-        
-        
-        # the tile width/height was written into tileinfo during processing
-        pr(f"\n{num_tiles[0]} x {num_tiles[1]} tiles, tile size {tile_info['tile_width']:.2f} x {tile_info['tile_height']:.2f} mm\n")
-
         # delete tile list, as the elevation arrays are no longer needed
         del tile_list
 
-        # stl_list will contain the stl/obj files or buffers 
-        # we can use it later to create a k3d render
-        stl_list = [] # make list of filenames or buffers
-
-        # concat all processed tiles into a zip file
-        #print "start of putting tiles into zip file")
-        for p in processed_list:
-                tile_info = p[0] # per-tile info
-                tile_name = f"{DEM_title}_tile_{tile_info['tile_no_x']}_{tile_info['tile_no_y']}.{fileformat[:3]}" # name of file inside zip
-                buf= p[1] # either a string or a file object
-
-                if tile_info.get("temp_file") != None: # if buf is a file 
-                    fname = tile_info["temp_file"]
-                    stl_list = add_to_stl_list(fname, stl_list)
-                    zip_file.write(fname , tile_name) # write temp file into zip
-                else:
-                    zip_file.writestr(tile_name, buf) # buf is a string
-                    stl_list = add_to_stl_list(buf, stl_list)
-
-
-                total_size += tile_info["file_size"]
-                logger.debug("adding tile %d %d, total size is %d" % (tile_info["tile_no_x"],tile_info["tile_no_y"], total_size))
-
-                # print size and elev range
-                pr("tile", tile_info["tile_no_x"], tile_info["tile_no_y"], ": height: ", tile_info["min_elev"], "-", tile_info["max_elev"], "mm",
-                   ", file size:", round(tile_info["file_size"]), "Mb")
-
-
         pr("\ntotal size for all tiles:", round(total_size, 1), "Mb")
 
         # delete all the GDAL geotiff stuff
@@ -1847,27 +2203,24 @@ def get_zipped_tiles(DEM_name=None, trlat=None, trlon=None, bllat=None, bllon=No
             for offset_layer in offset_npim:
                 del offset_layer
 
+        # delete the scratch files of memmap_rasters
+        if memmap_rasters == True:
+            shutil.rmtree(scratch_folder, ignore_errors=True)
+
 
         # make k3d render
-        if kd3_render == True and (fileformat == "STLa" or fileformat == "STLb"):
-            if tile_info.get("temp_file") != None:
-                html_file = k3d_render_to_html(stl_list, temp_folder, buffer=False)
-            else:
-                html_file = k3d_render_to_html(stl_list, temp_folder, buffer=True)
+        if make_k3d_render:
+            html_file = k3d_render_to_html(stl_list, temp_folder, buffer=not using_temp_files)
             zip_file.write(html_file, "k3d_plot.html") # write into zip
 
-
-        # file or buffer cleanup
-        for p in processed_list:
-            tile_info = p[0]
-            buf= p[1]
-            if tile_info.get("temp_file") != None:
-                try:
-                    os.remove(fname) # on windows remove closed file manually
-                except Exception as e:
-                    logger.error("Error removing" + str(fname) + " " + str(e))
-            else:
-                del buf # delete buffer
+            # file or buffer cleanup
+            for stl in stl_list:
+                if using_temp_files:
+                    try:
+                        os.remove(stl) # on windows remove closed file manually
+                    except Exception as e:
+                        logger.error("Error removing" + str(stl) + " " + str(e))
+            del stl_list
 
 
     # end of: if fileformat != "GeoTiff"
@@ -34,6 +34,7 @@ import struct # for making binary STL
 import sys
 import multiprocessing
 import io
+import copy
 import os
 import shutil   
 
@@ -52,9 +53,10 @@ def get_normal(tri):
     "in: 3 verts, out normal (nx, ny,nz) with length 1"
     
     (v0, v1, v2) = tri
-    p0 = Point.from_list(v0.get())
-    p1 = Point.from_list(v1.get())
-    p2 = Point.from_list(v2.get())
+    # verts can be vertex objects or just lists of 3 coords (from a triangle array)
+    p0 = Point.from_list(v0.get() if isinstance(v0, vertex) else v0)
+    p1 = Point.from_list(v1.get() if isinstance(v1, vertex) else v1)
+    p2 = Point.from_list(v2.get() if isinstance(v2, vertex) else v2)
     a = Vector.from_points(p1, p0)
     b = Vector.from_points(p1, p2)
     #print p0,p1, p2
@@ -68,6 +70,143 @@ def get_normal(tri):
         normal = [c.x/m, c.y/m, c.z/m]
     return normal
 
+def get_normals(tris):
+    '''Vectorized get_normal(): in: (n, 3, 3) array of triangles (3 verts, xyz), out: (n, 3) array of normals with length 1.
+    Degenerate triangles (collapsed into a line or a point, e.g. with dirty_triangles) get a normal of (0, 0, 0)'''
+    a = tris[:, 0] - tris[:, 1]
+    b = tris[:, 2] - tris[:, 1]
+
+    # cross product and magnitude with the same order of operations as Vector.cross() and Vector.magnitude()
+    normals = np.empty_like(a)
+    normals[:, 0] = a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1]
+    normals[:, 1] = a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2]
+    normals[:, 2] = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+    m = np.sqrt(normals[:, 0]**2 + normals[:, 1]**2 + normals[:, 2]**2)
+    degenerate = m == 0
+    m[degenerate] = 1
+    normals /= m[:, None]
+    normals[degenerate] = 0 # (instead of -0.0)
+    return normals
+
+def corner_elevations(ras, nan_aware=False):
+    '''Returns the elevations of all cell corners of a (by 1 cell) padded raster as a (ny+1, nx+1) array.
+    Each corner elevation is the mean of the 4 cells that share this corner, so for cell [y,x] of the 
+    inner (unpadded) raster its NW corner is at [y,x] and its SE corner is at [y+1,x+1].
+    If nan_aware is True, NaN cells are ignored for the mean (same as nanmean()) and a corner
+    that is surrounded by 4 NaN cells will be NaN.
+    '''
+    # the 4 cells around each corner, same order as used for a cell's NE corner in create_cells()
+    c0 = ras[1:,  1:]
+    c1 = ras[:-1, 1:]
+    c2 = ras[:-1, :-1]
+    c3 = ras[1:,  :-1]
+
+    if nan_aware == False:
+        return (c0 + c1 + c2 + c3) / 4.0
+
+    # sum up the non-NaN cells and divide by their number, which is 0 for corners with 4 NaN cells
+    num_valid = np.zeros(c0.shape, dtype=np.int8)
+    elev_sum = np.zeros(c0.shape, dtype=utils.float_dtype(ras))
+    for c in (c0, c1, c2, c3):
+        valid = ~np.isnan(c)
+        num_valid += valid
+        elev_sum += np.where(valid, c, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'): # 0/0 => NaN is what we want here
+        return elev_sum / num_valid
+
+
+def corners_have_nan(corners):
+    '''returns a (ny, nx) bool array that is True for cells with at least one NaN corner in the (ny+1, nx+1) corners array'''
+    corner_nan = np.isnan(corners)
+    return corner_nan[:-1, :-1] | corner_nan[:-1, 1:] | corner_nan[1:, :-1] | corner_nan[1:, 1:]
+
+# Vertex indices for the (up to) 12 triangles of a cell, used by grid.create_triangle_arrays()
+# The 8 vertices of a cell are: 0: top at min x, max y (NEt in create_cells()), 1: top at max x, max y (NWt),
+# 2: top at min x, min y (SEt), 3: top at max x, min y (SWt) and 4 - 7 are the same for the bottom.
+# The triangles (2 each for top, bottom, N, S, E and W wall) and their vertex order are the same as in create_cells()
+cell_triangle_verts = np.array([
+    [0, 2, 3], [0, 3, 1], # top
+    [4, 5, 7], [4, 7, 6], # bottom
+    [4, 0, 1], [4, 1, 5], # N wall
+    [7, 3, 2], [7, 2, 6], # S wall
+    [1, 3, 7], [1, 7, 5], # E wall
+    [2, 0, 4], [2, 4, 6], # W wall
+])
+
+# for each of the 8 vertices of a cell: top (0) or bottom (1), and row and column offset of its corner from the cell
+cell_vertex_offsets = np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1], [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]])
+
+# Tri-cells (smooth_borders): a cell with borders on 2 adjacent sides is collapsed into a triangle and gets a
+# diagonal wall, same as cell.convert_to_tri_cell(). Cell types are 0: normal cell, 1: N and W border, 2: N and E,
+# 3: S and E, 4: S and W. For each tri-cell type: (top triangle, bottom triangle, slot of the diagonal wall,
+# its 2 triangles, slot of the wall that is removed)
+tri_cell_triangles = {
+    1: ([1, 2, 3], [5, 7, 6], 4, [[2, 1, 5], [2, 5, 6]], 10), # N and W, W wall removed
+    2: ([0, 2, 3], [4, 7, 6], 4, [[0, 3, 7], [0, 7, 4]], 8),  # N and E, E wall removed
+    3: ([1, 0, 2], [6, 4, 5], 6, [[1, 2, 6], [1, 6, 5]], 8),  # S and E, E wall removed
+    4: ([3, 1, 0], [4, 5, 7], 6, [[3, 0, 4], [3, 4, 7]], 10), # S and W, W wall removed
+}
+
+# vertex indices (type, slot, 3) and mask of the slots that can be used (type, slot) for all 5 cell types
+cell_type_triangle_verts = np.array([cell_triangle_verts] * 5)
+cell_type_slots = np.ones((5, 12), dtype=bool)
+for t, (top_tri, bottom_tri, wall_slot, wall_tris, removed_slot) in tri_cell_triangles.items():
+    cell_type_triangle_verts[t, 0] = top_tri
+    cell_type_triangle_verts[t, 2] = bottom_tri
+    cell_type_triangle_verts[t, wall_slot:wall_slot+2] = wall_tris
+    cell_type_slots[t, [1, 3, removed_slot, removed_slot+1]] = False # tri-cells only have 1 top and 1 bottom triangle
+
+def cell_borders(top_orig, have_nan, fringe=("N", "S", "E", "W")):
+    '''Returns a dict with a (ny, nx) bool array for each direction ("N", "S", "E", "W") that is True
+    for cells that need a wall in that direction. top_orig is the (by 1 cell) padded, non-dilated top raster 
+    (or a band of its rows, including 1 row above and below). Fringe cells always have a wall and with NaNs,
+    so does every cell that has a NaN cell next to it.
+    fringe: directions in which top_orig is at the fringe of the tile (a band of rows only has E and W fringes,
+    plus N for the first and S for the last band)'''
+    ny, nx = top_orig.shape[0] - 2, top_orig.shape[1] - 2
+    borders = {drct: np.zeros((ny, nx), dtype=bool) for drct in ["N", "S", "E", "W"]}
+    if "N" in fringe: borders["N"][0, :] = True
+    if "S" in fringe: borders["S"][-1, :] = True
+    if "W" in fringe: borders["W"][:, 0] = True
+    if "E" in fringe: borders["E"][:, -1] = True
+    if have_nan == True:
+        # shift the NaN mask by 1 cell in each direction
+        nan_mask = np.isnan(top_orig)
+        borders["N"] |= nan_mask[:-2, 1:-1]
+        borders["S"] |= nan_mask[2:, 1:-1]
+        borders["W"] |= nan_mask[1:-1, :-2]
+        borders["E"] |= nan_mask[1:-1, 2:]
+    return borders
+
+def tri_cell_types(borders):
+    '''Returns a (ny, nx) int8 array with the cell type (see tri_cell_triangles) of each cell. Cells with borders
+    on exactly 2 adjacent sides are tri-cells (type 1 - 4), all others are normal cells (type 0),
+    see cell.check_for_tri_cell()'''
+    N, S, E, W = borders["N"], borders["S"], borders["E"], borders["W"]
+    two_borders = (N.astype(np.int8) + S + E + W) == 2
+    types = np.zeros(N.shape, dtype=np.int8)
+    types[two_borders & N & W] = 1
+    types[two_borders & N & E] = 2
+    types[two_borders & S & E] = 3
+    types[two_borders & S & W] = 4
+    return types
+
+
+# ascii STL facet: normal and 3 vertices (xyz)
+ASCII_FACET ="""facet normal {face[0]:f} {face[1]:f} {face[2]:f}\nouter loop\nvertex {face[3]:f} {face[4]:f} {face[5]:f}\nvertex {face[6]:f} {face[7]:f} {face[8]:f}\nvertex {face[9]:f} {face[10]:f} {face[11]:f}\nendloop\nendfacet\n"""
+
+def memory_info():
+    '''returns the peak memory use of this process as string for progress prints (empty if not available)'''
+    peak_MB = utils.get_peak_memory_MB()
+    return "" if peak_MB is None else f"peak memory: {peak_MB:.0f} MB"
+
+# binary STL facet: normal, 3 vertices (xyz) and the "attribute byte count" (0), 50 bytes without padding
+# en.wikipedia.org/wiki/STL_%28file_format%29#Binary_STL
+STLb_facet_dtype = np.dtype([("normal", "<f4", (3,)), ("v", "<f4", (9,)), ("attr", "<u2")])
+BINARY_HEADER = "80sI" # up to 80 chars do NOT start with the word solid + number of faces as UINT32
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER) # 84 bytes
+
 
 class vertex:
 
@@ -75,8 +214,11 @@ class vertex:
     # key is tuple of coordinates, value is a unique index
     vertex_index_dict = -1  
 
+    # no per instance __dict__, there are millions of these
+    __slots__ = ("coords",)
+
     def __init__(self, x,y,z):
-        self.coords = tuple([float(d) for d in (x,y,z)])  # made this a tuple (zigzag won't work wth this anymore but it's not used anyway ...)
+        self.coords = (float(x), float(y), float(z))  # made this a tuple (zigzag won't work wth this anymore but it's not used anyway ...)
         vdict = vertex.vertex_index_dict # class attribute
 
         # for non obj file this is set to -1, and there's no need to deal with vertex indices
@@ -125,10 +267,12 @@ class quad:
     # class attribute, use quad.too_skinny_ratio
     too_skinny_ratio = 0.1 # border quads with a horizontal vs vertical ratio smaller than this will be subdivided
 
+    __slots__ = ("vl", "subdivide_by")
+
     # order is NE, NW, SW, SE
     # can be just a triangle, if it just any 3 ccw consecutive corners 
     def __init__(self, v0, v1, v2, v3=None): 
-        self.vl = [v0, v1, v2, v3]
+        self.vl = (v0, v1, v2, v3) # a tuple is smaller than a list and quads don't change their verts
         self.subdivide_by = None # if not None, we need to subdivide the quad into that many subquads
 
     def get_copy(self):
@@ -291,6 +435,8 @@ class cell:
     '''a cell with a top and bottom quad, constructor: uses refs and does NOT copy ...
        except for triangle cells
        '''
+    __slots__ = ("topquad", "bottomquad", "borders", "is_tri_cell")
+
     def __init__(self, topquad, bottomquad, borders, is_tri_cell=False):
         self.topquad = topquad
         self.bottomquad = bottomquad
@@ -408,6 +554,10 @@ class grid:
     offsety = None
     num_triangles = 0
     fo = None  
+    facets = None # STLb facets of the (preallocated) file or buffer, see allocate_STLb()
+    num_facets = None # number of STLb facets written into the header by allocate_STLb()
+    zip_stream = None # zip file member that's written into instead of the temp file, see make_file_buffer()
+    diags_cleaned = False # True once clean_up_tile_diags() has run on this tile
     
 
     def __init__(self, top, bottom, top_orig, tile_info):
@@ -425,10 +575,12 @@ class grid:
         self.tile_info = tile_info
 
 
-        if self.tile_info["fileformat"] == 'obj':
+        # with vectorized meshing, obj vertex indices are derived from their position in the grid (create_triangle_arrays())
+        self.grid_indexed_obj = self.tile_info["fileformat"] == 'obj' and self.tile_info.get("vectorized_mesh") == True
+        if self.tile_info["fileformat"] == 'obj' and self.grid_indexed_obj == False:
             vertex.vertex_index_dict = {} # will be filled with vertex indices
 
-        self.cells = None # stores the cells in  a 2D array of cells
+        self.cells = None # cells are no longer stored (only used by the old zigzag code below)
 
         # Important: in 2D np arrays, x and y coordinate are "flipped" in the sense that when printing top
         # top[0,0] appears to the upper left (NW) corner and [0,1] (East) of it:
@@ -453,17 +605,26 @@ class grid:
         # same for bottom, if we have one
         if self.tile_info["bottom_elevation"] is not None:
             self.tile_info["have_bot_nan"] = np.any(np.isnan(self.bottom))# True => we have NaN values, 
+        else:
+            self.tile_info["have_bot_nan"] = False
 
         # Jan 2019: no idea why, but sometimes changing top also changes the elevation
         # array of another tile in the tile list
-        # for now I make a copy of all rasters and convert them to float
-        self.top = self.top.copy().astype(np.float64) # writeable
+        # Tile rasters are read-only views (of the full raster, which may be in shared memory), so make a (float)
+        # copy of a raster only if it will be changed (converted to mm) below, otherwise use it as it is
+        # With float32_rasters, the rasters are float32 (half the memory). Only the vectorized engine supports this, as it 
+        # calculates each corner elevation once, while create_cells() calculates a corner up to 4 times (in different 
+        # order) and would get slightly different (non-manifold) float32 corners. Vertex coords are still float64.
+        dtype = np.float32 if self.tile_info.get("float32_rasters") == True and self.tile_info.get("vectorized_mesh") == True else np.float64
+        to_mm = self.tile_info["use_geo_coords"] is None
+        self.top = np.array(self.top, dtype=dtype) if to_mm else np.asarray(self.top, dtype=dtype)
 
         if self.bottom is not None:
-            self.bottom = bottom.copy().astype(np.float64) # writeable
+            bottom_to_mm = to_mm and self.tile_info["bottom_elevation"] is not None and self.throughwater == False
+            self.bottom = np.array(bottom, dtype=dtype) if bottom_to_mm else np.asarray(bottom, dtype=dtype)
 
         if self.top_orig is not None:
-            self.top_orig = top_orig.copy().astype(np.float64)
+            self.top_orig = np.asarray(top_orig, dtype=dtype) # never changed in place
 
 
         #
@@ -482,6 +643,9 @@ class grid:
         # bottom is a elevation raster. It's ok to have NaNs in the bottom raster and/or top raster
         elif tile_info["bottom_elevation"] is not None and isinstance(self.bottom, np.ndarray) == True:
             self.tile_info["have_bottom_array"] = True
+        # bottom is a relief raster (in mm) made from the bottom image
+        elif tile_info["bottom_image"] is not None and isinstance(self.bottom, np.ndarray) == True:
+            self.tile_info["have_bottom_array"] = True
 
         # need to use the tilewide min/max for each tile, otherwise the boudaries don't line up perfectly! 
 
@@ -563,7 +727,8 @@ class grid:
 
             scz = 1 / self.tile_info["scale"] * 1000.0 # scale z to mm
 
-            if self.tile_info["have_bottom_array"] == False:
+            # a bottom image relief is already in mm and does not need to be scaled
+            if self.tile_info["have_bottom_array"] == False or self.tile_info["bottom_elevation"] is None:
                 self.top -= self.tile_info["min_elev"] # subtract global min from top to get to 0 
                 
             else:
@@ -587,8 +752,11 @@ class grid:
             self.top += self.tile_info["base_thickness_mm"] # add base thickness to top
 
             # post-scale (i.e. in mm) top elevations (for this tile)
-            self.tile_info["min_elev"] = np.nanmin(self.top)
-            self.tile_info["max_elev"] = np.nanmax(self.top)
+            if np.all(np.isnan(self.top)): # empty tile (nothing gets meshed, see is_empty()), nanmin/nanmax would warn
+                self.tile_info["min_elev"] = self.tile_info["max_elev"] = np.nan
+            else:
+                self.tile_info["min_elev"] = np.nanmin(self.top)
+                self.tile_info["max_elev"] = np.nanmax(self.top)
             print("top min/max for tile (mm):", self.tile_info["min_elev"], self.tile_info["max_elev"])
 
         else:  # using geo coords (UTM, meter based) - thickness is meters
@@ -669,6 +837,32 @@ class grid:
             if self.tile_info["clean_diags"] == True: # cleanup requested?
                 ras = utils.clean_up_diags(ras)
 
+    def clean_up_tile_diags(self):
+        '''fill single holes and clean up diagonal NaN patterns of this tile, if requested via clean_diags
+        Skipped if this was already done on the full raster (tile_info["raster_diags_cleaned"])'''
+        if self.tile_info.get("raster_diags_cleaned") == True or self.diags_cleaned == True:
+            return
+        self.diags_cleaned = True
+        if self.tile_info["clean_diags"] == True:
+            self.top = utils.fillHoles(self.top, 1, 8, True) # fill single holes
+            self.top = utils.clean_up_diags(self.top)
+            if self.top_orig is not None:
+                self.top_orig = utils.clean_up_diags(self.top_orig)
+
+    def is_empty(self):
+        '''True if no cell of this tile has a top, i.e. make_file_buffer() would not create any triangles. 
+        When using top and bottom and multiple tiles, a water tile can be empty b/c no water cells cross it.
+        Cells with a NaN center are skipped (see create_cells() and mesh_rows()), so this checks whether the
+        top raster they use has any non-NaN cell inside its 1 cell padding'''
+        self.clean_up_tile_diags() # may set more cells to NaN
+        if self.tile_info["have_nan"] == False:
+            return False
+        if self.tile_info["dirty_triangles"] == False and self.top_orig is not None:
+            top = self.top_orig
+        else:
+            top = self.top
+        return bool(np.all(np.isnan(top[1:-1, 1:-1])))
+
     def create_cells(self):
         '''Creates a data structure for each raster cell based on quads for top, any walls and possible bottom.
         Once created, each cell is converted into triangles for each file format, which are stored as a stream buffer (self.s)
@@ -677,16 +871,7 @@ class grid:
         for vertex coordinates. Here, only the index part (s[1] and fo[1]) is stored, the vertex coordinates will be
         created and stored later based on the keys of the vertex class attribute vertex_index_dict'''
         
-        # store cells in an array, init to None
-        self.cells = np.empty([self.ymaxidx, self.xmaxidx], dtype=cell)
-
-        # TODO: not sure we need this any more, given that this was done on the full raster
-        # and after the operations that could have changed the raster 
-        if self.tile_info["clean_diags"] == True:
-            self.top = utils.fillHoles(self.top, 1, 8, True) # fill single holes
-            self.top = utils.clean_up_diags(self.top)
-            if self.top_orig is not None:
-                self.top_orig = utils.clean_up_diags(self.top_orig)
+        self.clean_up_tile_diags()
 
         # report progress in %
         percent = 10
@@ -697,7 +882,7 @@ class grid:
         for j in range(1, self.ymaxidx+1):# y dimension for looping within the +1 padded raster
             if j % pc_step == 0:
                 progress += percent
-                print(progress, "%", multiprocessing.current_process(), file=sys.stderr)
+                print(progress, "%", multiprocessing.current_process(), memory_info(), file=sys.stderr)
 
             for i in range(1, self.xmaxidx + 1):# x dim.
                 #print("y=",j," x=",i, " elev=",top[j,i])
@@ -713,9 +898,8 @@ class grid:
                     top = self.top
 
 
-                # if center elevation of current top cell is NaN, set its cell to None and skip the rest
+                # if center elevation of current top cell is NaN, skip the rest
                 if self.tile_info["have_nan"] and np.isnan(top[j, i]):
-                    self.cells[j-1, i-1] = None
                     continue
                 
                 # x/y coords of cell "walls", origin is upper left
@@ -742,7 +926,7 @@ class grid:
 
                     # interpolate each corner with possible NaNs, using mean()
                     # Note: if we have 1 or more NaNs, we get a warning: warnings.warn("Mean of empty slice", RuntimeWarning)
-                    # but if the result of ANY corner is NaN (b/c it used 4 NaNs), skip this cell entirely by setting it to None instead a cell object
+                    # but if the result of ANY corner is NaN (b/c it used 4 NaNs), skip this cell entirely
                     with warnings.catch_warnings():
                         warnings.filterwarnings('error')
                         NEar = np.array([elev[j+0,i+0], elev[j-1,i-0], elev[j-1,i+1], elev[j-0,i+1]]).astype(np.float64)
@@ -764,8 +948,7 @@ class grid:
                             #print(j-1, i-1, ": elevation of at least one corner of this cell is NaN - skipping cell")
                             #print " NW",NWelev," NE", NEelev, " SE", SEelev, " SW", SWelev # DEBUG
                             num_nans = sum(np.isnan(np.array([NEelev, NWelev, SEelev, SWelev]))) # is ANY of the corners NaN?
-                            if num_nans > 0: # yes, set cell to None and skip it ...
-                                self.cells[j-1, i-1] = None
+                            if num_nans > 0: # yes, skip this cell
                                 return None, None, None, None
                         else:
                             
@@ -926,6 +1109,316 @@ class grid:
         
         print("100%", multiprocessing.current_process(), "\n", file=sys.stderr)
     
+    def create_triangle_arrays(self, cells_per_band=32768):
+        '''Vectorized version of create_cells(), used if tile_info["vectorized_mesh"] is True.
+        Instead of making a cell object (with quad and vertex objects) for each raster cell, the tile is processed
+        as bands of rows. For each band, the elevations of all cell corners, the walls (cell_borders()) and the
+        tri-cells for smooth borders (tri_cell_types()) are calculated from the rows of the band plus 1 row above
+        and below, then the triangles of the top, bottom and walls are made as a (n, 3, 3) array (n triangles, 3 verts, xyz),
+        written via write_triangle_array_to_buffer() and the band is discarded. So, apart from the rasters,
+        memory use only depends on the size of a band, not of the tile.
+        Each cell has 12 triangle "slots" (see cell_type_triangle_verts), a mask of the slots needed for each cell is 
+        used to pull out the triangles, so they end up in the same order as with create_cells().
+        With tile_info["CPU_cores_per_tile"], horizontal stripes of the tile are meshed in parallel, see mesh_stripes().
+        cells_per_band: (approximate) number of cells to process at once'''
+
+        self.clean_up_tile_diags()
+
+        ny = self.ymaxidx
+        print("creating triangle arrays for", multiprocessing.current_process(), file=sys.stderr)
+
+        self.bottom_corner_ids = [None] * 4 
+
+        # number of processes to mesh this tile with (0 means all cores), can't be used within a tile that's 
+        # already processed by a (daemonic) worker process of get_zipped_tiles() 
+        num_processes = self.tile_info.get("CPU_cores_per_tile")
+        if num_processes == 0: 
+            num_processes = multiprocessing.cpu_count()
+        if num_processes is not None and num_processes > 1 and ny > 1 and multiprocessing.current_process().daemon == False:
+            self.mesh_stripes(num_processes, cells_per_band)
+        else:
+            # STLb: the number of triangles only depends on the slot masks, so it's known before any triangle is made and 
+            # the file (or buffer) can be allocated in full and filled in place
+            if self.tile_info["fileformat"] == "STLb":
+                num_facets, _ = self.mesh_rows(0, ny, cells_per_band, count_only=True)
+                self.allocate_STLb(num_facets + (2 if self.use_simple_bottom() else 0))
+            self.mesh_rows(0, ny, cells_per_band)
+
+        print("\n", file=sys.stderr)
+
+    def mesh_rows(self, y_start, y_end, cells_per_band=32768, first_id=1, count_only=False):
+        '''makes the triangles of the cell rows y_start to y_end-1 band by band (see create_triangle_arrays()).
+        first_id: obj index of the first vertex of corner row y_start
+        count_only: True => only count the triangles (and the obj vertices), don't make them
+        returns the number of triangles and the number of (obj) vertices of these rows'''
+
+        ti = self.tile_info
+        have_nan = ti["have_nan"]
+        have_bottom_array = ti["have_bottom_array"]
+        ny, nx = self.ymaxidx, self.xmaxidx
+
+        # non-dilated top, used to skip NaN cells and to decide where walls are needed
+        top_orig = self.top_orig if self.top_orig is not None else self.top
+
+        # collapse cells with 2 adjacent walls into triangles with a diagonal wall (not done with a bottom array
+        # as it will lead to lots of triangle holes!)
+        make_tri_cells = have_nan == True and ti["smooth_borders"] == True and have_bottom_array == False
+
+        # do we need bottom triangles or will the bottom be made from 2 triangles later?
+        with_bottom = ti["no_bottom"] == False and (have_nan == True or have_bottom_array == True)
+
+        def band_slots(y0, y1):
+            '''returns the elevations of the top and bottom corners of cell rows y0 to y1-1 (i.e. corner rows y0 to y1), 
+            the cell type (see tri_cell_types()) and the mask of the triangle slots needed for each cell in that band'''
+            # rows of the padded rasters for this band (y0+1 to y1) and 1 row above and below 
+            band = slice(y0, y1 + 2)
+
+            # elevations of all top corners, NaN aware if needed
+            top_corners = corner_elevations(self.top[band], nan_aware=have_nan)
+
+            # True for cells that are not part of the mesh
+            skip = np.zeros((y1 - y0, nx), dtype=bool)
+            if have_nan == True:
+                # skip NaN cells (for dirty triangles, only those that are still NaN after dilation) 
+                center = self.top if ti["dirty_triangles"] == True else top_orig
+                skip |= np.isnan(center[y0+1:y1+1, 1:-1])
+                # skip cells that have a corner surrounded by 4 NaN cells
+                skip |= corners_have_nan(top_corners)
+
+            # elevations of all bottom corners
+            if have_bottom_array == True:
+                if self.throughwater == True: # for the through water case, simply set the bottom to 0
+                    bottom_corners = np.zeros(top_corners.shape)
+                else:
+                    bottom_corners = corner_elevations(self.bottom[band], nan_aware=ti["have_bot_nan"])
+                    if ti["have_bot_nan"] == True:
+                        skip |= corners_have_nan(bottom_corners)
+            else:
+                bottom_corners = np.full(top_corners.shape, self.bottom, dtype=top_corners.dtype) # constant bottom elevation
+
+            # Which directions will need a wall?
+            fringe = ["E", "W"] + (["N"] if y0 == 0 else []) + (["S"] if y1 == ny else [])
+            borders = cell_borders(top_orig[band], have_nan, fringe)
+
+            if make_tri_cells == True:
+                types = tri_cell_types(borders)
+                types[skip] = 0
+            else:
+                types = np.zeros((y1 - y0, nx), dtype=np.int8)
+
+            # mask of the triangle slots needed for each cell in this band
+            slots = cell_type_slots[types] # (rows, nx, 12) 
+            slots[:, :, 2:4] &= with_bottom
+            for k, drct in enumerate(["N", "S", "E", "W"]):
+                slots[:, :, 4 + 2*k : 6 + 2*k] &= borders[drct][:, :, None]
+            slots &= ~skip[:, :, None]
+            return top_corners, bottom_corners, types, slots
+
+        def band_triangles(y0, y1):
+            '''returns the elevations of the top and bottom corners of cell rows y0 to y1-1 (i.e. corner rows y0 to y1), 
+            and the cells (row in band, column) and 3 vertex indices (0 - 7) of all triangles in that band'''
+            top_corners, bottom_corners, types, slots = band_slots(y0, y1)
+
+            # cell (row by row) and slot order 
+            rows, cols, slot_idx = np.nonzero(slots)
+            tri_verts = cell_type_triangle_verts[types[rows, cols], slot_idx] # (n, 3) vertex indices
+            return top_corners, bottom_corners, rows, cols, tri_verts 
+
+        def used_corners(y0, y1):
+            '''band_triangles() for the cell rows y0 to y1-1 and the halo row y1, returns the band's triangles
+            (without the halo row) as cells, vertex offsets (see cell_vertex_offsets) and the mask of the used 
+            top/bottom corners of corner rows y0 to y1'''
+            top_corners, bottom_corners, rows, cols, tri_verts = band_triangles(y0, min(y1 + 1, ny))
+            tb, dr, dc = cell_vertex_offsets[tri_verts].transpose(2, 0, 1) # (n, 3) each
+
+            # which top/bottom corners of corner rows y0 to y1 are used?
+            used = np.zeros((2, top_corners.shape[0], nx+1), dtype=bool)
+            used[tb, rows[:, None] + dr, cols[:, None] + dc] = True
+            used = used[:, :y1 - y0 + 1]
+
+            in_band = rows < y1 - y0
+            return top_corners, bottom_corners, rows[in_band], cols[in_band], tb[in_band], dr[in_band], dc[in_band], used
+
+        # report progress in %
+        rows_per_band = max(1, cells_per_band // nx)
+        bands = [(y0, min(y0 + rows_per_band, y_end)) for y0 in range(y_start, y_end, rows_per_band)]
+        progress = 0
+        num_triangles = 0 
+        num_vertices = 0
+
+        if self.grid_indexed_obj == True:
+            # obj: the index of a vertex is derived from its position in the grid of top or bottom corners. Only corners
+            # that are used by a triangle get an index: per corner row, first the used top corners, then the used bottom corners.
+            # To know which corners of the last corner row of a band are used, the band also gets the triangles of 
+            # the first row of the next band (its halo row)
+            x_corner = np.arange(nx+1) * self.cell_size - self.offsetx # coords of all corners, same as create_cells() uses for E and N
+            used_first_row = None # used corners of the first corner row of the band (= last corner row of the previous band)
+            if y_start > 0: # corner row y_start is also used by the triangles of cell row y_start-1 
+                used_first_row = used_corners(y_start - 1, y_start)[-1][:, -1]
+        else:
+            # x/y coords of cell "walls" (see create_cells())
+            x_min = np.arange(nx) * self.cell_size - self.offsetx
+            x_max = x_min + self.cell_size
+
+        for band_no, (y0, y1) in enumerate(bands):
+
+            if self.grid_indexed_obj == True:
+                top_corners, bottom_corners, rows, cols, tb, dr, dc, used = used_corners(y0, y1)
+                if used_first_row is not None: 
+                    used[:, 0] |= used_first_row
+                used_first_row = used[:, -1].copy()
+
+                # index of the first vertex of each corner row
+                num_used = used.sum(axis=2) # (2, rows+1) number of used top/bottom corners per row
+                row_first_id = first_id + np.concatenate(([0], np.cumsum(num_used.sum(axis=0))))
+                num_rows = y1 - y0 + 1 if y1 == ny else y1 - y0 # the last band also gets the bottom corner row
+                num_vertices += row_first_id[num_rows] - first_id
+                num_triangles += len(rows)
+                first_id = row_first_id[y1 - y0]
+                if count_only == True:
+                    continue
+                
+                # v lines for the corner rows of this band
+                for r in range(num_rows):
+                    y = -(y0 + r) * self.cell_size + self.offsety
+                    for k, corners in enumerate((top_corners, bottom_corners)):
+                        c = np.nonzero(used[k, r])[0]
+                        coords = np.stack((x_corner[c], np.full(len(c), y), corners[r, c]), axis=1)
+                        self.s[0].write("".join([f"v {x}, {y}, {z}\n" for x, y, z in coords.tolist()]))
+
+                # f lines: index of the 3 verts of each triangle (without the halo row), based on the index of the 
+                # first vertex in its corner row and its rank within the used top or bottom corners of that row
+                rank = np.cumsum(used, axis=2) - 1 
+                r, c = rows[:, None] + dr, cols[:, None] + dc
+                ids = row_first_id[r] + np.where(tb == 0, 0, num_used[0, r]) + rank[tb, r, c]
+                self.s[1].write("".join([f"f {a}, {b}, {c}\n" for a, b, c in ids.tolist()]))
+                self.num_triangles += len(ids)
+                self.write_buffer_to_file(force=True)
+
+                # indices of the 4 bottom corners of the tile, (W,N), (E,N), (W,S), (E,S), used for the 
+                # 2 triangle bottom (see make_file_buffer())
+                for k, (r, c) in enumerate([(0, 0), (0, nx), (y1 - y0, 0), (y1 - y0, nx)]):
+                    if (y0 + r) in (0, ny) and used[1, r, c] == True:
+                        self.bottom_corner_ids[k] = row_first_id[r] + num_used[0, r] + rank[1, r, c]
+
+            elif count_only == True:
+                num_triangles += int(band_slots(y0, y1)[3].sum())
+                continue
+            else:
+                top_corners, bottom_corners, rows, cols, tri_verts = band_triangles(y0, y1)
+                num_triangles += len(rows)
+                y_max = -np.arange(y0, y1) * self.cell_size + self.offsety
+                y_min = y_max - self.cell_size
+
+                # 8 verts (xyz) of each cell in this band
+                verts = np.empty((y1 - y0, nx, 8, 3))
+                verts[:, :, 0::2, 0] = x_min[None, :, None]
+                verts[:, :, 1::2, 0] = x_max[None, :, None]
+                verts[:, :, [0, 1, 4, 5], 1] = y_max[:, None, None]
+                verts[:, :, [2, 3, 6, 7], 1] = y_min[:, None, None]
+                for k, corners in enumerate((top_corners, bottom_corners)):
+                    verts[:, :, 4*k + 0, 2] = corners[:-1, :-1]
+                    verts[:, :, 4*k + 1, 2] = corners[:-1, 1: ]
+                    verts[:, :, 4*k + 2, 2] = corners[1:,  :-1]
+                    verts[:, :, 4*k + 3, 2] = corners[1:,  1: ]
+
+                # pull out the 3 verts of each triangle => (n, 3, 3)
+                tris = verts[rows[:, None], cols[:, None], tri_verts]
+                self.write_triangle_array_to_buffer(tris)
+
+            if (band_no + 1) * 10 // len(bands) > progress:
+                progress = (band_no + 1) * 10 // len(bands)
+                print(progress * 10, "%", multiprocessing.current_process(), memory_info(), file=sys.stderr)
+
+        return num_triangles, int(num_vertices)
+
+    def mesh_stripes(self, num_processes, cells_per_band=32768):
+        '''meshes horizontal stripes of the tile in parallel on a pool of num_processes worker processes, each with 
+        its own copy of this grid (see init_stripe_worker()). Stripes don't need any extra rows as the padded rasters 
+        already have the row above and below each cell row. The triangles (and obj vertices) of each stripe are 
+        counted first so each stripe knows the index of its first facet (STLb) or first vertex (obj), then the 
+        stripes are meshed and written in order, so the file is the same as from a single process.'''
+        ny = self.ymaxidx
+        fileformat = self.tile_info["fileformat"]
+        temp_file = self.tile_info.get("temp_file")
+
+        # more stripes than processes, as stripes with lots of NaN cells are quicker
+        num_stripes = min(ny, num_processes * 4)
+        stripes = [(ny * i // num_stripes, ny * (i + 1) // num_stripes) for i in range(num_stripes)]
+
+        # copy for the workers: no buffers or open files, workers return their stripe instead of writing it
+        # (except for STLb temp files where they write directly into their part of the file)
+        worker_grid = copy.copy(self)
+        worker_grid.tile_info = dict(self.tile_info, temp_file=None, CPU_cores_per_tile=None)
+        worker_grid.s = worker_grid.fo = worker_grid.facets = worker_grid.zip_stream = None
+
+        print(f"meshing {num_stripes} stripes with {num_processes} processes", file=sys.stderr)
+        mp = multiprocessing.get_context('spawn') # same as get_zipped_tiles()
+        with mp.Pool(processes=num_processes, initializer=init_stripe_worker, initargs=(worker_grid,)) as pool:
+            del worker_grid
+
+            # index of the first facet and first obj vertex of each stripe
+            num_facets, first_facet, first_id = [None] * num_stripes, [0] * num_stripes, [1] * num_stripes 
+            if fileformat == "STLb" or self.grid_indexed_obj == True:
+                counts = pool.map(count_stripe, [(y0, y1, cells_per_band) for y0, y1 in stripes])
+                num_facets = [c[0] for c in counts]
+                first_facet = np.concatenate(([0], np.cumsum(num_facets)))[:-1].tolist()
+                first_id = (1 + np.concatenate(([0], np.cumsum([c[1] for c in counts])))[:-1]).tolist()
+                if fileformat == "STLb":
+                    self.allocate_STLb(sum(num_facets) + (2 if self.use_simple_bottom() else 0))
+
+            # (a zip file member can only be written in order, so then the STLb facets come back like for a buffer)
+            STLb_file = temp_file if fileformat == "STLb" and isinstance(self.facets, np.memmap) else None
+            args = [(y0, y1, cells_per_band, first_id[i], first_facet[i], num_facets[i], STLb_file) 
+                    for i, (y0, y1) in enumerate(stripes)]
+            for buf, num_triangles, bottom_corner_ids in pool.imap(mesh_stripe, args): # in stripe order
+                if fileformat == "STLb":
+                    if buf is not None and self.facets is None: # zip stream
+                        self.fo.write(memoryview(buf).cast("B"))
+                    elif buf is not None: # None => was written into the temp file
+                        self.facets[self.num_triangles : self.num_triangles + num_triangles] = buf
+                elif fileformat == "STLa":
+                    self.s.write(buf)
+                else:
+                    self.s[0].write(buf[0])
+                    self.s[1].write(buf[1])
+                self.num_triangles += num_triangles
+                self.write_buffer_to_file(force=True)
+                self.bottom_corner_ids = [i if i is not None else j for i, j in zip(bottom_corner_ids, self.bottom_corner_ids)]
+
+    def write_triangle_array_to_buffer(self, tris):
+        '''write a (n, 3, 3) array of triangles (3 verts, each xyz) to stream buffer self.s (or for temp files,
+        directly to self.fo), see write_triangle_to_buffer(). STL only, a vectorized obj is written with grid indexed
+        vertices by create_triangle_arrays()'''
+
+        if self.tile_info["fileformat"] == "STLa":
+            normals = get_normals(tris) if self.tile_info["no_normals"] == False else np.zeros((len(tris), 3))
+            for tl in np.concatenate((normals, tris.reshape(-1, 9)), axis=1).tolist():
+                self.s.write(ASCII_FACET.format(face=tl))
+            self.num_triangles += len(tris)
+            self.write_buffer_to_file(force=True)
+            return
+
+        # STLb: fill a structured array with all facets and write its bytes as one block
+        # (or, if the file/buffer was allocated up front, fill its next facets in place)
+        if self.facets is not None:
+            facets = self.facets[self.num_triangles : self.num_triangles + len(tris)]
+            assert len(facets) == len(tris), "more triangles than allocated in allocate_STLb()"
+        else:
+            facets = np.zeros(len(tris), dtype=STLb_facet_dtype) # attribute byte count stays 0
+        facets["v"] = tris.reshape(-1, 9)
+        if self.tile_info["no_normals"] == False:
+            facets["normal"] = get_normals(tris)
+        self.num_triangles += len(tris)
+
+        if self.facets is not None:
+            return
+        elif self.tile_info.get("temp_file") is None:
+            self.s.write(memoryview(facets).cast("B"))
+        else:
+            self.write_buffer_to_file(force=True) # write anything that's still in the buffer first
+            self.fo.write(memoryview(facets).cast("B")) # (not tofile(), which needs a real file, not a zip stream)
+
     def write_triangle_to_buffer(self, t):
         '''write triangle vertices for triangle t to stream buffer self.s for caching.
         Once the cache is full, is is writting to disk (self.fo)'''
@@ -949,7 +1442,6 @@ class grid:
             self.s.write(struct.pack(BINARY_FACET, *tl)) # append to s
 
         elif self.tile_info["fileformat"] == "STLa":
-            ASCII_FACET ="""facet normal {face[0]:f} {face[1]:f} {face[2]:f}\nouter loop\nvertex {face[3]:f} {face[4]:f} {face[5]:f}\nvertex {face[6]:f} {face[7]:f} {face[8]:f}\nvertex {face[9]:f} {face[10]:f} {face[11]:f}\nendloop\nendfacet\n"""
             self.s.write(ASCII_FACET.format(face=tl))
 
         elif self.tile_info["fileformat"] == "obj":
@@ -962,17 +1454,18 @@ class grid:
         if self.tile_info["fileformat"] != "obj":  
             self.write_buffer_to_file()
             
-    def write_buffer_to_file(self, flush=False, chunk_size=100000):
+    def write_buffer_to_file(self, flush=False, chunk_size=100000, force=False):
         # write buffer to file every 10k triangles
         # chunksize is the number of triangles that need to have been collected into the buffer in order to actually write to disk. (cache)
         # flusk=True forces a write: use this to flush whatever is in the buffer.  Will NOT close the file!
+        # force=True also forces a write but leaves the buffer open (used when a whole array of triangles was added)
         # for obj, write only the indices [1], vertices [0] will be done later
         
         # Only write to file if we're actually using temp files, otherwise just bail out
         if self.tile_info.get("temp_file") is None:
             return
         
-        if self.num_triangles % chunk_size == 0  or flush == True:
+        if self.num_triangles % chunk_size == 0  or flush == True or force == True:
             if self.tile_info["fileformat"] == "STLb":
                 self.fo.write(self.s.getbuffer())   # append (partial) binary buffer to file
                 self.s.close()
@@ -982,6 +1475,10 @@ class grid:
                 self.s.close()
                 self.s = io.StringIO()
             elif self.tile_info["fileformat"] == "obj":
+                if self.grid_indexed_obj == True: # vertices are also written while meshing
+                    self.fo[0].write(self.s[0].getvalue())
+                    self.s[0].close()
+                    self.s[0] = io.StringIO()
                 self.fo[1].write(self.s[1].getvalue())
                 self.s[1].close()
                 self.s[1] = io.StringIO()
@@ -1217,8 +1714,59 @@ class grid:
         temp_file.write(buf)
         return temp_file
     '''
+    def use_simple_bottom(self):
+        '''Can we use 2-triangle bottoms?'''
+        add_simple_bottom = True # True by default, set to False if we can't create a 2-triangle bottom
+        
+        # We don't have bottom tris but that's OK as we don't them anyway (no_bottom option was set)
+        if self.tile_info["no_bottom"] == True: add_simple_bottom = False # 
+        
+        # With a NaN (masked) top array, we already have the corresponding full bottom
+        if self.tile_info["have_nan"] == True: add_simple_bottom = False 
+        
+        # with a bottom image/elevation, we also already need a full bottom
+        if self.tile_info["bottom_image"] != None or self.tile_info["bottom_elevation"] != None: 
+            add_simple_bottom = False
+
+        # obj files currently don't support simple bottoms
+        #if self.tile_info["fileformat"] == 'obj': add_simple_bottom = False
+        return add_simple_bottom
+
+    def allocate_STLb(self, num_facets):
+        '''For a known number of facets, write the STLb header and allocate the full file (or buffer, self.s).
+        self.facets is then a structured array (see STLb_facet_dtype) of the facets of that file (a np.memmap) or 
+        buffer (a view of the bytearray), which write_triangle_array_to_buffer() fills in place, so the facets are 
+        never copied into an intermediate buffer and the body never needs to be copied behind the header.
+        A zip stream (see make_file_buffer()) can't be allocated, so only its header is written and the 
+        facets are appended in order'''
+        header = struct.pack(BINARY_HEADER, b'Binary STL Writer', num_facets)
+        size = BINARY_HEADER_SIZE + num_facets * STLb_facet_dtype.itemsize
+        self.num_facets = num_facets
+
+        if self.zip_stream is not None:
+            self.fo.write(header)
+        elif self.tile_info.get("temp_file") is None:
+            self.s = bytearray(size) # all 0, so the normals (with no_normals) and attribute byte counts are already set 
+            self.s[:BINARY_HEADER_SIZE] = header
+            self.facets = np.frombuffer(self.s, dtype=STLb_facet_dtype, count=num_facets, offset=BINARY_HEADER_SIZE)
+        else:
+            self.fo.write(header)
+            self.fo.truncate(size) # extends the file with 0s 
+            self.fo.flush()
+            if num_facets > 0: # can't map 0 bytes
+                self.facets = np.memmap(self.fo, dtype=STLb_facet_dtype, mode="r+", offset=BINARY_HEADER_SIZE, shape=(num_facets,))
+            else:
+                self.facets = np.zeros(0, dtype=STLb_facet_dtype)
+
     # Convert grid into a file or memory buffer containing triangles (plus indices for obj)
-    def make_file_buffer(self):
+    def make_file_buffer(self, zip_stream=None):
+        '''zip_stream: for tiles with a temp file, None or a binary file object of a zip file member
+        (e.g. from zip_file.open(name, "w", force_zip64=True)) to write the file into instead of the temp file.
+        As a zip stream can only be written in order, this needs the number of STLb triangles to be known up 
+        front (vectorized_mesh), without it the STLb temp file is still made and then copied into the stream. 
+        For obj, only the triangle indices go into a temp file (.idx) as they are appended after all the vertices.
+        The stream is not closed.
+        returns the buffer, the name of the temp file or (if it was written into) the zip stream'''
         
         # check that we have a valid triangle file format
         if self.tile_info["fileformat"] not in ["obj", "STLa", "STLb"]:
@@ -1229,12 +1777,17 @@ class grid:
             temp_file = self.tile_info["temp_file"]
         else:
             temp_file = None # means: use memory
+            zip_stream = None
+
+        # write into the zip stream instead of the temp file (except for the placeholder header of STLb)
+        if self.tile_info["fileformat"] != "STLb" or self.tile_info.get("vectorized_mesh") == True:
+            self.zip_stream = zip_stream
 
         # Open in-memory stream buffers s 
         # s is used to collect the data that is eventually written into a proper file
         if self.tile_info["fileformat"] == "STLb":
             self.s = io.BytesIO()
-            mode = "ab"  # for using open() later
+            mode = "w+b"  # for using open() later (read/write for the header and for np.memmap)
         elif self.tile_info["fileformat"] == "STLa":
             self.s = io.StringIO() 
             mode = "a"
@@ -1244,7 +1797,20 @@ class grid:
             self.s = [io.StringIO(), io.StringIO()]
 
         # open temp file for appending, file object self.fo will be used in create_cells()
-        if temp_file != None:
+        # (text files are written into the zip stream through a utf-8 wrapper, without newline translation)
+        if self.zip_stream is not None:
+            if self.tile_info["fileformat"] == "STLb":
+                self.fo = self.zip_stream
+            elif self.tile_info["fileformat"] == "STLa":
+                self.fo = io.TextIOWrapper(self.zip_stream, encoding="utf-8", newline="")
+            else:
+                try:
+                    idxfo = open(temp_file + ".idx", mode)
+                except Exception as e:
+                    print("Error opening:", temp_file + ".idx", e, file=sys.stderr)
+                    return e
+                self.fo = [io.TextIOWrapper(self.zip_stream, encoding="utf-8", newline=""), idxfo]
+        elif temp_file != None:
             if self.tile_info["fileformat"] == "STLa" or self.tile_info["fileformat"] == "STLb":
                 try:
                     self.fo = open(temp_file, mode)
@@ -1268,34 +1834,30 @@ class grid:
                 self.fo = [vertsfo, idxfo]
 
         # header for STLa and obj
-        # (STLb header can only pre-pended later)
-        if self.tile_info["fileformat"] == "STLa":
+        # (STLb header: for vectorized meshing the number of triangles is known up front (see allocate_STLb()), 
+        # otherwise use a placeholder that is overwritten at the end)
+        if self.tile_info["fileformat"] == "STLb" and self.tile_info.get("vectorized_mesh") != True:
+            self.s.write(bytes(BINARY_HEADER_SIZE))
+        elif self.tile_info["fileformat"] == "STLa":
             self.s.write('solid digital_elevation_model\n') # digital_elevation_model is the name of the model
         elif self.tile_info["fileformat"] == "obj":
             self.s[0].write("g vert\n")
             self.s[1].write("g tris\n")
 
-        # populate self.cells, will write triangles into buffer/file
-        self.create_cells()
-
-        # Can we use 2-triangle bottoms?
-        add_simple_bottom = True # True by default, set to False if we can't create a 2-triangle bottom
-        
-        # We don't have bottom tris but that's OK as we don't them anyway (no_bottom option was set)
-        if self.tile_info["no_bottom"] == True: add_simple_bottom = False # 
-        
-        # With a NaN (masked) top array, we already have the corresponding full bottom
-        if self.tile_info["have_nan"] == True: add_simple_bottom = False 
-        
-        # with a bottom image/elevation, we also already need a full bottom
-        if self.tile_info["bottom_image"] != None or self.tile_info["bottom_elevation"] != None: 
-            add_simple_bottom = False
-
-        # obj files currently don't support simple bottoms
-        #if self.tile_info["fileformat"] == 'obj': add_simple_bottom = False
+        # make cells (or triangle arrays) a row (band) at a time, will write triangles into buffer/file
+        if self.tile_info.get("vectorized_mesh") == True:
+            self.create_triangle_arrays()
+        else:
+            self.create_cells()
 
         # For simple bottom, add 2 triangles based on the corners of the tile
-        if add_simple_bottom:
+        add_simple_bottom = self.use_simple_bottom()
+        if add_simple_bottom and self.grid_indexed_obj == True:
+            # use the bottom corners of the grid, their v lines have already been written
+            i = self.bottom_corner_ids # (W,N), (E,N), (W,S), (E,S) 
+            self.s[1].write(f"f {i[2]}, {i[1]}, {i[3]}\nf {i[2]}, {i[0]}, {i[1]}\n")
+            self.num_triangles += 2
+        elif add_simple_bottom:
             v0 = vertex(self.tile_info["W"], self.tile_info["S"], 0)
             v1 = vertex(self.tile_info["E"], self.tile_info["S"], 0)
             v2 = vertex(self.tile_info["E"], self.tile_info["N"], 0)
@@ -1304,8 +1866,11 @@ class grid:
             t0 = (v0, v2, v1) #A
             t1 = (v0, v3, v2) #B
 
-            self.write_triangle_to_buffer(t0) #
-            self.write_triangle_to_buffer(t1)
+            if self.facets is not None: # preallocated STLb
+                self.write_triangle_array_to_buffer(np.array([[v.get() for v in t] for t in (t0, t1)]))
+            else:
+                self.write_triangle_to_buffer(t0) #
+                self.write_triangle_to_buffer(t1)
 
         # using buffer 
         if temp_file is None: 
@@ -1315,21 +1880,26 @@ class grid:
                 self.s.write('endsolid digital_elevation_model') # append end clause
                 buf = self.s.getvalue()
 
-            # For STLb buffer, prepend the header
+            # For STLb buffer, fill in the header (the preallocated bytearray is already complete)
             if self.tile_info["fileformat"] == "STLb":
-                BINARY_HEADER = "80sI" # up to 80 chars do NOT start with the word solid + number of faces as UINT32
-                stlb_header = io.BytesIO()
-                stlb_header.write(struct.pack(BINARY_HEADER, b'Binary STL Writer', self.num_triangles))
-                stlb_header.write(self.s.getbuffer()) # append body to header
+                if self.facets is not None:
+                    assert self.num_triangles == len(self.facets), "fewer triangles than allocated in allocate_STLb()"
+                    self.facets = None
+                    buf = self.s
+                else:
+                    with self.s.getbuffer() as view:
+                        view[:BINARY_HEADER_SIZE] = struct.pack(BINARY_HEADER, b'Binary STL Writer', self.num_triangles)
+                    buf = self.s.getvalue()  # CH 5/2025 changed from getbuffer to not return a memory object that c an't be pickled  
                 del self.s # no longer needed
-                buf = stlb_header.getvalue()  # CH 5/2025 changed from getbuffer to not return a memory object that c an't be pickled  
 
             # fill s[0] and append s[1]
             elif self.tile_info["fileformat"] == "obj":
                 # fill s[0] with all vertices used (keys of vertex class attribute dict)
+                # (grid indexed vertices are already in s[0])
                 print("Appending obj triangle indices\n", file=sys.stderr)
-                for vc in vertex.vertex_index_dict:
-                    self.s[0].write(f"v {vc[0]}, {vc[1]}, {vc[2]}\n")
+                if self.grid_indexed_obj == False:
+                    for vc in vertex.vertex_index_dict:
+                        self.s[0].write(f"v {vc[0]}, {vc[1]}, {vc[2]}\n")
                 
                 self.s[0].write(self.s[1].getvalue()) # append indices
                 del self.s[1]
@@ -1337,6 +1907,33 @@ class grid:
 
             return buf
         
+        # using zip stream
+        elif self.zip_stream is not None:
+            self.write_buffer_to_file(flush=True) # write leftover buffer to the stream
+
+            if self.tile_info["fileformat"] == "STLa":
+                self.fo.write('endsolid digital_elevation_model') 
+                self.fo.detach() # flushes the wrapper, but does not close the stream
+            elif self.tile_info["fileformat"] == "STLb":
+                assert self.num_triangles == self.num_facets, "fewer triangles than allocated in allocate_STLb()"
+            elif self.tile_info["fileformat"] == "obj":
+                print("Appending obj triangle indices\n", file=sys.stderr)
+                if self.grid_indexed_obj == False:
+                    for vc in vertex.vertex_index_dict:
+                        self.fo[0].write(f"v {vc[0]}, {vc[1]}, {vc[2]}\n")
+                self.fo[1].close()
+
+                # append index temp file to the vertices in the stream
+                idx_temp_file = temp_file + ".idx"
+                with open(idx_temp_file, "r") as idx_fo:
+                    shutil.copyfileobj(idx_fo, self.fo[0])
+                self.fo[0].detach()
+                os.remove(idx_temp_file)
+
+            self.fo = None
+            zip_stream, self.zip_stream = self.zip_stream, None
+            return zip_stream
+
         # using temp file
         else:
             self.write_buffer_to_file(flush=True) # write leftover buffer to file, will NOT close fo!
@@ -1346,26 +1943,34 @@ class grid:
                 self.fo.write('endsolid digital_elevation_model') 
                 self.fo.close()
 
-            # for binary STL we can only now prepend a header as we didn't have num_triangles until now.
+            # for binary STL, flush the memmap of the preallocated file or overwrite the placeholder header, 
+            # as we didn't have num_triangles until now.
             elif self.tile_info["fileformat"] == "STLb":
-                # rename curent file so we can append it to the header file
+                if self.facets is not None:
+                    assert self.num_triangles == len(self.facets), "fewer triangles than allocated in allocate_STLb()"
+                    if isinstance(self.facets, np.memmap):
+                        self.facets.flush()
+                    self.facets = None
+                else:
+                    self.fo.seek(0)
+                    self.fo.write(struct.pack(BINARY_HEADER, b'Binary STL Writer', self.num_triangles))
                 self.fo.close()
-                body_file = temp_file + ".body"
-                os.replace(temp_file, body_file)
-                with open(body_file, "rb") as fbody:
-                    with open(temp_file, "ab") as fheader: # new temp_file
-                        BINARY_HEADER = "80sI" # up to 80 chars do NOT start with the word solid + number of faces as UINT32
-                        fheader.write(struct.pack(BINARY_HEADER, b'Binary STL Writer', self.num_triangles))
-                        shutil.copyfileobj(fbody, fheader) # append the body to the header
-                os.remove(body_file)
+
+                # the placeholder header can't be overwritten in a zip stream, so copy the finished file into it
+                if zip_stream is not None:
+                    with open(temp_file, "rb") as fi:
+                        shutil.copyfileobj(fi, zip_stream)
+                    os.remove(temp_file)
+                    return zip_stream
             
             # For obj the the fo[0] temp file (vertices) must be filled, then the
             # .idx temp file needs to be appended to i 
             elif self.tile_info["fileformat"] == "obj":
-                # fill vertex temp file
+                # fill vertex temp file (grid indexed vertices are already in it)
                 print("Appending obj triangle indices\n", file=sys.stderr)
-                for vc in vertex.vertex_index_dict:
-                    self.fo[0].write(f"v {vc[0]}, {vc[1]}, {vc[2]}\n")
+                if self.grid_indexed_obj == False:
+                    for vc in vertex.vertex_index_dict:
+                        self.fo[0].write(f"v {vc[0]}, {vc[1]}, {vc[2]}\n")
                 self.fo[0].close()
                 self.fo[1].close()
 
@@ -1382,6 +1987,55 @@ class grid:
        
 
 
+# stripe workers for grid.mesh_stripes()
+stripe_grid = None # copy of the grid, set for each worker process
+
+def init_stripe_worker(g):
+    global stripe_grid
+    stripe_grid = g
+
+def count_stripe(stripe):
+    '''returns the number of triangles and obj vertices of the stripe (y0, y1, cells_per_band)'''
+    y0, y1, cells_per_band = stripe
+    return stripe_grid.mesh_rows(y0, y1, cells_per_band, count_only=True)
+
+def mesh_stripe(stripe):
+    '''meshes the stripe (y0, y1, cells_per_band, index of its first obj vertex, index of its first STLb facet, 
+    its number of STLb facets, STLb temp file or None).
+    returns the stripe's buffer (STLb: array of facets or None if written into the temp file, obj: vertices 
+    and indices), its number of triangles and its obj bottom_corner_ids'''
+    y0, y1, cells_per_band, first_id, first_facet, num_facets, temp_file = stripe
+    g = stripe_grid
+    g.num_triangles = 0
+    g.bottom_corner_ids = [None] * 4 
+    fileformat = g.tile_info["fileformat"]
+
+    if fileformat == "STLb":
+        if temp_file is not None and num_facets > 0: # write into the stripe's part of the preallocated temp file 
+            offset = BINARY_HEADER_SIZE + first_facet * STLb_facet_dtype.itemsize
+            g.facets = np.memmap(temp_file, dtype=STLb_facet_dtype, mode="r+", offset=offset, shape=(num_facets,))
+        else:
+            g.facets = np.zeros(num_facets, dtype=STLb_facet_dtype)
+    elif fileformat == "STLa":
+        g.s = io.StringIO()
+    else:
+        g.s = [io.StringIO(), io.StringIO()]
+
+    g.mesh_rows(y0, y1, cells_per_band, first_id=first_id)
+
+    if fileformat == "STLb":
+        buf = g.facets
+        if isinstance(buf, np.memmap):
+            buf.flush()
+            buf = None
+        g.facets = None
+    elif fileformat == "STLa":
+        buf = g.s.getvalue()
+    else:
+        buf = (g.s[0].getvalue(), g.s[1].getvalue())
+    g.s = None
+    return buf, g.num_triangles, g.bottom_corner_ids
+
  
 # MAIN  (left this in so I can test stuff, most of it is however outdated and would need to be fixed ...)
 
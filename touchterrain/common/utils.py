@@ -4,12 +4,24 @@ import numpy
 import imageio
 import scipy.stats as stats
 from scipy import ndimage  
-from scipy.ndimage import binary_dilation, generic_filter
+from scipy.ndimage import binary_dilation
+from scipy import sparse
 import os.path
+import sys
 import k3d
 import random
 from glob import glob
 import zipfile
+import io
+import zlib
+import hashlib
+import json
+import tempfile
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import matplotlib.colors as mcolors
@@ -23,17 +35,23 @@ def save_tile_as_image(tile, name):
     imageio.imsave(name + '.png', tile_elev_raster_mask.astype(numpy.uint8))
 
 
-def clean_up_diags(ras):
+def clean_up_diags(ras, band_pool=None):
     '''clean up diagonal cells as these lead to non-manifold vertices where they meet
     These are defined as either  0 1   or   1 0  where 0 == NaN and 1 == non-NaN)
                                  1 0        0 1
 
-    The operation uses a  binary hit & miss operation to identify these patterns and
-    subtraction to removed one of the two. Then the mask is flipped to catch the other pattern
+    Each round, all  1 0  patterns are found (like a binary hit & miss operation) and their upper-left 1 is set to 0,
+                     0 1
+    then all  0 1  patterns (in the changed mask) are found and their upper-right 1 is set to 0.
+              1 0
+    This is repeated until no new changes occur any more. The first round checks all 2 x 2 windows of the raster,
+    but a window can only get a new pattern if one of its cells was changed since it was last checked, so later
+    rounds only check the windows around the cells changed in the previous round.
 
-    This is repeated until no new changes occur any more.
+    With a band_pool (see BandPool), the rounds are done on row bands of a large raster in parallel.
 
-    returns changed ras
+    returns changed ras (as float64, or float32 for a float32 raster, with the removed cells set to NaN) or ras itself if 
+    there was nothing to clean up
 
     Example of mask data:
     mask = np.array([[0, 0, 1, 0],
@@ -47,70 +65,88 @@ def clean_up_diags(ras):
     if not numpy.any(numpy.isnan(ras)):
         return ras
 
-    cnt = 0
-    #save_tile_as_image(ras, "before")
-    while True:
-
-        print("Diagonal pattern cleanup, round: ", cnt)
-        # make a (inverse) mask raster (where 1 == NaN and 0 == non-NaN) (initially a bool raster)
-        # invert it, and cast to int. This is a binary mask that we'll query for diagonal patterns and
-        # modify accordingly (turn half the pattern from 1 to 0)
-        mask = numpy.invert(numpy.isnan(ras)).astype(numpy.int8) # int8 is the cheapest possible int in numpy
-
-        # how many 0s and 1s do we have before the potential cleanup?
-        unique_pre, counts_pre = numpy.unique(mask, return_counts=True)
-        pre = dict(zip(unique_pre, counts_pre))
-        print("pre-cleanup masks stats: ", pre)
-
-        # if the dictionary has only 1 key, we're done as there are either no NaNs or only NaNs
-        if len(pre) == 1:
-            print("only one type of cell in raster, no cleanup needed")
-            return ras
-
-        p = numpy.array([[1, 0],
-                         [0, 1]]) # pattern to detect with hit-or-miss
-
-        #print(mask, "input raster")
-        hm = ndimage.binary_hit_or_miss(mask, structure1=p, origin1=-1).astype(numpy.int8) # shift origin to upper left corner
-        # hm will have 1s where the upper-left 1 of the first pattern are
-
-        #print(hm, "hit or miss with\n", p)
-        mask = mask - hm # subtract hit-or-miss results to change the location of upper left pattern cell from in the mask 1 to 0
-        #print(mask, "raster after 1. subtraction")
-
-        # flip the mask vertically to catch the inverse of the pattern p and again set its upper-left 1 to 0
-        mask = numpy.flip(mask, axis=1) #  flip
-        #print(mask, "raster flipped before 2. subtraction")
-        hm = ndimage.binary_hit_or_miss(mask, structure1=p, origin1=-1).astype(numpy.int8) # shift origin to upper left corner
-        #print(hm, "hit or miss with")
-        #print(p)
-        mask = mask - hm
-        #print(mask, "raster flipped after 2. subtraction")
-        mask = numpy.flip(mask, axis=1) #  flip back
-        #print(mask, "final raster")
-
-        # how many 0s and 1s do we have after the cleanup?
-        unique_post, counts_post = numpy.unique(mask, return_counts=True)
-        post = dict(zip(unique_post, counts_post))
-        print("post-cleanup masks stats:", post)
-
-        # convert 0 to NaN so we can use the 0s in the mask to create NaN cells in the DEM raster
-        mask = numpy.where(mask == 0, numpy.nan, 1)
-        #print(mask, "after 0 => NaN")
-
-        # multiply mask with original DEM raster
-        ras = ras * mask
-
-        # if there was not change, we're done, otherwise, run another round.
-        if (pre[0] == post[0]) and (pre[1] == post[1]):
-            #save_tile_as_image(ras, "after")
-            return ras
-
-        cnt += 1 # next round
-
-
+    # mask raster where 1 (True) == non-NaN and 0 == NaN
+    mask = ~numpy.isnan(ras)
+    num_valid = numpy.count_nonzero(mask)
+    print("pre-cleanup masks stats: ", {0: mask.size - num_valid, 1: num_valid})
+    if num_valid == 0:
+        print("only one type of cell in raster, no cleanup needed")
+        return ras
+    ny, nx = mask.shape
+    if ny < 2 or nx < 2: # no 2 x 2 windows
+        return ras.astype(float_dtype(ras))
+
+    if band_pool is not None and band_pool.num_bands(ras) > 1: # in parallel, on row bands of the raster
+        del mask
+        # a change can only spread 2 rows up per round (1 per pattern), so 2 halo rows per round
+        out, num_removed = iterate_row_bands(band_pool, clean_up_diags_band, ras, -1, halo_per_round=2, dtype=float_dtype(ras))
+        print("Diagonal pattern cleanup:", len(num_removed), "rounds,", sum(num_removed), "cells set to NaN")
+        return out
 
-def fillHoles(raster, num_iters=-1,  num_neighbors=7, NaN_are_holes=False):
+    num_removed = remove_diag_patterns(mask)
+    print("Diagonal pattern cleanup:", len(num_removed), "rounds,", sum(num_removed), "cells set to NaN")
+
+    # set the removed cells to NaN (as float, as when the raster is multiplied with a 1/NaN mask)
+    out = map_row_blocks(lambda rows: rows.astype(float_dtype(ras)), [ras])
+    out[~mask] = numpy.nan
+    return out
+
+def remove_diag_patterns(mask, max_rounds=None, counted_rows=slice(None)):
+    '''the rounds of clean_up_diags() on the (bool) mask, which is changed in place. Stops after a round without 
+    changes or after max_rounds rounds. 
+    returns a list with the number of cells removed in each round (only those in counted_rows)'''
+    ny, nx = mask.shape
+    if ny < 2 or nx < 2: # no 2 x 2 windows
+        return [0]
+
+    def windows_around(ys, xs):
+        '''upper-left corners (ys, xs) of all 2 x 2 windows that contain any of the cells (ys, xs)'''
+        wy = numpy.clip(numpy.concatenate([ys - 1, ys - 1, ys, ys]), 0, ny - 2)
+        wx = numpy.clip(numpy.concatenate([xs - 1, xs, xs - 1, xs]), 0, nx - 2)
+        w = numpy.unique(wy * (nx - 1) + wx)
+        return w // (nx - 1), w % (nx - 1)
+
+    def remove(windows, anti):
+        '''find the pattern in the windows (None: all windows, else their upper-left corners (wy, wx)), 
+        set its upper-left (anti: upper-right) 1 to 0 and return the cells that were changed'''
+        if windows is None: # slices of the whole mask
+            ul, ur, ll, lr = mask[:-1, :-1], mask[:-1, 1:], mask[1:, :-1], mask[1:, 1:]
+        else:
+            wy, wx = windows
+            ul, ur, ll, lr = mask[wy, wx], mask[wy, wx + 1], mask[wy + 1, wx], mask[wy + 1, wx + 1]
+        if anti == False:
+            hit = ul & ~ur & ~ll & lr
+        else:
+            hit = ur & ~ul & ~lr & ll
+        if windows is None:
+            ys, xs = numpy.nonzero(hit)
+        else:
+            ys, xs = wy[hit], wx[hit]
+        if anti == True:
+            xs = xs + 1
+        mask[ys, xs] = False # all hits are removed at once, as they were found in the same mask
+        return ys, xs
+
+    first, last, _ = counted_rows.indices(ny)
+    num_removed = []
+    changed = [None, None] # cells changed by each pattern since its windows were last checked
+    while max_rounds is None or len(num_removed) < max_rounds:
+        for anti in (False, True):
+            windows = None # first round (or lots of changes): check all windows
+            if len(num_removed) > 0: # check only the windows around the cells changed since the last check
+                ys = numpy.concatenate([c[0] for c in changed if c is not None])
+                xs = numpy.concatenate([c[1] for c in changed if c is not None])
+                if len(ys) * 4 < mask.size // 8: 
+                    windows = windows_around(ys, xs)
+            changed[anti] = remove(windows, anti)
+        ys = numpy.concatenate([changed[0][0], changed[1][0]])
+        num_removed.append(int(numpy.count_nonzero((ys >= first) & (ys < last))))
+        if len(ys) == 0: # no change, we're done
+            break
+    return num_removed
+
+
+def fillHoles(raster, num_iters=-1,  num_neighbors=7, NaN_are_holes=False, band_pool=None):
     """Fills holes in a raster by replacing neagtive elevation values with the average elevation of its neighbors.
     If NaN_are_holes is set to True, NaN values will be filled instead of negative values. Does not fill holes on the edges of the raster.
      
@@ -118,6 +154,7 @@ def fillHoles(raster, num_iters=-1,  num_neighbors=7, NaN_are_holes=False):
         raster (ndarray): The input raster array.
         num_iters (int, optional): The number of iterations to perform. Defaults to -1, which means iterate until no more holes are filled.
         num_neighbors (int, optional): The threshold for the number of neighbors with >= 0 elevation values to consider a hole. Must be in the range [1, 9]. Defaults to 7.
+        band_pool (BandPool, optional): if given, the rounds are done on row bands of a large raster in parallel. Same result.
     Returns:
         ndarray: The raster array with holes filled.
     Raises:
@@ -137,36 +174,43 @@ def fillHoles(raster, num_iters=-1,  num_neighbors=7, NaN_are_holes=False):
         print("fill_holes neighbor threshold must be in range of [1,9] for 3x3 footprint. Defaulting to 7.")
         num_neighbors = 7
 
+    # Instead of running a python callback on every pixel (ndimage.generic_filter()) each round, gather the 3x3 
+    # neighborhoods of the remaining holes only. Like generic_filter(mode='nearest'), neighbors outside the raster 
+    # are the nearest edge cell and all holes of a round are filled from the raster of the previous round.
+    # A hole is a cell that's not > 0 (incl. NaN) or, for NaN_are_holes, a NaN cell. 
+    def is_hole(values):
+        if NaN_are_holes == True:
+            return numpy.isnan(values)
+        return ~(values > 0)
+
+    if band_pool is not None and band_pool.num_bands(raster) > 1: # in parallel, on row bands of the raster
+        raster, num_filled = iterate_row_bands(band_pool, fill_holes_band, raster, num_iters, halo_per_round=1,
+                                               args=(num_neighbors, NaN_are_holes))
+        for round, holesFilled in enumerate(num_filled, 1):
+            print(f"Round {round}: {holesFilled} holes filled.")
+        return raster
+
+    if is_memmap(raster): # out-of-core raster, fill it in blocks of rows instead
+        return fill_holes_by_rows(raster, num_iters, num_neighbors, NaN_are_holes, is_hole)
+
     round = 1
     holesFilledLastRound = 1
+    holes = None
     while (holesFilledLastRound > 0) and (num_iters == -1 or num_iters > 0):
         holesFilledLastRound = 0
         if num_iters > 0: # i.e not infinite
             num_iters -= 1
 
-        def checkForAndFillHole(values):
-            nonlocal holesFilledLastRound
-            # Check to see if there is a hole in the center with elevation of 0
-            if values[4] > 0 or (NaN_are_holes == True and ~numpy.isnan(values[4])):
-                return values[4]
-
-            # Count number of neighbors with elevations > 0
-            neighborsGreaterThanZero = len(values[values > 0])
-
-            # If 7 out of 8 neighbors are filled, fill the hole with the average.
-            # This can be set to 8 out of 8 neighbors to only fill completely enclosed holes.
-            # 7 out of 8 neighors allows cascading fills to solve diagonal holes and narrow 1xn length holes on repeating iterations.
-            if neighborsGreaterThanZero >= num_neighbors:
-                holesFilledLastRound += 1
-                #print(values.reshape(3, 3))
-                return numpy.nanmean(values)
-            return values[4]
-
-        footprint = numpy.array([[1,1,1],
-                                 [1,1,1],
-                                 [1,1,1]])
-        
-        raster = ndimage.generic_filter(raster, checkForAndFillHole, footprint=footprint, mode='nearest')
+        if holes is None:
+            raster = raster.copy() # don't change the input raster (generic_filter also returned a new raster)
+            holes = numpy.nonzero(is_hole(raster))
+        hy, hx = holes
+
+        # Count number of neighbors with elevations > 0
+        # If 7 out of 8 neighbors are filled, fill the hole with the average.
+        # This can be set to 8 out of 8 neighbors to only fill completely enclosed holes.
+        # 7 out of 8 neighors allows cascading fills to solve diagonal holes and narrow 1xn length holes on repeating iterations.
+        holesFilledLastRound = fill_holes_once(raster, hy, hx, num_neighbors)
         #print(raster)
 
         if num_iters != -1:
@@ -181,10 +225,81 @@ def fillHoles(raster, num_iters=-1,  num_neighbors=7, NaN_are_holes=False):
             for i, j in corners:
                     raster[i, j] = 0 if raster[i, j] < 0 else raster[i, j]
 
+        # only holes can change, so the holes of the next round are the ones that are still holes (unfilled or e.g. filled with a mean <= 0)
+        if holesFilledLastRound > 0:
+            still_hole = is_hole(raster[hy, hx])
+            holes = (hy[still_hole], hx[still_hole])
+
+
+    return raster
+
+def fill_holes_once(raster, hy, hx, num_neighbors):
+    '''fill the holes (hy, hx) of raster that have at least num_neighbors neighbors > 0 with the nanmean of their
+    3 x 3 neighborhood (all from the values before any hole was filled). Returns the number of filled holes'''
+    values = gather_3x3(raster, hy, hx)
+    fill = numpy.count_nonzero(values > 0, axis=0) >= num_neighbors
+    num_filled = int(numpy.count_nonzero(fill))
+    if num_filled > 0:
+        raster[hy[fill], hx[fill]] = nanmean_3x3(values[:, fill])
+    return num_filled
+
+def fill_holes_by_rows(raster, num_iters, num_neighbors, NaN_are_holes, is_hole, rows_per_block=1024):
+    '''fillHoles() for a memmap raster: each round is done on blocks of rows (plus the row above and below, for the 
+    3 x 3 neighborhoods) and written into another memmap, so, as in fillHoles(), all holes of a round are filled from 
+    the raster of the previous round. Only two memmaps are used, they swap roles after each round.
+    returns the filled raster (a new memmap) or raster itself if no round was done'''
+    ny = raster.shape[0]
+    buffers = [None, None]
+    round = 1
+    holesFilledLastRound = 1
+    while (holesFilledLastRound > 0) and (num_iters == -1 or num_iters > 0):
+        holesFilledLastRound = 0
+        if num_iters > 0: # i.e not infinite
+            num_iters -= 1
+
+        i = (round - 1) % 2
+        if buffers[i] is None:
+            buffers[i] = new_memmap_raster(raster.shape, raster.dtype, os.path.dirname(raster.filename))
+        out = buffers[i]
+        for y0 in range(0, ny, rows_per_block):
+            y1 = min(y0 + rows_per_block, ny)
+            h0, h1 = max(y0 - 1, 0), min(y1 + 1, ny)
+            block = numpy.array(raster[h0:h1])
+            hy, hx = numpy.nonzero(is_hole(block[y0 - h0:y1 - h0])) # holes of the block without the extra rows
+            holesFilledLastRound += fill_holes_once(block, hy + (y0 - h0), hx, num_neighbors)
+            out[y0:y1] = block[y0 - h0:y1 - h0]
+        print(f"Round {round}: {holesFilledLastRound} holes filled.")
+        round += 1
 
+        # fill negative values in the corners with 0 (nothing to do for NaN_are_holes)
+        if NaN_are_holes == False:
+            for cy, cx in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
+                out[cy, cx] = 0 if out[cy, cx] < 0 else out[cy, cx]
+        raster = out
     return raster
 
 
+def gather_3x3(raster, ys, xs):
+    '''returns the 3x3 neighborhoods of the cells (ys, xs) of raster as float64 array of shape (9, number of cells), 
+    in the same order (row by row) and with the same edge handling as ndimage.generic_filter() with a 3x3 footprint 
+    and mode 'nearest' (or 'reflect', which is the same for 1 cell beyond the edge)'''
+    ny, nx = raster.shape
+    values = numpy.empty((9, len(ys)))
+    for i, (dy, dx) in enumerate([(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]):
+        values[i] = raster[numpy.clip(ys + dy, 0, ny - 1), numpy.clip(xs + dx, 0, nx - 1)]
+    return values
+
+def nanmean_3x3(values):
+    '''numpy.nanmean() of each column of the (9, n) values from gather_3x3() (NaN if all are NaN). 
+    The values are summed up in the same order as numpy.sum() does it (pairwise, 8 at a time), so the means 
+    are bit-identical to calling nanmean() on each 3x3 neighborhood'''
+    not_nan = ~numpy.isnan(values)
+    v = numpy.where(not_nan, values, 0)
+    total = ((v[0] + v[1]) + (v[2] + v[3])) + ((v[4] + v[5]) + (v[6] + v[7])) + v[8]
+    with numpy.errstate(invalid="ignore", divide="ignore"): # all NaN => 0/0 => NaN
+        return total / numpy.count_nonzero(not_nan, axis=0)
+
+
 def add_to_stl_list(stl, stl_list):
     stl_list.append(stl)
     return stl_list
@@ -208,7 +323,7 @@ def k3d_render_to_html(stl_list, folder, buffer=False):
             buf = fp.read()
             fp.close()
         else:
-            buf = stl
+            buf = bytes(stl) if isinstance(stl, bytearray) else stl # binary STL buffers of vectorized meshing are bytearrays
 
         random_color = random.choice(list(color_mapping.values()))
         plot += k3d.stl(buf, color=random_color) 
@@ -303,10 +418,18 @@ def plot_DEM_histogram(npim, DEM_name, temp_folder):
     return plot_file_name
 
 
-def dilate_array(raster, dilation_source=None):
+def dilate_array(raster, dilation_source=None, band_pool=None):
     '''Will dilate raster (1 cell incl diagonals) with the corresponding cell values of the dilation_source.
     If dilation_source is None the dilation will be filled with the 3 x 3 nanmean
+    With a band_pool (see BandPool), row bands of a large raster are dilated in parallel.
     returns the dilated raster'''
+
+    if band_pool is not None and band_pool.num_bands(raster) > 1: # in parallel, on row bands (plus the row above and below)
+        rasters = [raster] if dilation_source is None else [raster, dilation_source]
+        return map_row_bands(band_pool, dilate_band, rasters, halo=1, dtype=numpy.result_type(*rasters))[0]
+
+    if is_memmap(raster): # out-of-core raster: dilate blocks of rows (plus the row above and below)
+        return map_row_blocks(dilate_array, [raster] if dilation_source is None else [raster, dilation_source], halo=1)
     
     if dilation_source is not None:
         
@@ -345,24 +468,998 @@ def dilate_array(raster, dilation_source=None):
         # [ True  True False False]
         # [False False False False]]
 
-        
-        def nanmean(data):# if all are NaN return NaN, else return nanmean
-            return np.nan if np.all(np.isnan(data)) else np.nanmean(data) # 
-    
-        # Compute the 3x3 (nan) mean for each cell in ras, ignoring partial NaNs
-        mean_ras =  generic_filter(raster, nanmean, size=(3, 3))
-        # [[nan 1.7 2.2 2.3]
-        #  [9.3 6.8 6.1 5.7]
-        #  [9.3 9.  9.1 9. ]]
-
-        # Create a new array where the mean is applied to the cells selected by unequal_mask = True
-        out = np.where(unequal_mask, mean_ras, raster)
+
+        # Compute the 3x3 (nan) mean, ignoring partial NaNs, only for the cells selected by unequal_mask = True
+        # (instead of for every cell, with a python callback via generic_filter)
+        ys, xs = np.nonzero(unequal_mask)
+        out = raster.copy()
+        out[ys, xs] = nanmean_3x3(gather_3x3(raster, ys, xs))
         # [[ nan  1.7  1.   2. ]
         #  [ 9.3  6.8  3.   4. ]
         #  [ 9.  10.  11.  12. ]]
         
         return out
 
+def area_weights(n, m):
+    '''sparse (m, n) matrix with the area weights of n source cells for m resampled cells along an axis:
+    the part of each source cell that is covered by the footprint of a resampled cell (0 - 1)'''
+    edges = numpy.arange(m + 1) * n / m # footprint edges in source cells
+    first = numpy.minimum(edges[:-1].astype(numpy.int64), n - 1) # first source cell of each footprint
+    span = int(numpy.ceil(n / m)) + 1 # max. number of source cells per footprint
+    rows = numpy.repeat(numpy.arange(m), span)
+    cols = (first[:, None] + numpy.arange(span)).ravel()
+    weights = numpy.minimum(cols + 1, edges[rows + 1]) - numpy.maximum(cols, edges[rows])
+    used = (cols < n) & (weights > 0)
+    return sparse.csr_matrix((weights[used], (rows[used], cols[used])), shape=(m, n))
+
+def bilinear_weights(n, m):
+    '''sparse (m, n) matrix with the linear interpolation weights of n source cells for m (>= n) up-sampled cells 
+    along an axis, between the centers of the 2 closest source cells (as PIL's bilinear resize, the up-sampled cells
+    beyond the outer source cell centers get the outer source cells)'''
+    centers = numpy.clip((numpy.arange(m) + 0.5) * n / m - 0.5, 0, n - 1) # in source cells
+    left = numpy.minimum(centers.astype(numpy.int64), n - 1)
+    right = numpy.minimum(left + 1, n - 1)
+    w = centers - left
+    rows = numpy.concatenate([numpy.arange(m), numpy.arange(m)])
+    return sparse.csr_matrix((numpy.concatenate([1 - w, w]), (rows, numpy.concatenate([left, right]))), shape=(m, n))
+
+def resample_rasters(rasters, factor, rows_per_chunk=256, new_shape=None, out=None, rows=None, band_pool=None):
+    '''Resample one or more aligned rasters (same shape) by a down(!) sample factor, 2.0 will reduce the number 
+    of cells in x and y to 50%, or to new_shape (rows, columns), if given.
+    Each resampled cell is the area weighted average of the source cells under its footprint, source cells
+    cut by the footprint border count with their covered fraction (for integer factors, footprints are just blocks
+    of source cells). This is done as two (sparse) matrix products with the area weights of the rows and columns.
+    NaN cells are ignored in the average, a resampled cell becomes NaN if less than half of its footprint is valid.
+    Up-sampling (factor < 1, i.e. more cells in x and y) interpolates bilinearly instead (see bilinear_weights()), 
+    with the same matrix products. There, NaN cells are ignored by dividing by the interpolated weight of the valid
+    cells, a cell becomes NaN if that's less than half.
+    The rasters are processed together in chunks of rows_per_chunk resampled rows, so apart from the resampled 
+    rasters only the source rows of a chunk are copied. The rasters can also be BandRows, which read the 
+    source rows of a chunk from disk.
+    out: None or a list of (e.g. memmap) rasters of the resampled shape to write the resampled rasters into
+    rows: None or (first, last) resampled rows, only these rows are made (and out only has these rows)
+    band_pool: None or a BandPool, to resample bands of chunks of (in-memory) rasters in parallel
+    returns a list of the resampled rasters (float32 for float32 rasters, otherwise float64)'''
+    ny, nx = rasters[0].shape
+    if new_shape is None:
+        new_shape = int(ny / float(factor)), int(nx / float(factor))
+    new_ny, new_nx = max(new_shape[0], 1), max(new_shape[1], 1)
+    first, last = rows if rows is not None else (0, new_ny)
+
+    # in parallel: each band is a range of chunks, so the chunks (and their values) are the same as done here
+    if band_pool is not None and out is None and rows is None and not any(isinstance(r, BandRows) for r in rasters):
+        num_chunks = -(-new_ny // rows_per_chunk)
+        num_bands = min(band_pool.num_bands(rasters[0]), num_chunks)
+        if num_bands > 1:
+            bands = [(min(num_chunks * i // num_bands * rows_per_chunk, new_ny), 
+                      min(num_chunks * (i + 1) // num_bands * rows_per_chunk, new_ny)) for i in range(num_bands)]
+            return resample_rasters_by_bands(rasters, factor, rows_per_chunk, (new_ny, new_nx), bands, band_pool)
+    if new_ny >= ny and new_nx >= nx and new_ny * new_nx > ny * nx: # up-sampling: interpolate
+        footprint_area = 1.0 # the interpolation weights of each resampled cell sum up to 1
+        row_weights = bilinear_weights(ny, new_ny)
+        col_weights = bilinear_weights(nx, new_nx).T.tocsc()
+    else:
+        footprint_area = (ny / new_ny) * (nx / new_nx) # in source cells
+        row_weights = area_weights(ny, new_ny)
+        col_weights = area_weights(nx, new_nx).T.tocsc()
+
+    resampled = out
+    if resampled is None:
+        resampled = [numpy.empty((last - first, new_nx), dtype=float_dtype(r)) for r in rasters]
+    for start in range(first, last, rows_per_chunk):
+        end = min(start + rows_per_chunk, last)
+        chunk_weights = row_weights[start:end]
+        y0, y1 = chunk_weights.indices.min(), chunk_weights.indices.max() + 1 # source rows needed for this chunk
+        chunk_weights = chunk_weights[:, y0:y1]
+        for r, out in zip(rasters, resampled):
+            chunk = numpy.asarray(r[y0:y1], dtype=numpy.float64)
+            valid = ~numpy.isnan(chunk)
+            if valid.all(): # all footprints are fully valid
+                out[start - first:end - first] = (chunk_weights @ chunk @ col_weights) / footprint_area
+                continue
+            sums = chunk_weights @ numpy.where(valid, chunk, 0) @ col_weights
+            areas = chunk_weights @ valid.astype(numpy.float64) @ col_weights
+            # NaN unless at least half of the footprint is valid (minus a bit for rounding errors in the sums)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                out[start - first:end - first] = numpy.where(areas >= 0.5 * footprint_area - 1e-6, sums / areas, numpy.nan)
+    return resampled
+
+class BandRows:
+    '''Rows of a GDAL raster band that are only read from disk when sliced (e.g. by resample_rasters()), 
+    as float64 (or dtype) with cells close to the band's undefined value set to NaN
+    undef_val: undefined value of the band (None: no undefined value)
+    minus: None or (band, undef_val) of an aligned band to subtract (e.g. bottom = top - thickness) 
+    ignore_leq: None or elevation, cells <= ignore_leq are set to NaN'''
+    def __init__(self, band, undef_val=None, minus=None, ignore_leq=None, dtype=numpy.float64):
+        self.band = band
+        self.undef_val = undef_val
+        self.minus = minus
+        self.ignore_leq = ignore_leq
+        self.shape = (band.YSize, band.XSize)
+        self.dtype = numpy.dtype(dtype)
+
+    @staticmethod
+    def read(band, undef_val, y0, y1, dtype=numpy.float64):
+        rows = band.ReadAsArray(0, y0, band.XSize, y1 - y0).astype(dtype)
+        if undef_val != None:
+            rows[numpy.isclose(rows, undef_val)] = numpy.nan
+        return rows
+
+    def __getitem__(self, rows):
+        y0, y1, _ = rows.indices(self.shape[0])
+        a = self.read(self.band, self.undef_val, y0, y1, self.dtype)
+        if self.minus is not None:
+            a -= self.read(*self.minus, y0, y1, self.dtype)
+        if self.ignore_leq != None:
+            a[a <= self.ignore_leq] = numpy.nan
+        return a
+
+def get_overview_bands(bands, new_shape):
+    '''returns the coarsest overviews of the (aligned) GDAL raster bands that still have at least new_shape 
+    (rows, columns) cells, or the bands themselves if there's no such overview for all of them'''
+    overviews = []
+    for band in bands:
+        sizes = {}
+        for i in range(band.GetOverviewCount()):
+            ov = band.GetOverview(i)
+            if ov.YSize >= new_shape[0] and ov.XSize >= new_shape[1]:
+                sizes[(ov.YSize, ov.XSize)] = ov
+        overviews.append(sizes)
+    common = set(overviews[0]).intersection(*overviews[1:])
+    if len(common) == 0:
+        return bands
+    size = min(common) # coarsest
+    return [ov[size] for ov in overviews]
+
+def get_cached_overviews(raster_file, cache_folder, min_size=256):
+    '''Get a VRT of raster_file with (external, AVERAGE) overviews at levels 2, 4, 8, ... (down to about min_size 
+    cells) from cache_folder. If it's not there yet, it's made, which takes a full read of raster_file.
+    The VRT (and its .ovr file) are named after a hash of the absolute path of raster_file and one of its modification time
+    and size, so a changed file gets new overviews and the outdated overviews of that file are deleted.
+    returns the name of the VRT file and True if it was already cached (hit) or False (miss)'''
+    from osgeo import gdal # only needed here
+
+    path = os.path.abspath(raster_file)
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+    version_key = hashlib.sha1(f"{stat.st_mtime_ns} {stat.st_size}".encode("utf-8")).hexdigest()[:8]
+    vrt_name = os.path.join(cache_folder, f"{path_key}_{version_key}.vrt")
+    if os.path.exists(vrt_name): # the VRT is only renamed to this once its overviews are done
+        return vrt_name, True
+
+    os.makedirs(cache_folder, exist_ok=True)
+    for outdated in glob(os.path.join(cache_folder, path_key + "_*")):
+        os.remove(outdated)
+
+    # make the VRT and its overviews under a temp name, so an interrupted run doesn't leave a VRT without overviews
+    tmp_name = os.path.join(cache_folder, f"{path_key}_{version_key}_{os.getpid()}.tmp.vrt")
+    ds = gdal.Translate(tmp_name, path, format="VRT")
+    levels = []
+    while max(ds.RasterXSize, ds.RasterYSize) // (2 ** (len(levels) + 1)) >= min_size:
+        levels.append(2 ** (len(levels) + 1))
+    if len(levels) > 0:
+        ds.BuildOverviews("AVERAGE", levels)
+    ds = None # close
+    if len(levels) > 0:
+        os.replace(tmp_name + ".ovr", vrt_name + ".ovr")
+    os.replace(tmp_name, vrt_name)
+    return vrt_name, False
+
+
+class DEMCache:
+    '''On-disk cache of downloaded DEM GeoTIFFs (e.g. from Earth Engine) in folder, shared by all processes that use 
+    that folder (e.g. gunicorn workers). Each GeoTIFF is stored under a hash of its request (see key()), writes 
+    go to a temp file that's renamed when done, so a reader never sees a partly written GeoTIFF. When the GeoTIFFs 
+    take more than max_bytes, the least recently used ones are deleted (a hit touches its file).
+    hits and misses are counted for all caches of this process, for the log.'''
+    suffix = ".tif"
+    label = "DEM cache"
+    hits = 0
+    misses = 0
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(request):
+        '''hash of the request (dict of json-able values, e.g. DEM name, region, crs and scale)'''
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.folder, key + self.suffix)
+
+    def get(self, key):
+        '''returns the cached GeoTIFF (bytes) for key or None'''
+        try:
+            with open(self.file_name(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError: # (or just deleted by another process)
+            type(self).misses += 1
+            return None
+        type(self).hits += 1
+        try:
+            os.utime(self.file_name(key)) # most recently used
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data, evict=True):
+        '''stores the GeoTIFF data (bytes) for key, then deletes the least recently used GeoTIFFs beyond max_bytes
+        (unless evict is False, e.g. when several are put, call evict() after the last one)'''
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_name, self.file_name(key))
+        if evict:
+            self.evict()
+
+    def evict(self):
+        cached = []
+        for name in glob(os.path.join(self.folder, "*" + self.suffix)) + glob(os.path.join(self.folder, "*.tmp")):
+            try:
+                stat = os.stat(name)
+                if name.endswith(".tmp"): # left over by an interrupted write? (others are renamed within seconds)
+                    if time.time() - stat.st_mtime > 3600:
+                        os.remove(name)
+                    continue
+            except FileNotFoundError: # deleted (or renamed) by another process
+                continue
+            cached.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in cached)
+        for _, size, name in sorted(cached): # oldest first
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        '''hits and misses as string, for the log'''
+        return f"{self.label} hits: {type(self).hits}, misses: {type(self).misses}"
+
+
+class DEMChunkCache(DEMCache):
+    '''DEMCache for chunks of DEM rasters. The cells of a DEM, at a given crs and cell size, are split into a fixed
+    grid of chunk_cells x chunk_cells chunks (chunk col, row has its upper left cell at col, row chunk col * chunk_cells,
+    chunk row * chunk_cells), so requests for overlapping regions share the chunks they both cover and only need
+    to download the missing ones. Each chunk is stored as a compressed int16 (if that keeps all its values) or 
+    float32 array.'''
+    suffix = ".npz"
+    label = "DEM chunk cache"
+    hits = 0
+    misses = 0
+
+    def __init__(self, folder, max_bytes, chunk_cells=256):
+        super().__init__(folder, max_bytes)
+        self.chunk_cells = chunk_cells
+
+    @staticmethod
+    def to_bytes(chunk):
+        '''chunk as compressed npz file (bytes)'''
+        chunk = numpy.asarray(chunk)
+        if (numpy.all(numpy.isfinite(chunk)) and chunk.min() >= -32768 and chunk.max() <= 32767 and
+            numpy.array_equal(chunk, numpy.round(chunk))):
+            chunk = chunk.astype(numpy.int16)
+        else:
+            chunk = chunk.astype(numpy.float32)
+        buf = io.BytesIO()
+        numpy.savez_compressed(buf, chunk=chunk)
+        return buf.getvalue()
+
+    @staticmethod
+    def from_bytes(data):
+        with numpy.load(io.BytesIO(data)) as npz:
+            return npz["chunk"]
+
+    def get_raster(self, grid, col, row, num_cols, num_rows, fetch, max_workers=8):
+        '''returns the float32 raster of num_rows x num_cols cells whose upper left cell is at col, row of the 
+        chunk grid, and a dict with the number of chunks used, of cache hits and of the (compressed) bytes that 
+        were read from the cache instead of downloaded. grid is a dict with whatever defines the grid (e.g. DEM name,
+        crs and cell size), it becomes part of the key of each chunk. The chunks that aren't cached are fetched with 
+        fetch(chunk_col, chunk_row), which must return the chunk's chunk_cells x chunk_cells raster, with NaN for
+        cells without data (such chunks are stored as float32).
+        The missing chunks are fetched concurrently, by up to max_workers threads (a download mostly waits for 
+        the server), so fetch must be thread safe. The dict also has the number of fetched chunks, their 
+        (compressed) bytes and the seconds it took to fetch them, i.e. the cost of the missing chunks.'''
+        n = self.chunk_cells
+        raster = numpy.empty((num_rows, num_cols), dtype=numpy.float32)
+        stats = {"chunks": 0, "hits": 0, "bytes_saved": 0, "fetched": 0, "bytes_fetched": 0, "fetch_seconds": 0.0}
+
+        def copy_chunk(chunk_col, chunk_row, chunk):
+            '''copy the part of the chunk that overlaps the raster'''
+            r0, r1 = max(chunk_row * n, row), min((chunk_row + 1) * n, row + num_rows)
+            c0, c1 = max(chunk_col * n, col), min((chunk_col + 1) * n, col + num_cols)
+            raster[r0 - row:r1 - row, c0 - col:c1 - col] = chunk[r0 - chunk_row * n:r1 - chunk_row * n,
+                                                                 c0 - chunk_col * n:c1 - chunk_col * n]
+
+        def fetch_chunk(missing_chunk):
+            chunk_col, chunk_row, _ = missing_chunk
+            chunk = numpy.asarray(fetch(chunk_col, chunk_row))
+            assert chunk.shape == (n, n), f"chunk {chunk_col}, {chunk_row} has {chunk.shape} cells instead of {n} x {n}"
+            return chunk
+
+        missing = [] # (chunk col, chunk row, key)
+        for chunk_row in range(row // n, (row + num_rows - 1) // n + 1):
+            for chunk_col in range(col // n, (col + num_cols - 1) // n + 1):
+                key = self.key(dict(grid, chunk_cells=n, chunk=[chunk_col, chunk_row]))
+                data = self.get(key)
+                stats["chunks"] += 1
+                if data is None:
+                    missing.append((chunk_col, chunk_row, key))
+                    continue
+                stats["hits"] += 1
+                stats["bytes_saved"] += len(data)
+                copy_chunk(chunk_col, chunk_row, self.from_bytes(data))
+
+        if len(missing) > 0:
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=max(min(max_workers, len(missing)), 1)) as executor:
+                for (chunk_col, chunk_row, key), chunk in zip(missing, executor.map(fetch_chunk, missing)):
+                    data = self.to_bytes(chunk)
+                    self.put(key, data, evict=False)
+                    stats["fetched"] += 1
+                    stats["bytes_fetched"] += len(data)
+                    copy_chunk(chunk_col, chunk_row, chunk)
+            stats["fetch_seconds"] = time.time() - start
+            self.evict()
+        return raster, stats
+
+
+def get_peak_memory_MB():
+    '''returns the peak memory use (max. resident set size) of the current process in MB, 
+    or None if that can't be found out (no resource module on Windows)'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # bytes on macOS, kB on Linux
+        max_rss /= 1024
+    return max_rss / 1024
+
+def share_raster(ras):
+    '''copy raster ras into a new shared memory block, so worker processes can use it without getting 
+    their own pickled copy. A memmap raster is not copied, the workers map (their part of) its file instead.
+    returns the SharedMemory object (close() and unlink() it once the workers are done, None for a memmap) and the 
+    (name, shape, dtype) tuple needed to attach to it via attach_shared_raster()'''
+    if is_memmap(ras):
+        ras.flush()
+        return None, ("memmap:" + ras.filename, ras.shape, ras.dtype.str)
+    shm = shared_memory.SharedMemory(create=True, size=max(ras.nbytes, 1)) # size 0 is not allowed
+    numpy.ndarray(ras.shape, dtype=ras.dtype, buffer=shm.buf)[:] = ras
+    return shm, (shm.name, ras.shape, ras.dtype.str)
+
+def attach_shared_raster(shared, window=None, writeable=False):
+    '''attach to a raster put into shared memory by share_raster() (or new_shared_raster())
+    shared: (name, shape, dtype) tuple returned by share_raster()
+    window: None or (slice of rows, slice of columns) of the raster to use
+    writeable: if True, the view can be written to (e.g. by the band workers of BandPool, each into its own rows)
+    returns the SharedMemory object and a read-only (or writeable) view of the raster (or its window). The view is only 
+    valid until the SharedMemory object is closed (or garbage collected), so keep it until the view is no longer used.
+    For a memmap raster, only the rows of the window are mapped and the SharedMemory object is None'''
+    name, shape, dtype = shared
+    if name.startswith("memmap:"):
+        rows, cols = window if window is not None else (slice(None), slice(None))
+        y0, y1, _ = rows.indices(shape[0])
+        row_bytes = shape[1] * numpy.dtype(dtype).itemsize
+        mode = "r+" if writeable == True else "r"
+        ras = numpy.memmap(name[len("memmap:"):], dtype=dtype, mode=mode, offset=y0 * row_bytes, shape=(y1 - y0, shape[1]))
+        return None, ras[:, cols]
+    shm = shared_memory.SharedMemory(name=name)
+    ras = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if window is not None:
+        ras = ras[window]
+    ras.flags.writeable = writeable
+    return shm, ras
+
+def new_shared_raster(shape, dtype, like=None):
+    '''returns a new raster that worker processes can write into (via attach_shared_raster(..., writeable=True)): a new
+    memmap next to the file of like, if that's a memmap, otherwise in a new shared memory block. Returns the 
+    SharedMemory object (None for a memmap), the raster and its (name, shape, dtype), as share_raster()'''
+    dtype = numpy.dtype(dtype)
+    if like is not None and is_memmap(like):
+        ras = new_memmap_raster(shape, dtype, os.path.dirname(like.filename))
+        return None, ras, ("memmap:" + ras.filename, tuple(shape), dtype.str)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(numpy.prod(shape)) * dtype.itemsize, 1))
+    return shm, numpy.ndarray(shape, dtype=dtype, buffer=shm.buf), (shm.name, tuple(shape), dtype.str)
+
+class BandPool:
+    '''Pool of worker processes for the preprocessing of large rasters (fillHoles(), dilate_array(), clean_up_diags(),
+    resample_rasters()), which split the raster into row bands and run on the bands in parallel, see map_row_bands(). 
+    Rasters with fewer than 2 x min_cells_per_band cells are not worth it and are processed as usual. 
+    The processes are only started when they are first needed, close() the pool when done.'''
+    def __init__(self, num_processes=None, min_cells_per_band=1 << 20):
+        self.num_processes = num_processes if num_processes is not None else os.cpu_count()
+        self.min_cells_per_band = min_cells_per_band
+        self.pool = None
+
+    def num_bands(self, ras):
+        '''returns the number of row bands ras is split into (1: process it as usual)'''
+        ny, nx = ras.shape
+        return max(min(self.num_processes, ny, ny * nx // self.min_cells_per_band), 1)
+
+    def map(self, func, tasks):
+        if self.pool is None:
+            import multiprocessing
+            mp = multiprocessing.get_context('spawn') # same as get_zipped_tiles()
+            self.pool = mp.Pool(processes=self.num_processes)
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def map_row_bands(band_pool, func, rasters, halo=0, dtype=None, args=()):
+    '''Runs func on row bands of the (aligned) rasters, in parallel on the processes of band_pool, and stitches 
+    the rows it returns into a new raster (a memmap next to the first raster's file if that's a memmap).
+    Each band gets halo extra rows above and below (unless at the raster's edges), so func can make its rows
+    the same as for the whole raster (e.g. 1 for 3 x 3 neighborhoods). The rasters are put into shared memory once 
+    and the workers write their rows straight into the new raster, so the bands are not pickled.
+    func must be a module level function (so it can be pickled), it's called in the worker as 
+    func(rows, first, last, offset, ny, *args), with rows: list of the band's rows (incl. halo) of each raster, as
+    writeable copies, first, last: the band's rows within them, offset: the raster row of rows[0], ny: the raster's 
+    number of rows. It returns the band's last - first rows and a (picklable) result.
+    dtype: dtype of the new raster (default: the first raster's)
+    returns the new raster and a list of the results of the bands (in band order)'''
+    ras = rasters[0]
+    ny = ras.shape[0]
+    num_bands = band_pool.num_bands(ras)
+    bands = [(ny * i // num_bands, ny * (i + 1) // num_bands) for i in range(num_bands)]
+    blocks, shared = [], []
+    try:
+        for r in rasters:
+            if is_memmap(r) and not r.flags.c_contiguous: # e.g. cropped, but the workers map whole rows of the file
+                r = copy_raster(r)
+            shm, sh = share_raster(r)
+            blocks.append(shm)
+            shared.append(sh)
+        shm, out, out_shared = new_shared_raster(ras.shape, dtype if dtype is not None else ras.dtype, ras)
+        blocks.append(shm)
+        tasks = [(func, shared, out_shared, y0, y1, max(y0 - halo, 0), min(y1 + halo, ny), args) for y0, y1 in bands]
+        results = band_pool.map(run_row_band, tasks)
+        if shm is not None: # copy it out of shared memory
+            out = numpy.array(out)
+        else:
+            out.flush()
+    except BaseException:
+        out = None # (a view of the shared memory can't be open when it's closed)
+        raise
+    finally:
+        for shm in blocks:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+    return out, results
+
+def run_row_band(task):
+    '''worker of map_row_bands(): runs func on a band of rows and writes its rows into the new raster'''
+    func, shared, out_shared, y0, y1, h0, h1, args = task
+    rows = []
+    for sh in shared:
+        shm, r = attach_shared_raster(sh, (slice(h0, h1), slice(None)))
+        rows.append(numpy.array(r)) # own (writeable) copy of the band
+        del r
+        if shm is not None:
+            shm.close()
+    band, result = func(rows, y0 - h0, y1 - h0, h0, shared[0][1][0], *args)
+    del rows
+    shm, out = attach_shared_raster(out_shared, (slice(y0, y1), slice(None)), writeable=True)
+    out[:] = band
+    del out
+    if shm is not None:
+        shm.close()
+    return result
+
+def iterate_row_bands(band_pool, func, ras, num_rounds=-1, halo_per_round=1, rounds_per_batch=8, dtype=None, args=()):
+    '''Runs an operator that's repeated in rounds until a round doesn't change anything (or for num_rounds rounds, 
+    -1 means until then) on row bands of ras in parallel, see map_row_bands(). A change at a band's edges can only 
+    spread halo_per_round rows per round, so with halo_per_round halo rows per round, the band's rows stay the same as 
+    for the whole raster for a batch of rounds_per_batch rounds. After each batch the bands are stitched into a new raster
+    (this is the fix-up across the band borders) from which the bands of the next batch are taken. 
+    func is called as func(rows, first, last, offset, ny, number of rounds of the batch, *args), see map_row_bands(), 
+    it returns the band's rows and a list of the number of changed cells of the band's rows for each round (which 
+    can stop early if nothing changed in the band incl. its halo).
+    returns the changed raster (ras itself if no round was done) and a list of the number of changed cells of each 
+    round, up to and incl. the first round without changes'''
+    num_changed = []
+    while num_rounds == -1 or len(num_changed) < num_rounds:
+        batch = rounds_per_batch if num_rounds == -1 else min(rounds_per_batch, num_rounds - len(num_changed))
+        out, counts = map_row_bands(band_pool, func, [ras], halo_per_round * batch, dtype, (batch, *args))
+        if is_memmap(ras) and len(num_changed) > 0: # scratch file of the previous batch
+            filename = ras.filename
+            del ras
+            try:
+                os.remove(filename)
+            except OSError: # (e.g. still mapped on Windows, then it goes with the scratch folder)
+                pass
+        ras = out
+        totals = [sum(c[i] for c in counts if i < len(c)) for i in range(batch)]
+        if 0 in totals: # no changes after this round
+            num_changed += totals[:totals.index(0) + 1]
+            break
+        num_changed += totals
+    return ras, num_changed
+
+def fill_holes_band(rows, first, last, offset, ny, num_rounds, num_neighbors, NaN_are_holes):
+    '''band worker of fillHoles(): num_rounds rounds on the band, as done by fillHoles() for the whole raster'''
+    band = rows[0]
+    def is_hole(values):
+        if NaN_are_holes == True:
+            return numpy.isnan(values)
+        return ~(values > 0)
+    corners = [(y - offset, x) for y in (0, ny - 1) for x in (0, -1) if offset <= y < offset + len(band)] # of the raster
+    hy, hx = numpy.nonzero(is_hole(band))
+    num_filled = []
+    for round in range(num_rounds):
+        values = gather_3x3(band, hy, hx)
+        fill = numpy.count_nonzero(values > 0, axis=0) >= num_neighbors
+        band[hy[fill], hx[fill]] = nanmean_3x3(values[:, fill])
+        num_filled.append(int(numpy.count_nonzero(fill & (hy >= first) & (hy < last))))
+        if NaN_are_holes == False:
+            for cy, cx in corners:
+                band[cy, cx] = 0 if band[cy, cx] < 0 else band[cy, cx]
+        if not numpy.any(fill): # nothing changed, nor will it in the next rounds
+            break
+        still_hole = is_hole(band[hy, hx])
+        hy, hx = hy[still_hole], hx[still_hole]
+    return band[first:last], num_filled
+
+def clean_up_diags_band(rows, first, last, offset, ny, num_rounds):
+    '''band worker of clean_up_diags(): num_rounds rounds on the band, as done by clean_up_diags() for the whole raster'''
+    band = rows[0].astype(float_dtype(rows[0]), copy=False)
+    mask = ~numpy.isnan(band)
+    num_removed = remove_diag_patterns(mask, num_rounds, slice(first, last))
+    band[~mask] = numpy.nan
+    return band[first:last], num_removed
+
+def dilate_band(rows, first, last, offset, ny):
+    '''band worker of dilate_array()'''
+    return dilate_array(*rows)[first:last], None
+
+def resample_rasters_by_bands(rasters, factor, rows_per_chunk, new_shape, bands, band_pool):
+    '''resample_rasters() with the resampled rows of each band made in parallel by the processes of band_pool 
+    from the rasters in shared memory, written straight into the resampled rasters (also in shared memory)'''
+    blocks, shared, shared_out, resampled = [], [], [], []
+    try:
+        for r in rasters:
+            shm, sh = share_raster(r)
+            blocks.append(shm)
+            shared.append(sh)
+            shm, out, sh = new_shared_raster(new_shape, float_dtype(r))
+            blocks.append(shm)
+            resampled.append(out)
+            shared_out.append(sh)
+        band_pool.map(resample_band, [(shared, shared_out, factor, rows_per_chunk, new_shape, rows) for rows in bands])
+        resampled = [numpy.array(out) for out in resampled] # copy them out of shared memory
+    except BaseException:
+        resampled = out = None # (a view of the shared memory can't be open when it's closed)
+        raise
+    finally:
+        for shm in blocks:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+    return resampled
+
+def resample_band(task):
+    '''worker of resample_rasters_by_bands()'''
+    shared, shared_out, factor, rows_per_chunk, new_shape, (first, last) = task
+    attached = [attach_shared_raster(sh) for sh in shared]
+    attached += [attach_shared_raster(sh, (slice(first, last), slice(None)), writeable=True) for sh in shared_out]
+    blocks = [shm for shm, _ in attached]
+    ras = [r for _, r in attached[:len(shared)]]
+    out = [r for _, r in attached[len(shared):]]
+    del attached
+    resample_rasters(ras, factor, rows_per_chunk, new_shape, out=out, rows=(first, last))
+    del ras, out
+    for shm in blocks:
+        if shm is not None:
+            shm.close()
+
+def row_blocks(ras, cells_per_block=1 << 20):
+    '''yields the (y0, y1) rows of the blocks of (about) cells_per_block cells in which ras is processed'''
+    ny, nx = ras.shape
+    rows_per_block = max(cells_per_block // max(nx, 1), 1)
+    for y0 in range(0, ny, rows_per_block):
+        yield y0, min(y0 + rows_per_block, ny)
+
+class RasterStats:
+    '''NaN-aware min/max and number of NaN cells of a raster. They are gathered in one pass over blocks of rows when 
+    first needed (or while the raster is processed anyway, see preprocess_raster()) and are then cached, instead of 
+    doing a nanmin() and a nanmax() pass over the full raster for each log line. Make new stats after changing the raster.'''
+    def __init__(self, ras):
+        self.ras = ras
+        self.gathered = False
+        self._min = self._max = numpy.nan
+        self._num_nan = 0
+
+    def add(self, rows):
+        '''adds the stats of some rows of the raster'''
+        if rows.size > 0:
+            self._min = numpy.fmin(self._min, numpy.fmin.reduce(rows, axis=None)) # fmin/fmax ignore NaN
+            self._max = numpy.fmax(self._max, numpy.fmax.reduce(rows, axis=None))
+            self._num_nan += int(numpy.count_nonzero(numpy.isnan(rows)))
+
+    def gather(self):
+        if self.gathered == False:
+            for y0, y1 in row_blocks(self.ras):
+                self.add(self.ras[y0:y1])
+            self.gathered = True
+            self.ras = None # (the stats don't keep the raster alive)
+        return self
+
+    @property
+    def min(self):
+        return self.gather()._min
+
+    @property
+    def max(self):
+        return self.gather()._max
+
+    @property
+    def num_nan(self):
+        return self.gather()._num_nan
+
+def preprocess_raster(ras, undef_val=None, nan_zeros=False, ignore_leq=None, max_abs_elev=None, cells_per_block=1 << 20):
+    '''Sets cells of ras to NaN, in place: cells close to undef_val (numpy.isclose()), cells that are 0 (nan_zeros),
+    cells <= ignore_leq and cells below -max_abs_elev or above max_abs_elev. Instead of a numpy.where() pass with a full 
+    size temporary raster for each, this is done in a single pass over blocks of rows, with boolean masks per block.
+    returns the RasterStats of the changed raster (gathered during the pass) and a dict with the number of cells set 
+    to NaN by each test (undef, zero, ignore_leq, too_low, too_high)'''
+    stats = RasterStats(None)
+    num_nan = dict(undef=0, zero=0, ignore_leq=0, too_low=0, too_high=0)
+    for y0, y1 in row_blocks(ras, cells_per_block):
+        rows = ras[y0:y1]
+        nan = numpy.zeros(rows.shape, dtype=bool)
+        for test, cells in [("undef", None if undef_val == None else lambda: numpy.isclose(rows, undef_val)),
+                            ("zero", None if nan_zeros == False else lambda: rows == 0.0),
+                            ("ignore_leq", None if ignore_leq == None else lambda: rows <= ignore_leq),
+                            ("too_low", None if max_abs_elev == None else lambda: rows < -max_abs_elev),
+                            ("too_high", None if max_abs_elev == None else lambda: rows > max_abs_elev)]:
+            if cells is not None:
+                cells = cells() & ~nan # (only count cells not already set to NaN by a previous test)
+                num_nan[test] += int(numpy.count_nonzero(cells))
+                nan |= cells
+        rows[nan] = numpy.nan
+        stats.add(rows)
+    stats.gathered = True
+    return stats, num_nan
+
+def raise_raster(ras, threshold=None, offset=0, offset_masks=(), cells_per_block=1 << 20):
+    '''Raises cells of ras in place, in a single pass over blocks of rows: cells > threshold are raised by offset 
+    (lower_leq, done by raising the other cells to avoid negative elevations). Then, for each (mask, offset) in 
+    offset_masks (aligned rasters), the cells that are not masked (mask <= 0 or NaN) are raised by offset and 
+    negative cells are set to 0 (offset_masks_lower).
+    returns the RasterStats of the changed raster (gathered during the pass)'''
+    stats = RasterStats(None)
+    for y0, y1 in row_blocks(ras, cells_per_block):
+        rows = ras[y0:y1]
+        if threshold is not None:
+            numpy.add(rows, offset, out=rows, where=rows > threshold)
+        for mask, mask_offset in offset_masks:
+            numpy.add(rows, mask_offset, out=rows, where=~(mask[y0:y1] > 0))
+            rows[rows < 0] = 0
+        stats.add(rows)
+    stats.gathered = True
+    return stats
+
+def float_dtype(ras):
+    '''returns the dtype a raster is processed in: float32 for a float32 raster (see float32_rasters), otherwise float64'''
+    return numpy.dtype(numpy.float32) if ras.dtype == numpy.float32 else numpy.dtype(numpy.float64)
+
+def is_memmap(ras):
+    '''True if ras is a numpy.memmap backed by a file'''
+    return isinstance(ras, numpy.memmap) and ras.filename is not None
+
+def new_memmap_raster(shape, dtype, folder):
+    '''returns a new (zeroed) raster in a memory mapped scratch file (.raw) in folder, for out-of-core processing'''
+    fd, name = tempfile.mkstemp(suffix=".raw", dir=folder)
+    os.close(fd)
+    return numpy.memmap(name, dtype=dtype, mode="w+", shape=shape)
+
+def memmap_raster(ras, folder, rows_per_block=1024):
+    '''returns a copy of ras in a memory mapped scratch file in folder (or ras itself if it's already a memmap)'''
+    if is_memmap(ras):
+        return ras
+    out = new_memmap_raster(ras.shape, ras.dtype, folder)
+    for y0 in range(0, ras.shape[0], rows_per_block):
+        out[y0:y0 + rows_per_block] = ras[y0:y0 + rows_per_block]
+    return out
+
+def map_row_blocks(func, rasters, halo=0, in_place=False, rows_per_block=1024):
+    '''returns func(*rasters) for the (aligned) rasters. If the first raster is a memmap, func is instead run on 
+    blocks of rows_per_block rows of the rasters, with halo extra rows above and below (e.g. 1 for 3 x 3 neighborhoods), 
+    and the rows of its result (without the halo rows) are written into a new memmap next to the first raster's file
+    or, with in_place (only for halo 0), into the first raster itself. func must return an array of the rows it got.'''
+    ras = rasters[0]
+    if not is_memmap(ras):
+        return func(*rasters)
+    assert halo == 0 or in_place == False, "can't change the raster in place if the blocks overlap"
+    ny = ras.shape[0]
+    out = ras if in_place == True else None
+    for y0 in range(0, ny, rows_per_block):
+        y1 = min(y0 + rows_per_block, ny)
+        h0, h1 = max(y0 - halo, 0), min(y1 + halo, ny)
+        rows = func(*[numpy.asarray(r[h0:h1]) for r in rasters])[y0 - h0:y1 - h0]
+        if out is None:
+            out = new_memmap_raster(ras.shape, rows.dtype, os.path.dirname(ras.filename))
+        out[y0:y1] = rows
+    return out
+
+def copy_raster(ras):
+    '''returns a copy of ras (a new memmap for a memmap)'''
+    return map_row_blocks(numpy.copy, [ras])
+
+def pad_raster(ras, rows_per_block=1024):
+    '''returns ras padded by 1 cell on all sides with its edge values (numpy.pad(ras, (1,1), 'edge')), 
+    for a memmap as a new memmap'''
+    if not is_memmap(ras):
+        return numpy.pad(ras, (1,1), 'edge')
+    ny, nx = ras.shape
+    out = new_memmap_raster((ny + 2, nx + 2), ras.dtype, os.path.dirname(ras.filename))
+    for y0 in range(0, ny, rows_per_block):
+        y1 = min(y0 + rows_per_block, ny)
+        out[y0 + 1:y1 + 1] = numpy.pad(ras[y0:y1], ((0, 0), (1, 1)), 'edge')
+    out[0] = out[1]
+    out[-1] = out[-2]
+    return out
+
+
+def deflate_tile(buf=None, filename=None, level=6, chunk_size=1024*1024):
+    '''compress a tile buffer (str or bytes-like) or the file filename into a raw deflate stream, i.e. the data 
+    of a ZIP_DEFLATED zip member, so that the (slow) compression can run in the tile worker processes. 
+    For a file, the stream is written to filename + ".deflate" (in chunks) and filename is removed.
+    returns the deflated buffer (or the name of the .deflate file), the CRC-32 and the size of the uncompressed data
+    Use write_deflated_to_zip() to put it into a zip file'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # negative wbits: raw stream, no zlib header/checksum
+    crc = 0
+    size = 0
+    if filename is None:
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8") # same as ZipFile.writestr() 
+        crc = zlib.crc32(buf)
+        size = len(buf)
+        return compressor.compress(buf) + compressor.flush(), crc, size
+
+    deflated_filename = filename + ".deflate"
+    with open(filename, "rb") as fi, open(deflated_filename, "wb") as fo:
+        while True:
+            chunk = fi.read(chunk_size)
+            if not chunk: 
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            fo.write(compressor.compress(chunk))
+        fo.write(compressor.flush())
+    os.remove(filename)
+    return deflated_filename, crc, size
+
+def write_deflated_to_zip(zip_file, arcname, deflated, crc, file_size, chunk_size=1024*1024):
+    '''add a member that was already compressed by deflate_tile() to zip_file (a ZipWriter), without compressing 
+    it again. deflated is either the deflated buffer or the name of the .deflate file (which is not removed), crc and 
+    file_size are the CRC-32 and size of the uncompressed data, as returned by deflate_tile()'''
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16 # permissions: ?rw-------, same as writestr()
+    zinfo.file_size = file_size
+    zinfo.CRC = crc
+    if isinstance(deflated, str):
+        zinfo.compress_size = os.path.getsize(deflated)
+        with open(deflated, "rb") as fi:
+            zip_file.write_raw(zinfo, fi, chunk_size)
+    else:
+        zinfo.compress_size = len(deflated)
+        zip_file.write_raw(zinfo, deflated)
+
+def copy_zip_member(part_zip_name, name, zip_file, arcname=None, chunk_size=1024*1024):
+    '''copy the member name of the zip file part_zip_name (e.g. the part archive of a tile worker) into 
+    zip_file (a ZipWriter) as arcname, as is, i.e. its compressed data is neither decompressed nor compressed again'''
+    with zipfile.ZipFile(part_zip_name) as part:
+        info = part.getinfo(name)
+    zinfo = zipfile.ZipInfo(name if arcname is None else arcname, date_time=info.date_time)
+    for attr in ("compress_type", "external_attr", "CRC", "file_size", "compress_size"):
+        setattr(zinfo, attr, getattr(info, attr))
+
+    with open(part_zip_name, "rb") as fi:
+        # skip the local header, which has a variable length name and extra field
+        fi.seek(info.header_offset)
+        header = fi.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f"{part_zip_name}: bad local header of {name}")
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        fi.seek(name_length + extra_length, os.SEEK_CUR)
+        zip_file.write_raw(zinfo, fi, chunk_size)
+
+ZIP64_LIMIT = (1 << 31) - 1 # beyond it, sizes and offsets go into a ZIP64 extra field (same limit as zipfile)
+
+class ZipWriter:
+    '''Writes a new zip file, with the part of the zipfile.ZipFile API that get_zipped_tiles() uses (write(), 
+    writestr(), open(zinfo, "w"), close(), filename) plus write_raw(), which adds a member whose data is already 
+    compressed (e.g. deflated in a tile worker process by deflate_tile() or copied from a worker's part archive by 
+    copy_zip_member()), without decompressing it. ZipFile has no public API for that, so the local headers and the 
+    central directory are written here (see the zip file spec, APPNOTE.TXT), with ZIP64 extra fields where needed.
+    Members are described by zipfile.ZipInfo objects. Reading the zip file is left to ZipFile.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, "wb")
+        self.members = [] # ZipInfo of each member (with its header_offset), for the central directory
+        self.writing = False # True while a member opened with open() is written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def dos_date_time(date_time):
+        year, month, day, hour, minute, second = date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    @staticmethod
+    def name_and_flags(zinfo):
+        '''encoded file name, flag bit 11 is set for a utf-8 name (same as ZipFile)'''
+        if zinfo.filename.isascii():
+            return zinfo.filename.encode("ascii"), 0
+        return zinfo.filename.encode("utf-8"), 0x800
+
+    def local_header(self, zinfo, zip64):
+        name, flags = self.name_and_flags(zinfo)
+        dos_time, dos_date = self.dos_date_time(zinfo.date_time)
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, zinfo.file_size, zinfo.compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+        else:
+            extra = b""
+            file_size, compress_size = zinfo.file_size, zinfo.compress_size
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, flags, zinfo.compress_type, dos_time, dos_date,
+                           zinfo.CRC, compress_size, file_size, len(name), len(extra)) + name + extra
+
+    def start_member(self, zinfo, zip64):
+        if self.fp is None:
+            raise ValueError("Attempt to write to ZIP archive that was already closed")
+        if self.writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        if zinfo.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError(f"{zinfo.filename}: compression method {zinfo.compress_type} is not supported")
+        zinfo.header_offset = self.fp.tell()
+        self.fp.write(self.local_header(zinfo, zip64))
+
+    def write_raw(self, zinfo, data, chunk_size=1024*1024):
+        '''add the member zinfo (a ZipInfo with compress_type, CRC, file_size and compress_size) with its already 
+        compressed data, either a buffer or a file object positioned at its start (zinfo.compress_size bytes are 
+        read from it)'''
+        self.start_member(zinfo, zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if len(data) != zinfo.compress_size:
+                raise ValueError(f"{zinfo.filename}: compressed data has {len(data)} bytes instead of {zinfo.compress_size}")
+            self.fp.write(data)
+        else:
+            remaining = zinfo.compress_size
+            while remaining > 0:
+                chunk = data.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise EOFError(f"{zinfo.filename}: compressed data is shorter than {zinfo.compress_size} bytes")
+                self.fp.write(chunk)
+                remaining -= len(chunk)
+        self.members.append(zinfo)
+
+    def open(self, name, mode="w", force_zip64=False):
+        '''returns a binary file object to write the member name (a ZipInfo or a string) into, as ZipFile.open().
+        Its CRC and sizes are written into its local header (and into the ZipInfo) when it's closed. Without 
+        force_zip64, a member can only get bigger than 2 GB if the ZipInfo's file_size says so up front'''
+        if mode != "w":
+            raise ValueError('open() requires mode "w"')
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+            zinfo.external_attr = 0o600 << 16
+        zip64 = force_zip64 or zinfo.file_size * 1.05 > ZIP64_LIMIT
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        self.start_member(zinfo, zip64)
+        self.writing = True
+        return ZipWriterStream(self, zinfo, zip64)
+
+    def write(self, filename, arcname=None, compress_type=None):
+        '''add the file filename as arcname, compressed with compress_type (default: ZIP_STORED), as ZipFile.write()'''
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname) # date, time and permissions of the file
+        zinfo.compress_type = compress_type if compress_type is not None else zipfile.ZIP_STORED
+        with open(filename, "rb") as fi, self.open(zinfo, "w") as zip_stream:
+            shutil.copyfileobj(fi, zip_stream, 1024*1024)
+
+    def writestr(self, arcname, data, compress_type=None):
+        '''add data (str, written as utf-8, or bytes) as arcname, as ZipFile.writestr()'''
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = compress_type if compress_type is not None else zipfile.ZIP_STORED
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(data)
+        with self.open(zinfo, "w") as zip_stream:
+            zip_stream.write(data)
+
+    def close(self):
+        '''write the central directory and close the file'''
+        if self.fp is None:
+            return
+        if self.writing:
+            raise ValueError("Can't close the ZIP file while there is an open writing handle on it.")
+        cd_offset = self.fp.tell()
+        for zinfo in self.members:
+            name, flags = self.name_and_flags(zinfo)
+            dos_time, dos_date = self.dos_date_time(zinfo.date_time)
+            values = [zinfo.file_size, zinfo.compress_size, zinfo.header_offset] # in this order if in the ZIP64 extra
+            zip64_values = [v for v in values if v > ZIP64_LIMIT]
+            file_size, compress_size, header_offset = [0xFFFFFFFF if v > ZIP64_LIMIT else v for v in values]
+            extra = struct.pack(f"<HH{len(zip64_values)}Q", 1, 8 * len(zip64_values), *zip64_values) if zip64_values else b""
+            version = 45 if zip64_values else 20
+            self.fp.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version, version, flags, # made on unix 
+                                      zinfo.compress_type, dos_time, dos_date, zinfo.CRC, compress_size, file_size,
+                                      len(name), len(extra), 0, 0, 0, zinfo.external_attr, header_offset) + name + extra)
+        cd_size = self.fp.tell() - cd_offset
+        num_members = len(self.members)
+        if num_members > 0xFFFF or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            zip64_end_offset = self.fp.tell()
+            self.fp.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, num_members, num_members, cd_size, cd_offset))
+            self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, zip64_end_offset, 1))
+            num_members, cd_size, cd_offset = min(num_members, 0xFFFF), min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF)
+        self.fp.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, num_members, num_members, cd_size, cd_offset, 0))
+        self.fp.close()
+        self.fp = None
+
+class ZipWriterStream(io.BufferedIOBase):
+    '''file object of a member of a ZipWriter that is written into, see ZipWriter.open()'''
+    def __init__(self, zip_writer, zinfo, zip64):
+        self.zip_writer = zip_writer
+        self.zinfo = zinfo
+        self.zip64 = zip64
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if zinfo.compress_type == zipfile.ZIP_DEFLATED else None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        data = memoryview(data).cast("B")
+        num_bytes = len(data)
+        self.zinfo.file_size += num_bytes
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.zinfo.compress_size += len(data)
+        self.zip_writer.fp.write(data)
+        return num_bytes
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            fp = self.zip_writer.fp
+            if self.compressor is not None:
+                tail = self.compressor.flush()
+                self.zinfo.compress_size += len(tail)
+                fp.write(tail)
+            if not self.zip64 and (self.zinfo.file_size > ZIP64_LIMIT or self.zinfo.compress_size > ZIP64_LIMIT):
+                raise RuntimeError(f"{self.zinfo.filename}: file size too large, try using force_zip64")
+            end = fp.tell()
+            fp.seek(self.zinfo.header_offset) # put the CRC and sizes into the local header
+            fp.write(self.zip_writer.local_header(self.zinfo, self.zip64))
+            fp.seek(end)
+            self.zip_writer.members.append(self.zinfo)
+        finally:
+            self.zip_writer.writing = False
+            super().close()
+
 '''
 # Test
 numpy.set_printoptions(linewidth=numpy.inf)
@@ -557,6 +557,14 @@ def export():
             yield html
             return "bailing out!"# Cannot continue without proper temp folder
 
+        # re-use earlier Earth Engine downloads of the same area
+        if DEM_CACHE_FOLDER != None:
+            args["DEM_cache"] = DEM_CACHE_FOLDER
+            args["DEM_cache_max_MB"] = DEM_CACHE_MAX_MB
+        if DEM_CHUNK_CACHE_FOLDER != None:
+            args["DEM_chunk_cache"] = DEM_CHUNK_CACHE_FOLDER
+            args["DEM_cache_max_MB"] = DEM_CACHE_MAX_MB
+
         # name of zip file is time since 2000 in 0.01 seconds
         fname = str(int((datetime.now()-datetime(2000,1,1)).total_seconds() * 1000))
         args["zip_file_name"] = fname
@@ -50,6 +50,13 @@ TMP_FOLDER = os.getenv('TOUCHTERRAIN_TMP_FOLDER', os.path.join(config.SERVER_DIR
 DOWNLOADS_FOLDER = os.getenv('TOUCHTERRAIN_DOWNLOADS_FOLDER', os.path.join(config.SERVER_DIR, "downloads"))
 PREVIEWS_FOLDER = os.getenv('TOUCHTERRAIN_PREVIEWS_FOLDER', os.path.join(config.SERVER_DIR, "previews"))
 
+# folder for GeoTIFFs downloaded from Earth Engine, re-used by identical requests (shared by all workers)
+# None => no caching. Don't put it inside TMP_FOLDER, which gets cleaned by tmpwatch
+DEM_CACHE_FOLDER = os.getenv('TOUCHTERRAIN_DEM_CACHE_FOLDER', None)
+DEM_CACHE_MAX_MB = int(os.getenv('TOUCHTERRAIN_DEM_CACHE_MAX_MB', 2000))
+# folder for chunks of Earth Engine DEMs, re-used by overlapping requests (None => no chunks)
+DEM_CHUNK_CACHE_FOLDER = os.getenv('TOUCHTERRAIN_DEM_CHUNK_CACHE_FOLDER', None)
+
 # This will be inlined in index.html to enable Google Analytics, However, this is
 # my tracking id, so if you use google analytics, make sure to use your own Tracking ID!
 GOOGLE_ANALYTICS_TRACKING_ID = "G-EGX5Y3PBYH"